@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Offline benchmark of generation, completion scanning and submission.
+# Every run gets its own temporary workspace and submits to the stub schedulers in stubs/,
+# optionally with artificial latency per scheduler call. The results are saved as JSON for comparison.
+#
+# python3 benchmark/benchmark.py --nfiles 100,1000,10000 --backends sukap,cedar,condor --latency 0.05
+# python3 benchmark/benchmark.py --compare benchmark_old.json benchmark_new.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import platform
+import subprocess
+import contextlib
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import runSimulation
+
+BACKENDS = ["sukap", "sukap-bulk", "cedar", "cedar-array", "condor"]
+PHASES = ["generate", "scan", "submit"]
+
+def make_config(workspace, backend, nfiles, args):
+    config = runSimulation.SimulationConfig()
+    config.curdir = workspace
+    config.siffile = os.path.join(workspace, "software.sif")
+    config.sandbox = os.path.join(workspace, "sandbox")
+    config.nfiles = nfiles
+    config.gen_workers = args.workers
+    config.files_per_job = args.files_per_job
+    config.compact = args.compact
+    # The throttle is part of what is measured, but by default it should not wait for the stub queues
+    config.max_jobs = args.max_jobs
+    config.submit_rate = args.submit_rate
+    config.queue_poll_interval = args.poll_interval
+    config.submit_retries = 0
+    if backend.startswith("sukap"):
+        config.submit_sukap_jobs = True
+        config.sukap_bulk = backend == "sukap-bulk"
+    elif backend.startswith("cedar"):
+        config.submit_cedar_jobs = True
+        config.rapaccount = "def-benchmark"
+        config.cedar_array = backend == "cedar-array"
+    else:
+        config.submit_condor_jobs = True
+    return config
+
+def fake_outputs(fgen, config, fraction):
+    # Empty outputs for every stage of the first fraction of the indices, so the scan and the submission see a partial campaign
+    configString = config.get_config_string()
+    indices = config.get_indices()
+    for i in indices[:int(len(indices) * fraction)]:
+        for stage in ["wcsim", "mdt", "fq"]:
+            open(fgen.path("%s/%s%s%04i.root" % (fgen.outdir, stage, configString, i)), 'w').close()
+
+def run_one(backend, nfiles, args):
+    workspace = tempfile.mkdtemp(prefix="wcte_bench_", dir=args.tmpdir)
+    try:
+        for d in ["template", "validation"]:
+            shutil.copytree(os.path.join(REPO, d), os.path.join(workspace, d))
+        config = make_config(workspace, backend, nfiles, args)
+        stubLog = os.path.join(workspace, "stub.log")
+        os.environ["STUB_LOG"] = stubLog
+        result = {'backend': backend, 'nfiles': nfiles}
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            fgen = runSimulation.FileGenerator(config)
+            start = time.time()
+            fgen.create_directories()
+            fgen.generate_mac_files()
+            fgen.generate_shell_scripts()
+            result['generate'] = time.time() - start
+
+            fake_outputs(fgen, config, args.done)
+            submitter = runSimulation.JobSubmitter(config, fgen)
+            start = time.time()
+            missing = submitter.get_missing_indices(refresh=True)
+            result['scan'] = time.time() - start
+
+            start = time.time()
+            submitter.submit_sukap()
+            submitter.submit_cedar()
+            submitter.submit_condor()
+            result['submit'] = time.time() - start
+
+        snap = fgen.progress.snapshot()
+        result['missing'] = len(missing)
+        result['submitted'] = snap['submitted']
+        result['failed'] = snap['failed']
+        calls = {}
+        if os.path.exists(stubLog):
+            with open(stubLog, 'r') as f:
+                for line in f:
+                    command = line.split()[0] if line.strip() else None
+                    if command:
+                        calls[command] = calls.get(command, 0) + 1
+        result['scheduler_calls'] = calls
+        result['files_per_s'] = dict((phase, nfiles / result[phase] if result[phase] > 0 else None) for phase in ["generate", "scan"])
+        result['files_per_s']['submit'] = len(missing) / result['submit'] if result['submit'] > 0 else None
+        return result
+    finally:
+        if not args.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+        else:
+            print ("Kept workspace %s" % workspace)
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "-C", REPO, "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    # Ratio of the phase times of matching (backend, nfiles) runs, below 1 is faster
+    with open(old, 'r') as f:
+        before = dict(((r['backend'], r['nfiles']), r) for r in json.load(f)['results'])
+    with open(new, 'r') as f:
+        after = json.load(f)['results']
+    print ("%-12s %8s %s" % ("backend", "nfiles", " ".join("%18s" % phase for phase in PHASES)))
+    for r in after:
+        b = before.get((r['backend'], r['nfiles']))
+        if b is None:
+            continue
+        print ("%-12s %8d %s" % (r['backend'], r['nfiles'], " ".join(
+            "%8.2fs %6.2fx  " % (r[phase], r[phase] / b[phase] if b[phase] > 0 else 0.) for phase in PHASES)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark generation, completion scanning and submission against stub schedulers')
+    parser.add_argument('--nfiles', default="100,1000,10000,100000", help='comma separated campaign sizes (default: 100,1000,10000,100000)')
+    parser.add_argument('--backends', default="sukap,cedar,condor", help='comma separated backends out of %s (default: sukap,cedar,condor)' % ",".join(BACKENDS))
+    parser.add_argument('--latency', type=float, default=0., help='seconds of artificial latency per scheduler call')
+    parser.add_argument('--done', type=float, default=0.5, help='fraction of the files that already have outputs (default: 0.5)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='threads used to write mac and shell files')
+    parser.add_argument('--files-per-job', type=int, default=1, help='number of files per batch job')
+    parser.add_argument('--compact', action='store_true', help='generate compact campaigns (one manifest instead of per-file scripts)')
+    parser.add_argument('--max-jobs', type=int, default=0, help='queue limit of the submission throttle (default: 0, no limit)')
+    parser.add_argument('--submit-rate', type=float, default=0., help='submission rate limit of the throttle (default: 0, no limit)')
+    parser.add_argument('--poll-interval', type=float, default=1., help='queue poll interval of the throttle in seconds')
+    parser.add_argument('--tmpdir', help='directory for the temporary workspaces (default: system temp)')
+    parser.add_argument('--keep', action='store_true', help='keep the workspaces')
+    parser.add_argument('-o', '--output', help='result file (default: benchmark_<time>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    backends = args.backends.split(",")
+    for backend in backends:
+        if backend not in BACKENDS:
+            print ("ERROR: unknown backend %s" % backend)
+            sys.exit(1)
+    os.environ["PATH"] = "%s:%s" % (os.path.join(REPO, "stubs"), os.environ.get("PATH", ""))
+    os.environ["STUB_LATENCY"] = str(args.latency) if args.latency > 0 else ""
+
+    results = []
+    print ("%-12s %8s %10s %10s %10s %10s" % ("backend", "nfiles", "generate", "scan", "submit", "calls"))
+    for nfiles in [int(float(n)) for n in args.nfiles.split(",")]:
+        for backend in backends:
+            r = run_one(backend, nfiles, args)
+            results.append(r)
+            print ("%-12s %8d %9.2fs %9.2fs %9.2fs %10d" % (backend, nfiles, r['generate'], r['scan'], r['submit'], sum(r['scheduler_calls'].values())))
+
+    output = args.output or "benchmark_%s.json" % time.strftime("%Y%m%d_%H%M%S")
+    with open(output, 'w') as fo:
+        json.dump({
+            'time': time.time(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'revision': git_revision(),
+            'settings': vars(args),
+            'results': results
+        }, fo, indent=1)
+    print ("Results written to %s" % output)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
 from fastapi import FastAPI, Request, Form, BackgroundTasks, HTTPException
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 import runSimulation
 import os
 import sys
-import io
-from contextlib import redirect_stdout
+import json
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 # Check Environment Variables on startup
 if not os.environ.get("SOFTWARE_SIF_FILE") and not os.environ.get("SOFTWARE_SANDBOX_DIR"):
@@ -23,6 +26,13 @@ if not os.path.exists("templates"):
 
 templates = Jinja2Templates(directory="templates")
 
+# Submissions run on worker threads; campaigns are kept in memory for progress queries
+campaigns = {}
+campaign_pool = ThreadPoolExecutor(max_workers=4)
+
+# Scheduler queries are shared between browser tabs polling /status
+status_cache = runSimulation.StatusCache(ttl=5)
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request, "condor_flavours": runSimulation.CONDOR_FLAVOURS})
@@ -37,16 +47,25 @@ async def submit_simulation(
     energy_high: float = Form(2000),
     nevs: int = Form(1000),
     nfiles: int = Form(100),
-    batch_system: str = Form("none"), # none, sukap, cedar, condor
+    files_per_job: int = Form(1),
+    cpus_per_task: int = Form(1),
+    batch_system: str = Form("none"), # none, sukap, cedar, condor, local
     rap_account: str = Form(""),
     sukap_queue: str = Form("all"),
     condor_queue: str = Form("tomorrow"),
+    local_workers: int = Form(0),
     seed: int = Form(20260129),
     # Boolean flags: Default to False so that if unchecked (sending nothing), they are False.
     # The HTML form will have them checked by default, sending 'true'.
     run_wcsim: bool = Form(False),
     run_mdt: bool = Form(False),
-    run_fq: bool = Form(False)
+    run_fq: bool = Form(False),
+    chained: bool = Form(False),
+    # 0 is no limit
+    budget_core_hours: float = Form(0),
+    budget_storage_gb: float = Form(0),
+    # Only estimate the cost, nothing is written or submitted
+    dry_run: bool = Form(False)
 ):
     # Check Environment Variables manually to avoid sys.exit() in SimulationConfig.validate()
     siffile = os.environ.get("SOFTWARE_SIF_FILE")
@@ -63,12 +82,20 @@ async def submit_simulation(
     config.ParticleName = particle_name
     config.nevs = nevs
     config.nfiles = nfiles
+    config.files_per_job = files_per_job
+    config.cpus_per_job = cpus_per_task
     config.rngseed = seed
+    config.gen_workers = min(8, os.cpu_count() or 1)
+    config.budget_core_hours = budget_core_hours
+    config.budget_storage_gb = budget_storage_gb
+    # A full queue is not waited for on a web worker, the files that do not fit are counted as deferred
+    config.queue_wait = 0
     
     # Set Toggles
     config.runWCSim = run_wcsim
     config.runMDT = run_mdt
     config.runFQ = run_fq
+    config.chained = chained
 
     # Configure Mode
     if mode == "beam":
@@ -89,10 +116,15 @@ async def submit_simulation(
         config.useUniform = False
         config.useCosmics = True
     
+    if files_per_job < 1 or cpus_per_task < 1:
+        raise HTTPException(status_code=400, detail="Configuration Error: files per job and CPUs per job must be at least 1.")
+
     # Configure Batch System
     if batch_system == "sukap":
         if not sandbox:
              raise HTTPException(status_code=400, detail="Configuration Error: SOFTWARE_SANDBOX_DIR is required for Sukap submission.")
+        if cpus_per_task > 1:
+            raise HTTPException(status_code=400, detail="Configuration Error: parallel tasks are only supported on Cedar and Condor.")
         config.submit_sukap_jobs = True
         config.sukap_queue = sukap_queue
     elif batch_system == "cedar":
@@ -103,56 +135,106 @@ async def submit_simulation(
             raise HTTPException(status_code=400, detail=f"Invalid Condor JobFlavour. Must be one of: {', '.join(runSimulation.CONDOR_FLAVOURS)}")
         config.submit_condor_jobs = True
         config.condor_queue = condor_queue
+    elif batch_system == "local":
+        if local_workers < 0:
+            raise HTTPException(status_code=400, detail="Configuration Error: number of local jobs cannot be negative.")
+        config.submit_local_jobs = True
+        config.local_workers = local_workers
         
-    # Generate Files
-    try:
-        fgen = runSimulation.FileGenerator(config)
-        fgen.create_directories()
-        fgen.generate_mac_files()
-        fgen.generate_shell_scripts()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"File Generation Failed: {str(e)}")
-
-    # Submit Jobs
-    submitter = runSimulation.JobSubmitter(config, fgen)
-    
-    # Scan jobs to get counts for the response message
-    n_submit, n_skip = submitter.scan_jobs()
-    msg_suffix = f" (Submitted {n_submit} jobs, Skipped {n_skip} existing)"
-    
-    try:
-        if config.submit_sukap_jobs:
-            submitter.submit_sukap()
-        if config.submit_cedar_jobs:
-            submitter.submit_cedar()
-        if config.submit_condor_jobs:
-            submitter.submit_condor()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-        
+    config_string = config.get_config_string()
+    if dry_run:
+        planner = runSimulation.CampaignPlanner(runSimulation.FileGenerator(config))
+        plan = await run_in_threadpool(planner.summary, [config])
+        return {"status": "plan", "config_string": config_string, "plan": plan}
+
+    # Two campaigns with the same config string would write the same files
+    for campaign in campaigns.values():
+        if campaign["config_string"] == config_string and campaign["progress"].stage in ("pending", "generating", "validating", "submitting"):
+            raise HTTPException(status_code=409, detail=f"A campaign for {config_string} is already running ({campaign['id']}).")
+
+    campaign_id = uuid.uuid4().hex[:12]
+    progress = runSimulation.Progress()
+    campaigns[campaign_id] = {
+        "id": campaign_id,
+        "config_string": config_string,
+        "batch_system": batch_system,
+        "nfiles": nfiles,
+        "progress": progress
+    }
+    campaign_pool.submit(runSimulation.run_campaign, config, progress)
+
     return {
-        "status": "success", 
-        "message": f"Simulation configured for {particle_name}. Job submission to ({batch_system}) completed.{msg_suffix}",
-        "config_string": config.get_config_string()
+        "status": "queued", 
+        "message": f"Simulation configured for {particle_name}. Campaign {campaign_id} queued for ({batch_system}).",
+        "config_string": config_string,
+        "campaign_id": campaign_id
     }
 
+def campaign_summary(campaign):
+    summary = {k: v for k, v in campaign.items() if k != "progress"}
+    summary.update(campaign["progress"].snapshot())
+    return summary
+
+@app.get("/campaigns")
+async def list_campaigns():
+    return [campaign_summary(c) for c in campaigns.values()]
+
+@app.get("/campaigns/{campaign_id}")
+async def get_campaign(campaign_id: str):
+    if campaign_id not in campaigns:
+        raise HTTPException(status_code=404, detail="Unknown campaign.")
+    return campaign_summary(campaigns[campaign_id])
+
+@app.get("/campaigns/{campaign_id}/events")
+async def stream_campaign(campaign_id: str):
+    if campaign_id not in campaigns:
+        raise HTTPException(status_code=404, detail="Unknown campaign.")
+
+    # Server-sent events, one progress snapshot per second until the campaign ends
+    async def events():
+        while True:
+            summary = campaign_summary(campaigns[campaign_id])
+            yield f"data: {json.dumps(summary)}\n\n"
+            if summary["stage"] in ("done", "failed"):
+                break
+            await asyncio.sleep(1)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/status")
 async def get_job_status(batch_system: str = "none"):
-    # Initialize config
+    if batch_system not in runSimulation.JobStatus.backends:
+        return {}
+    jobs = await status_cache.get_jobs(batch_system)
+    return {batch_system: [job._asdict() for job in jobs]}
+
+@app.get("/status/cache")
+async def get_status_cache():
+    return status_cache.stats
+
+@app.get("/files/{config_string}")
+async def get_file_states(config_string: str, nfiles: int = 100):
+    # Answered from the job database and the job state files in log/, without listing out/ or asking the scheduler
     config = runSimulation.SimulationConfig()
-    
-    if batch_system == "sukap":
-        config.submit_sukap_jobs = True
-    elif batch_system == "cedar":
-        config.submit_cedar_jobs = True
-    elif batch_system == "condor":
-        config.submit_condor_jobs = True
-    
-    status_checker = runSimulation.JobStatus(config)
-    return status_checker.get_jobs()
+    fgen = runSimulation.FileGenerator(config)
+
+    def summary():
+        db = runSimulation.JobDatabase(fgen.path(config.db_file))
+        db.fold_states(fgen.path(fgen.logdir), [config_string])
+        return db.summary(config_string, range(nfiles))
+
+    return await run_in_threadpool(summary)
+
+@app.get("/metrics")
+async def get_metrics(config_string: str = None):
+    # Per-stage summary of the job sidecars in log/, for one configuration or all of them
+    config = runSimulation.SimulationConfig()
+    metrics = runSimulation.CampaignMetrics(runSimulation.FileGenerator(config))
+    return await run_in_threadpool(metrics.summary, [config_string] if config_string else None)
 
 @app.post("/kill")
-async def kill_all_jobs(batch_system: str = Form("none")):
+async def kill_all_jobs(batch_system: str = Form("none"), config_string: str = Form(""), indices: str = Form(""), job_ids: str = Form("")):
+    # Without a config string or job IDs every job of the user on the batch system is cancelled
     config = runSimulation.SimulationConfig()
     
     if batch_system == "sukap":
@@ -161,15 +243,26 @@ async def kill_all_jobs(batch_system: str = Form("none")):
         config.submit_cedar_jobs = True
     elif batch_system == "condor":
         config.submit_condor_jobs = True
+    elif batch_system == "local":
+        config.submit_local_jobs = True
     else:
         return {"status": "error", "message": "Invalid batch system selected."}
 
     status_checker = runSimulation.JobStatus(config)
     
-    # Capture the output of the kill_jobs function
-    f = io.StringIO()
-    with redirect_stdout(f):
-        status_checker.kill_jobs()
-    output = f.getvalue()
+    try:
+        selection = {
+            'config_string': config_string.strip() or None,
+            'indices': runSimulation.expand_indices(indices) if indices.strip() else None,
+            'job_ids': [job_id.strip() for job_id in job_ids.split(",") if job_id.strip()] or None
+        }
+    except ValueError:
+        return {"status": "error", "message": "Invalid index list %s." % indices}
+
+    # Collect the messages of kill_jobs for the response, stdout is shared with the campaign threads
+    messages = []
+    counts = await run_in_threadpool(status_checker.kill_jobs, log=messages.append, **selection)
+    output = "\n".join(messages)
+    status_cache.invalidate(batch_system)
     
-    return {"status": "success", "message": output}
\ No newline at end of file
+    return {"status": "success", "message": output, "counts": counts.get(batch_system, {})}
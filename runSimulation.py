@@ -7,6 +7,21 @@ import subprocess
 import string
 import random
 import getpass
+import json
+import collections
+import hashlib
+import re
+import asyncio
+import threading
+import signal
+import copy
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from validation.validate_output import validate_file, validate_files
+
+# Job ID in the output of sbatch, pjsub and condor_submit
+SUBMIT_ID = re.compile(r"(?:Submitted batch job|pjsub Job|submitted to cluster) (\d+)")
 
 CONDOR_FLAVOURS = [
     "espresso",     # 20 minutes
@@ -17,6 +32,119 @@ CONDOR_FLAVOURS = [
     "testmatch",    # 3 days
     "nextweek"      # 1 week
 ]
+CONDOR_HOURS = [1 / 3., 1, 2, 8, 24, 72, 168]
+
+def compress_indices(indices):
+    # Collapse sorted file indices into a slurm style range list, e.g. 0-5,7,9-12
+    ranges = []
+    for i in sorted(indices):
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ",".join("%d" % lo if lo == hi else "%d-%d" % (lo, hi) for lo, hi in ranges)
+
+def expand_indices(text):
+    # Inverse of compress_indices, also accepts START:END (END excluded) as for --range
+    indices = []
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        if ":" in part:
+            lo, hi = part.split(":")
+            indices.extend(range(int(lo), int(hi)))
+        elif "-" in part[1:]:
+            lo, hi = part.split("-")
+            indices.extend(range(int(lo), int(hi) + 1))
+        else:
+            indices.append(int(part))
+    return indices
+
+def derive_seed(rngseed, index, stage):
+    # Counter-based seed: any (index, stage) can be reproduced without walking a stream
+    digest = hashlib.sha256(("%d/%d/%s" % (rngseed, index, stage)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % int(1e9)
+
+def compile_template(path, **constants):
+    # Resolve the constant fields of a string.Template once and leave %(name)s
+    # slots for the per-file fields, so rendering a file is a single % operation
+    with open(path, 'r') as f:
+        text = f.read()
+    pattern = string.Template.pattern
+    pieces = []
+    pos = 0
+    for m in pattern.finditer(text):
+        pieces.append(text[pos:m.start()].replace('%', '%%'))
+        pos = m.end()
+        name = m.group('named') or m.group('braced')
+        if m.group('escaped') is not None:
+            pieces.append('$')
+        elif name in constants:
+            pieces.append(str(constants[name]).replace('%', '%%'))
+        elif name is not None:
+            pieces.append('%%(%s)s' % name)
+        else:
+            raise ValueError("Invalid placeholder in %s at offset %d" % (path, m.start()))
+    pieces.append(text[pos:].replace('%', '%%'))
+    return ''.join(pieces)
+
+def parse_scan_values(text):
+    # "100" or an inclusive range "100:1000:100"
+    vals = [float(v) for v in str(text).strip().split(":")]
+    if len(vals) == 1:
+        return vals
+    step = vals[2] if len(vals) > 2 else 1.
+    if step <= 0 or vals[1] < vals[0]:
+        raise ValueError("invalid range %s" % text)
+    return [vals[0] + k * step for k in range(int(round((vals[1] - vals[0]) / step)) + 1)]
+
+def expand_scan(base, particles=None, beams=None, uniforms=None, cosmics=False):
+    # Every particle with every beam (KE,wallD) and uniform (KELow,KEHigh) point; either value of a pair can be a range
+    modes = []
+    for beam in beams or []:
+        ke, wallD = str(beam).split(",")
+        modes.extend(('beam', a, b) for a in parse_scan_values(ke) for b in parse_scan_values(wallD))
+    for uniform in uniforms or []:
+        low, high = str(uniform).split(",")
+        modes.extend(('uniform', a, b) for a in parse_scan_values(low) for b in parse_scan_values(high))
+    if not modes and not cosmics:
+        modes.append(None)
+
+    configs = []
+    for particle in particles or [base.ParticleName]:
+        for mode in modes:
+            config = copy.copy(base)
+            config.ParticleName = particle
+            if mode is not None and mode[0] == 'beam':
+                config.set_beam(mode[1], mode[2])
+            elif mode is not None:
+                config.set_uniform(mode[1], mode[2])
+            configs.append(config)
+    if cosmics:
+        # The particle is not part of the cosmics config string
+        config = copy.copy(base)
+        config.set_cosmics()
+        configs.append(config)
+    return configs
+
+def load_scan(path):
+    # JSON, or YAML if PyYAML is installed
+    with open(path, 'r') as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        import yaml
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+def check_scan(configs):
+    # Points that share a config string would overwrite each other's files
+    seen = collections.OrderedDict()
+    for config in configs:
+        seen.setdefault(config.get_config_string(), []).append(config)
+    collisions = [(name, points) for name, points in seen.items() if len(points) > 1]
+    for name, points in collisions:
+        print ("ERROR: %d scan points have the same config string %s" % (len(points), name))
+    return len(collisions) == 0
 
 class SimulationConfig:
     def __init__(self):
@@ -40,16 +168,55 @@ class SimulationConfig:
 
         self.nevs = 1000
         self.nfiles = 100
+        self.file_range = None
+        self.legacy_seeds = False
         self.useCDS = True
+        self.gen_workers = 1
+        self.min_output_size = 0
         self.runWCSim = True
         self.runMDT = True
         self.runFQ = True
+        self.chained = False
+        self.compact = False
+        self.scratch = False
+        self.keep_stages = None
+        self.files_per_job = 1
+        self.cpus_per_job = 1
         
         self.submit_sukap_jobs = False
         self.submit_cedar_jobs = False
         self.submit_condor_jobs = False
+        self.submit_local_jobs = False
+        self.local_workers = 0
+        self.local_timeout = 0
+        self.local_mem_per_job = 16000
+        self.walltime_hours = 24
+        self.mem_per_cpu = 16000
+        self.condor_memory = 0
+        self.only_indices = None
+        self.retry_budget = 0
+        self.validate_outputs = False
+        self.db_file = "jobs.db"
+        self.quarantine_dir = None
+        self.max_jobs = None
+        self.submit_rate = 5.
+        self.submit_retries = 5
+        self.submit_backoff = 10
+        self.queue_poll_interval = 10
+        self.queue_wait = -1
+        self.auto_resources = 0
+        self.budget_core_hours = 0
+        self.budget_storage_gb = 0
+        self.merge_size = 0
+        self.merge_fanin = 64
+        self.merge_workers = 0
+        self.merge_batch = False
+        self.merge_remove = False
         self.rapaccount = ""
+        self.cedar_array = False
+        self.cedar_array_limit = 0
         self.sukap_queue = "all"
+        self.sukap_bulk = False
         self.condor_queue = "tomorrow"
 
         self.useBeam = True
@@ -75,6 +242,64 @@ class SimulationConfig:
         if self.submit_sukap_jobs and not self.sandbox:
             print ("ERROR: SOFTWARE_SANDBOX_DIR is needed for sukap submission.")
             sys.exit(1)
+        if self.file_range is not None:
+            if self.file_range[0] < 0 or self.file_range[0] >= self.file_range[1]:
+                print ("ERROR: invalid file range %d:%d." % tuple(self.file_range))
+                sys.exit(1)
+            if self.legacy_seeds and self.file_range[1] > self.nfiles:
+                print ("ERROR: legacy seeds need the file range to be within nfiles.")
+                sys.exit(1)
+        if self.files_per_job < 1 or self.cpus_per_job < 1:
+            print ("ERROR: files per job and cpus per task must be at least 1.")
+            sys.exit(1)
+        if self.compact and self.files_per_job > 1:
+            print ("ERROR: compact campaigns run one file per job.")
+            sys.exit(1)
+        if self.submit_sukap_jobs and self.files_per_job > 1 and self.sukap_bulk:
+            print ("ERROR: pjsub bulk jobs cannot be combined with files per job.")
+            sys.exit(1)
+        if self.keep_stages is not None and not self.get_kept_stages():
+            print ("ERROR: none of the kept stages %s is run." % ",".join(self.keep_stages))
+            sys.exit(1)
+        if self.submit_sukap_jobs and self.cpus_per_job > 1:
+            print ("ERROR: parallel tasks are only supported on cedar and condor.")
+            sys.exit(1)
+
+    def set_beam(self, ke, wallD):
+        self.useBeam = True
+        self.useUniform = False
+        self.useCosmics = False
+        self.ParticleKE = ke
+        self.wallD = wallD
+        self.ParticlePosz = -(self.TankRadius - self.wallD)
+
+    def set_uniform(self, keLow, keHigh):
+        self.useBeam = False
+        self.useUniform = True
+        self.useCosmics = False
+        self.ParticleKELow = keLow
+        self.ParticleKEHigh = keHigh
+
+    def set_cosmics(self):
+        self.useBeam = False
+        self.useUniform = False
+        self.useCosmics = True
+
+    def get_run_stages(self):
+        return [stage for stage, run in [("wcsim", self.runWCSim), ("mdt", self.runMDT), ("fq", self.runFQ)] if run]
+
+    def get_kept_stages(self):
+        # Stages whose outputs stay in out/, the others are intermediates of the job
+        if self.keep_stages is None:
+            return self.get_run_stages()
+        return [stage for stage in self.get_run_stages() if stage in self.keep_stages]
+
+    def get_indices(self):
+        if self.only_indices is not None:
+            return sorted(self.only_indices)
+        if self.file_range is not None:
+            return range(self.file_range[0], self.file_range[1])
+        return range(self.nfiles)
 
     def get_config_string(self):
         wCDSstring = "_wCDS" if self.useCDS else ""
@@ -91,9 +316,39 @@ class SimulationConfig:
         
         return configString
 
+class Progress:
+    # Thread-safe counters that a caller can poll while generation and submission run
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'generated': 0, 'submitted': 0, 'skipped': 0, 'failed': 0, 'deferred': 0, 'validated': 0, 'invalid': 0}
+        self.stage = "pending"
+        self.error = ""
+        self.start = time.time()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def set_stage(self, stage, error=""):
+        with self.lock:
+            self.stage = stage
+            self.error = error
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            snap = dict(self.counts)
+            snap['stage'] = self.stage
+            snap['error'] = self.error
+            snap['elapsed'] = elapsed
+            snap['rate'] = (self.counts['generated'] + self.counts['submitted']) / elapsed if elapsed > 0 else 0.
+        return snap
+
 class FileGenerator:
-    def __init__(self, config):
+    def __init__(self, config, progress=None):
         self.cfg = config
+        self.progress = progress if progress is not None else Progress()
+        self.db = None
         self.macdir = "mac"
         self.outdir = "out"
         self.logdir = "log"
@@ -109,6 +364,18 @@ class FileGenerator:
         self.condorout = "condor_out"
         self.condorerr = "condor_err"
         self.condorlog = "condor_log"
+        self.localdir = "local_dir"
+
+    def get_db(self):
+        # The states reported by the jobs of this configuration are folded in once
+        if self.db is None:
+            self.db = JobDatabase(self.path(self.cfg.db_file))
+            self.db.fold_states(self.path(self.logdir), [self.cfg.get_config_string()], self.cfg.gen_workers)
+        return self.db
+
+    def path(self, name):
+        # Everything is relative to the configured curdir rather than the process working directory
+        return os.path.join(self.cfg.curdir, name)
 
     def create_directories(self):
         dirs = [self.macdir, self.outdir, self.logdir, self.shelldir, self.figdir]
@@ -118,61 +385,84 @@ class FileGenerator:
             dirs.extend([self.sldir, self.sloutdir, self.slerrdir])
         if self.cfg.submit_condor_jobs:
             dirs.extend([self.condordir, self.condorout, self.condorerr, self.condorlog])
+        if self.cfg.submit_local_jobs:
+            dirs.append(self.localdir)
 
         for d in dirs:
-            if not os.path.exists(d):
-                os.makedirs(d)
+            if not os.path.exists(self.path(d)):
+                os.makedirs(self.path(d))
 
-    def generate_mac_files(self):
-        print ("Creating mac files for WCSim")
+    def file_names(self):
+        # Paths of a file index inside the container, formatted with {'index': i}
         configString = self.cfg.get_config_string()
-        
+        names = {
+            'macfile': "%s/%s/wcsim%s%%(index)04i.mac" % (self.cfg.mntdir, self.macdir, configString),
+            'tuningfile': "%s/%s/tuning_parameters%s%%(index)04i.mac" % (self.cfg.mntdir, self.macdir, configString),
+            'logfile': "%s/%s/run%s%%(index)04i.log" % (self.cfg.mntdir, self.logdir, configString),
+            'wcsimfile': "%s/%s/wcsim%s%%(index)04i.root" % (self.cfg.mntdir, self.outdir, configString),
+            'mdtfile': "%s/%s/mdt%s%%(index)04i.root" % (self.cfg.mntdir, self.outdir, configString),
+            'fqfile': "%s/%s/fq%s%%(index)04i.root" % (self.cfg.mntdir, self.outdir, configString)
+        }
+        if self.cfg.compact:
+            # The tuning parameters are the same for every file
+            names['tuningfile'] = "%s/%s/tuning_parameters%s.mac" % (self.cfg.mntdir, self.macdir, configString)
+        return names
+
+    def mac_format(self):
         wCDSmac = "" if self.cfg.useCDS else "#"
         beammac = "" if self.cfg.useBeam else "#"
         uniformmac = "" if self.cfg.useUniform else "#"
         comsicsmac = "" if self.cfg.useCosmics else "#"
 
-        with open("template/WCTE.mac", 'r') as f:
-            macTemplate = string.Template(f.read())
-        with open("template/tuning_parameters.mac", 'r') as f:
-            tuningTemplate = string.Template(f.read())
+        return compile_template(self.path("template/WCTE.mac"), 
+            wcsimdir=self.cfg.wcsimdir, 
+            wCDSmac=wCDSmac, 
+            beammac=beammac,
+            uniformmac=uniformmac,
+            comsicsmac=comsicsmac,
+            ParticleName=self.cfg.ParticleName,
+            ParticleKE=self.cfg.ParticleKE,
+            ParticleDirx=self.cfg.ParticleDirx,
+            ParticleDiry=self.cfg.ParticleDiry,
+            ParticleDirz=self.cfg.ParticleDirz,
+            ParticlePosx=self.cfg.ParticlePosx,
+            ParticlePosy=self.cfg.ParticlePosy,
+            ParticlePosz=self.cfg.ParticlePosz,
+            ParticleKELow=self.cfg.ParticleKELow,
+            ParticleKEHigh=self.cfg.ParticleKEHigh, 
+            rmac=self.cfg.TankRadius, 
+            zmac=self.cfg.TankHalfz,
+            nevs=self.cfg.nevs
+        )
 
-        random.seed(self.cfg.rngseed)
+    def generate_mac_files(self):
+        print ("Creating mac files for WCSim")
+        configString = self.cfg.get_config_string()
+        tuning = compile_template(self.path("template/tuning_parameters.mac"), wcsimdir=self.cfg.wcsimdir) % {}
+        names = self.file_names()
+        host = lambda name: self.path(name[len(self.cfg.mntdir) + 1:])
 
-        for i in range(self.cfg.nfiles):
-            macFile = "%s/wcsim%s%04i.mac" % (self.macdir, configString, i)
-            macseed = random.randrange(int(1e9))
-            
-            with open(macFile, 'w') as fo:
-                fo.write(macTemplate.substitute(
-                    wcsimdir=self.cfg.wcsimdir, 
-                    rngseed=macseed, 
-                    wCDSmac=wCDSmac, 
-                    beammac=beammac,
-                    uniformmac=uniformmac,
-                    comsicsmac=comsicsmac,
-                    ParticleName=self.cfg.ParticleName,
-                    ParticleKE=self.cfg.ParticleKE,
-                    ParticleDirx=self.cfg.ParticleDirx,
-                    ParticleDiry=self.cfg.ParticleDiry,
-                    ParticleDirz=self.cfg.ParticleDirz,
-                    ParticlePosx=self.cfg.ParticlePosx,
-                    ParticlePosy=self.cfg.ParticlePosy,
-                    ParticlePosz=self.cfg.ParticlePosz,
-                    ParticleKELow=self.cfg.ParticleKELow,
-                    ParticleKEHigh=self.cfg.ParticleKEHigh, 
-                    rmac=self.cfg.TankRadius, 
-                    zmac=self.cfg.TankHalfz,
-                    nevs=self.cfg.nevs,
-                    filename="%s/%s/wcsim%s%04i.root" % (self.cfg.mntdir, self.outdir, configString, i)
-                ))
+        if self.cfg.compact:
+            # The macros are rendered by the jobs from the campaign manifest
+            with open(host(names['tuningfile']), 'w') as fo:
+                fo.write(tuning)
+            return
 
-            tuningFile = "%s/tuning_parameters%s%04i.mac" % (self.macdir, configString, i)
-            with open(tuningFile, 'w') as fo:
-                fo.write(tuningTemplate.substitute(wcsimdir=self.cfg.wcsimdir))
+        macFormat = self.mac_format()
+        macseeds = self.get_seeds("wcsim")
 
-    def generate_shell_scripts(self):
-        print ("Creating shell scripts for simulation")
+        def write(i):
+            with open(host(names['macfile'] % {'index': i}), 'w') as fo:
+                fo.write(macFormat % {
+                    'rngseed': macseeds[i],
+                    'filename': names['wcsimfile'] % {'index': i}
+                })
+            with open(host(names['tuningfile'] % {'index': i}), 'w') as fo:
+                fo.write(tuning)
+
+        self.write_batch(write, 2)
+
+    def shell_format(self):
         configString = self.cfg.get_config_string()
         
         cern_condor = "" if self.cfg.submit_condor_jobs else "#"
@@ -183,126 +473,1165 @@ class FileGenerator:
         runmdt = "" if self.cfg.runMDT else "#"
         runfq = "" if self.cfg.runFQ else "#"
 
-        with open("template/run.sh", 'r') as f:
-            shTemplate = string.Template(f.read())
+        # With scratch staging the kept outputs are copied back, otherwise the others are removed at the end of the job.
+        # Intermediates are dropped only if the job succeeded, a failed job keeps (or copies back) them for a retry
+        kept = self.cfg.get_kept_stages()
+        run = self.cfg.get_run_stages()
+        keep = dict(("keep%s" % stage, "" if self.cfg.scratch and stage in kept else "#") for stage in ["wcsim", "mdt", "fq"])
+        drop = dict(("drop%s" % stage, "" if stage in run and stage not in kept else "#") for stage in ["wcsim", "mdt", "fq"])
 
-        for i in range(self.cfg.nfiles):
-            shFile = "%s/run%s%04i.sh" % (self.shelldir, configString, i)
-            wcsimfile = "%s/%s/wcsim%s%04i.root" % (self.cfg.mntdir, self.outdir, configString, i)
-            mdtfile = "%s/%s/mdt%s%04i.root" % (self.cfg.mntdir, self.outdir, configString, i)
-            fqfile = "%s/%s/fq%s%04i.root" % (self.cfg.mntdir, self.outdir, configString, i)
-            
-            with open(shFile, 'w') as fo:
-                fo.write(shTemplate.substitute(
-                    curdir=self.cfg.curdir,
-                    cern_condor=cern_condor, 
-                    userns=userns,
-                    mntdir=self.cfg.mntdir,
-                    siffile=siffile,
-                    runwcsim=runwcsim,
-                    runmdt=runmdt,
-                    runfq=runfq,
-                    macfile="%s/%s/wcsim%s%04i.mac" % (self.cfg.mntdir, self.macdir, configString, i),
-                    tuningfile="%s/%s/tuning_parameters%s%04i.mac" % (self.cfg.mntdir, self.macdir, configString, i),
-                    logfile="%s/%s/run%s%04i.log" % (self.cfg.mntdir, self.logdir, configString, i),
-                    wcsimfile=wcsimfile, 
-                    nevs=self.cfg.nevs,
-                    mdtfile=mdtfile,
-                    fqfile=fqfile,
-                    rngseed=random.randrange(int(1e9))
-                ))
+        # Chained mode starts the container once for all stages
+        shTemplate = "template/run_chained.sh" if self.cfg.chained else "template/run.sh"
+        # The validator runs on the host in run.sh and inside the container in chained mode
+        quarantine = ""
+        if self.cfg.quarantine_dir:
+            quarantine = "-q %s/%s" % (self.cfg.mntdir if self.cfg.chained else self.cfg.curdir, self.cfg.quarantine_dir)
+        return compile_template(self.path(shTemplate),
+            curdir=self.cfg.curdir,
+            quarantine=quarantine,
+            config=configString,
+            cern_condor=cern_condor, 
+            userns=userns,
+            mntdir=self.cfg.mntdir,
+            siffile=siffile,
+            runwcsim=runwcsim,
+            runmdt=runmdt,
+            runfq=runfq,
+            scratch="" if self.cfg.scratch else "#",
+            nevs=self.cfg.nevs,
+            **dict(keep, **drop)
+        )
+
+    def generate_shell_scripts(self):
+        print ("Creating shell scripts for simulation")
+        configString = self.cfg.get_config_string()
+        shFormat = self.shell_format()
+        names = self.file_names()
+
+        if self.cfg.compact:
+            self.write_manifest(shFormat)
+        else:
+            shseeds = self.get_seeds("mdt")
+
+            def write(i):
+                with open(self.path("%s/run%s%04i.sh" % (self.shelldir, configString, i)), 'w') as fo:
+                    values = dict((key, name % {'index': i}) for key, name in names.items())
+                    values.update(rngseed=shseeds[i], index=i)
+                    fo.write(shFormat % values)
+
+            self.write_batch(write, 1)
+        self.get_db().mark(configString, self.cfg.get_indices(), 'generated', only_new=True)
+
+    def manifest_file(self):
+        return "%s/campaign%s.json" % (self.shelldir, self.cfg.get_config_string())
+
+    def write_manifest(self, shFormat):
+        # Compact mode: one manifest with the macro and run script formats, the file names and the seeds of every index,
+        # and one generic job script that renders its files from it (see render_job)
+        configString = self.cfg.get_config_string()
+        start = time.time()
+        indices = self.cfg.get_indices()
+        macseeds = self.get_seeds("wcsim")
+        shseeds = self.get_seeds("mdt")
+        seeds = {
+            'wcsim': dict((str(i), macseeds[i]) for i in indices),
+            'mdt': dict((str(i), shseeds[i]) for i in indices)
+        }
+        manifestFile = self.path(self.manifest_file())
+        if os.path.exists(manifestFile):
+            # Jobs of an earlier range may still be queued, so their indices stay in the manifest with the same seeds
+            with open(manifestFile, 'r') as f:
+                previous = json.load(f)['seeds']
+            for stage in seeds:
+                for i, seed in previous.get(stage, {}).items():
+                    if seeds[stage].setdefault(i, seed) != seed:
+                        raise ValueError("file %s already has a different %s seed in %s, use the same --seed as before" % (i, stage, manifestFile))
+        manifest = {
+            'config': configString,
+            'curdir': self.cfg.curdir,
+            'mntdir': self.cfg.mntdir,
+            'nevs': self.cfg.nevs,
+            'indices': compress_indices(int(i) for i in seeds['wcsim']),
+            'names': self.file_names(),
+            'macro': self.mac_format(),
+            'script': shFormat,
+            'seeds': seeds
+        }
+        with open(manifestFile + ".tmp", 'w') as fo:
+            json.dump(manifest, fo)
+        os.replace(manifestFile + ".tmp", manifestFile)
+
+        jobFormat = compile_template(self.path("template/job.sh"), curdir=self.cfg.curdir, macdir=self.macdir, config=configString)
+        with open(self.path("%s/job%s.sh" % (self.shelldir, configString)), 'w') as fo:
+            fo.write(jobFormat % {'manifest': manifestFile})
+        self.progress.add('generated', len(indices))
+        print ("Wrote the manifest of %d files in %.2f s" % (len(indices), time.time() - start))
+
+    def get_seeds(self, stage):
+        if self.cfg.legacy_seeds:
+            # Old productions drew all the mac seeds and then all the shell seeds from one stream
+            rng = random.Random(self.cfg.rngseed)
+            macseeds = [rng.randrange(int(1e9)) for i in range(self.cfg.nfiles)]
+            shseeds = [rng.randrange(int(1e9)) for i in range(self.cfg.nfiles)]
+            seeds = macseeds if stage == "wcsim" else shseeds
+            return dict((i, seeds[i]) for i in self.cfg.get_indices())
+        return dict((i, derive_seed(self.cfg.rngseed, i, stage)) for i in self.cfg.get_indices())
+
+    def write_batch(self, write, files_per_index):
+        # Seeds are drawn up front, so the writes can go out in any order
+        start = time.time()
+        indices = self.cfg.get_indices()
+        chunks = [indices[k:k + 256] for k in range(0, len(indices), 256)]
+
+        def write_chunk(chunk):
+            for i in chunk:
+                write(i)
+            self.progress.add('generated', files_per_index * len(chunk))
+
+        if self.cfg.gen_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.cfg.gen_workers) as pool:
+                for _ in pool.map(write_chunk, chunks):
+                    pass
+        else:
+            for chunk in chunks:
+                write_chunk(chunk)
+        elapsed = time.time() - start
+        nwritten = files_per_index * len(indices)
+        print ("Wrote %d files in %.2f s (%.0f files/s)" % (nwritten, elapsed, nwritten / elapsed if elapsed > 0 else 0))
+
+def render_job(manifestFile, index, output):
+    # Writes the macro of one file of a compact campaign to mac/ and its run script to output
+    with open(manifestFile, 'r') as f:
+        manifest = json.load(f)
+    if str(index) not in manifest['seeds']['wcsim']:
+        print ("ERROR: file %d is not part of %s" % (index, manifestFile))
+        return False
+    values = dict((key, name % {'index': index}) for key, name in manifest['names'].items())
+    host = lambda name: os.path.join(manifest['curdir'], name[len(manifest['mntdir']) + 1:])
+    with open(host(values['macfile']), 'w') as fo:
+        fo.write(manifest['macro'] % {'rngseed': manifest['seeds']['wcsim'][str(index)], 'filename': values['wcsimfile']})
+    values.update(rngseed=manifest['seeds']['mdt'][str(index)], index=index)
+    with open(output, 'w') as fo:
+        fo.write(manifest['script'] % values)
+    return True
+
+def read_merge_manifests(mergedir, pending=False):
+    # Manifests of the merged files (or of the merges still running) in out/merged/
+    manifests = []
+    if not os.path.isdir(mergedir):
+        return manifests
+    for name in sorted(os.listdir(mergedir)):
+        if not name.endswith(".json") or name.endswith(".pending.json") != pending:
+            continue
+        try:
+            with open(os.path.join(mergedir, name), 'r') as f:
+                manifests.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return manifests
+
+class CompletionIndex:
+    # Output names are <stage><configString><index>.root and every config string ends with "_"
+    pattern = re.compile(r"^(wcsim|mdt|fq)(.*_)(\d+)\.root$")
+
+    def __init__(self, outdir, min_size=0, newer_than=None):
+        self.outdir = outdir
+        self.min_size = min_size
+        self.newer_than = newer_than
+        self.files = {}
+        self.merged = {}
+        self.scan()
+
+    def scan(self):
+        # One directory listing instead of a stat per expected file
+        self.files = {}
+        # Indices already merged into out/merged/ are done, even if their own files were removed
+        self.merged = {}
+        for manifest in read_merge_manifests(os.path.join(self.outdir, "merged")):
+            self.merged.setdefault((manifest['stage'], manifest['config']), set()).update(expand_indices(manifest['indices']))
+        if not os.path.isdir(self.outdir):
+            return
+        with os.scandir(self.outdir) as it:
+            for entry in it:
+                m = self.pattern.match(entry.name)
+                if not m:
+                    continue
+                if self.min_size > 0 or self.newer_than is not None:
+                    st = entry.stat()
+                    if st.st_size < self.min_size:
+                        continue
+                    if self.newer_than is not None and st.st_mtime < self.newer_than:
+                        continue
+                self.files.setdefault((m.group(1), m.group(2)), set()).add(int(m.group(3)))
+
+    def completed(self, configString, stages):
+        done = None
+        for stage in stages:
+            found = self.files.get((stage, configString), set()) | self.merged.get((stage, configString), set())
+            done = set(found) if done is None else done & found
+        return done if done is not None else set()
+
+    def missing(self, configString, stages, indices):
+        if not stages:
+            return []
+        done = self.completed(configString, stages)
+        return [i for i in indices if i not in done]
+
+class JobDatabase:
+    # Per-file job state keyed by (config string, index), shared by the submitter, the status poller and the job scripts
+    states = ['generated', 'submitted', 'running', 'finished', 'validated', 'failed']
+    done_states = ('submitted', 'running', 'finished', 'validated')
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS files (config TEXT, idx INTEGER, state TEXT, backend TEXT, job_id TEXT, "
+                        "submitted REAL, updated REAL, attempts INTEGER DEFAULT 0, message TEXT, PRIMARY KEY (config, idx))")
+
+    def connect(self):
+        # A connection per call keeps it usable from the generation and submission threads
+        return sqlite3.connect(self.path, timeout=60)
+
+    def mark(self, config, indices, state, backend=None, job_ids=None, message=None, only_new=False):
+        # job_ids is one ID for all indices or a dict index -> ID
+        now = time.time()
+        with self.connect() as con:
+            con.executemany("INSERT OR IGNORE INTO files (config, idx, state, updated) VALUES (?, ?, ?, ?)", [(config, i, state, now) for i in indices])
+            if only_new:
+                return
+            if state == 'submitted':
+                con.executemany("UPDATE files SET state = 'submitted', backend = ?, job_id = ?, submitted = ?, updated = ?, "
+                                "attempts = attempts + 1, message = NULL WHERE config = ? AND idx = ?",
+                                [(backend, job_ids.get(i) if isinstance(job_ids, dict) else job_ids, now, now, config, i) for i in indices])
+            else:
+                con.executemany("UPDATE files SET state = ?, updated = ?, message = ? WHERE config = ? AND idx = ?",
+                                [(state, now, message, config, i) for i in indices])
+
+    def mark_running(self, jobs):
+        # Scheduler records only move submitted files to running, the job scripts report the rest
+        rows = [(time.time(), job.config, job.index) for job in jobs if job.state == "RUNNING" and job.config and job.index is not None]
+        if not rows: return
+        with self.connect() as con:
+            con.executemany("UPDATE files SET state = 'running', updated = ? WHERE config = ? AND idx = ? AND state = 'submitted'", rows)
+
+    def apply_states(self, states):
+        # {config: {index: (state, time)}} reported by the jobs. A report older than the submission (an earlier attempt)
+        # is ignored, and one older than the last update only replaces a submitted or running state
+        rows = [(state, t, config, i, t, t) for config, files in states.items() for i, (state, t) in files.items() if state in self.states]
+        if not rows: return
+        with self.connect() as con:
+            con.executemany("UPDATE files SET state = ?, updated = ? WHERE config = ? AND idx = ? AND (submitted IS NULL OR submitted <= ?) "
+                            "AND (updated < ? OR state IN ('submitted', 'running'))", rows)
+
+    def fold_states(self, logdir, configStrings=None, workers=1):
+        self.apply_states(read_job_states(logdir, configStrings, workers))
+
+    def get_states(self, config):
+        with self.connect() as con:
+            return dict(con.execute("SELECT idx, state FROM files WHERE config = ?", (config,)))
+
+    def get_files(self, config):
+        with self.connect() as con:
+            con.row_factory = sqlite3.Row
+            return dict((row['idx'], dict(row)) for row in con.execute("SELECT * FROM files WHERE config = ?", (config,)))
+
+    def get_file(self, config, index):
+        with self.connect() as con:
+            con.row_factory = sqlite3.Row
+            row = con.execute("SELECT * FROM files WHERE config = ? AND idx = ?", (config, index)).fetchone()
+        return dict(row) if row else None
+
+    def summary(self, config, indices):
+        # Counts per state plus the indices that still need a job
+        states = self.get_states(config)
+        counts = collections.Counter(states.get(i, 'missing') for i in indices)
+        missing = [i for i in indices if states.get(i) not in self.done_states]
+        failed = [i for i in indices if states.get(i) == 'failed']
+        return {'config': config, 'counts': dict(counts), 'missing': compress_indices(missing), 'failed': compress_indices(failed)}
+
+class FailureClassifier:
+    # Categories are checked in this order across all the logs of a file, so the scheduler's own verdicts
+    # come before the symptoms they cause wherever they were logged
+    patterns = [
+        ('walltime', re.compile(r"DUE TO TIME LIMIT|elapse.*(?:limit|exceed)|exceeded .*(?:MaxRuntime|runtime|JobFlavour)|Local job killed after", re.I)),
+        ('oom', re.compile(r"oom[-_ ]kill|out of memory|memory limit|std::bad_alloc|Cannot allocate memory|MemoryUsage", re.I)),
+        ('bind', re.compile(r"container creation failed|while mounting|mount .* failed|FATAL:.*(?:bind|image)|no such file or directory.*\.sif", re.I)),
+        # Only fatal G4Exceptions, JustWarning blocks are routine in WCSim logs
+        ('geant4', re.compile(r"\*\*\* Fatal (?:Exception|Error In Argument) \*\*\*|FatalException|FatalErrorInArgument|\*\*\* Break \*\*\*|segmentation violation", re.I)),
+        ('truncated', re.compile(r"truncated file|file was not closed|entries, expected|kRecovered|probably not closed", re.I)),
+    ]
+    # A Geant4 exception comes back with the same seed, everything else may pass on a retry
+    retryable = {'walltime': True, 'oom': True, 'bind': True, 'geant4': False, 'truncated': True, 'unknown': True}
+    tail_bytes = 256 * 1024
 
-class JobSubmitter:
     def __init__(self, config, file_generator):
         self.cfg = config
         self.fgen = file_generator
+        self.slurm_logs = None
 
-    def is_job_missing(self, i):
+    def get_slurm_log(self, name):
+        # Slurm appends the job ID to the log name, so list slerr/ once and keep the latest job per name
+        if self.slurm_logs is None:
+            logs = {}
+            slerr = self.fgen.path(self.fgen.slerrdir)
+            if os.path.isdir(slerr):
+                for entry in os.listdir(slerr):
+                    parts = entry.rsplit(".", 2)
+                    if len(parts) == 3 and parts[1].isdigit() and int(parts[1]) >= logs.get(parts[0], (-1, None))[0]:
+                        logs[parts[0]] = (int(parts[1]), os.path.join(slerr, entry))
+            self.slurm_logs = dict((k, v[1]) for k, v in logs.items())
+        return self.slurm_logs.get(name)
+
+    def log_files(self, i):
+        # The run log is per file, the batch logs are named after the first index of the job
         configString = self.cfg.get_config_string()
-        if self.cfg.runWCSim and not os.path.exists("%s/wcsim%s%04i.root" % (self.fgen.outdir, configString, i)):
-            return True
-        if self.cfg.runMDT and not os.path.exists("%s/mdt%s%04i.root" % (self.fgen.outdir, configString, i)):
-            return True
-        if self.cfg.runFQ and not os.path.exists("%s/fq%s%04i.root" % (self.fgen.outdir, configString, i)):
+        files = [self.fgen.path("%s/run%s%04i.log" % (self.fgen.logdir, configString, i))]
+        for j in range(i, max(-1, i - self.cfg.files_per_job), -1):
+            files.append(self.fgen.path("%s/local%s%04i.err" % (self.fgen.logdir, configString, j)))
+            files.append(self.get_slurm_log("slurm%s%04i" % (configString, j)))
+            files.append(self.fgen.path("%s/pjsub%s%04i.err" % (self.fgen.pjerrdir, configString, j)))
+            files.append(self.fgen.path("%s/condor%s%04i.err" % (self.fgen.condorerr, configString, j)))
+            files.append(self.fgen.path("%s/condor%s%04i.log" % (self.fgen.condorlog, configString, j)))
+        return files
+
+    def read_tail(self, path):
+        # WCSim logs can be large, the reason for a failure is at the end
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - self.tail_bytes))
+            return f.read().decode('utf-8', 'replace')
+
+    def classify(self, i):
+        logs = [(path, self.read_tail(path)) for path in self.log_files(i) if path is not None and os.path.exists(path)]
+        for category, pattern in self.patterns:
+            for path, text in logs:
+                match = pattern.search(text)
+                if match:
+                    end = text.find("\n", match.end())
+                    line = text[text.rfind("\n", 0, match.start()) + 1:end if end >= 0 else len(text)]
+                    return category, "%s: %s" % (os.path.basename(path), line.strip()[:200])
+        return 'unknown', ""
+
+    def classify_all(self, indices):
+        self.get_slurm_log("")
+        with ThreadPoolExecutor(max_workers=max(1, self.cfg.gen_workers)) as pool:
+            return dict(zip(indices, pool.map(self.classify, indices)))
+
+def percentile(values, q):
+    # Nearest rank of an already sorted list
+    return values[int(round(q / 100. * (len(values) - 1)))] if values else None
+
+# Sidecars are named after the run log: log/run<config><index>.json
+SIDECAR_PATTERN = re.compile(r"^run(.*_)(\d+)\.json$")
+
+def read_sidecars(logdir, configStrings=None, workers=1):
+    # {config string: {index: stages}} from the log/run<config><index>.json files written by measure_stage.py
+    sidecars = []
+    if os.path.isdir(logdir):
+        with os.scandir(logdir) as it:
+            for entry in it:
+                m = SIDECAR_PATTERN.match(entry.name)
+                if m and (configStrings is None or m.group(1) in configStrings):
+                    sidecars.append((m.group(1), int(m.group(2)), entry.path))
+
+    def load(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f).get('stages', {})
+        except (OSError, ValueError):
+            return {}
+
+    result = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for (configString, i, path), stages in zip(sidecars, pool.map(lambda sidecar: load(sidecar[2]), sidecars)):
+            if stages:
+                result.setdefault(configString, {})[i] = stages
+    return result
+
+# The job scripts report the file state next to the run log: log/run<config><index>.state holds "STATE TIME".
+# Jobs never open the SQLite database, whose locking is unreliable on shared filesystems.
+STATE_PATTERN = re.compile(r"^run(.*_)(\d+)\.state$")
+
+def read_job_states(logdir, configStrings=None, workers=1):
+    # {config string: {index: (state, time)}} from the state files written by the job scripts
+    files = []
+    if os.path.isdir(logdir):
+        with os.scandir(logdir) as it:
+            for entry in it:
+                m = STATE_PATTERN.match(entry.name)
+                if m and (configStrings is None or m.group(1) in configStrings):
+                    files.append((m.group(1), int(m.group(2)), entry.path))
+
+    def load(path):
+        try:
+            with open(path, 'r') as f:
+                state, t = f.read().split()
+            return state, float(t)
+        except (OSError, ValueError):
+            return None
+
+    result = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for (configString, i, path), state in zip(files, pool.map(lambda f: load(f[2]), files)):
+            if state:
+                result.setdefault(configString, {})[i] = state
+    return result
+
+class ResourceModel:
+    # Seconds per event and peak memory learned from the sidecars that measure_stage.py writes next to the run logs.
+    # Only successful stages whose output exists are used, keyed by (particle, mode, energy, CDS) so the wall distance does not matter.
+    key_pattern = re.compile(r"^(_wCDS)?_(?:Comsics_|([^_]+)_(?:Beam_(\d+)MeV_-?\d+cm_|Uniform_(\d+)_(\d+)MeV_))$")
+    # Requested over expected walltime and memory
+    margin = 1.5
+    mem_margin = 1.25
+
+    def __init__(self, file_generator):
+        self.fgen = file_generator
+        self.cfg = file_generator.cfg
+        self.sidecars = None
+        self.samples = None
+
+    @classmethod
+    def key(cls, configString):
+        m = cls.key_pattern.match(configString)
+        if not m:
+            return None
+        cds = m.group(1) is not None
+        if m.group(2) is None:
+            return ("cosmics", "cosmics", 0., cds)
+        if m.group(3) is not None:
+            return (m.group(2), "beam", float(m.group(3)), cds)
+        # Uniform energies are compared by their mean
+        return (m.group(2), "uniform", (float(m.group(4)) + float(m.group(5))) / 2, cds)
+
+    def get_sidecars(self):
+        if self.sidecars is None:
+            self.sidecars = read_sidecars(self.fgen.path(self.fgen.logdir), workers=self.cfg.gen_workers)
+        return self.sidecars
+
+    def learn(self):
+        # samples[key][stage] is a list of (seconds per event, peak kB)
+        if self.samples is not None:
+            return self.samples
+        self.samples = {}
+        completion = CompletionIndex(self.fgen.path(self.fgen.outdir), self.cfg.min_output_size)
+        for configString, files in self.get_sidecars().items():
+            key = self.key(configString)
+            if key is None:
+                continue
+            # Intermediate outputs may have been dropped by the job, so the last stage with an output stands for the file
+            last = {}
+            for stage in ["wcsim", "mdt", "fq"]:
+                for i in completion.completed(configString, [stage]):
+                    last[i] = stage
+            order = ["wcsim", "mdt", "fq", "chain"]
+            for i, stages in files.items():
+                if i not in last:
+                    continue
+                for stage, entry in stages.items():
+                    if entry.get('exit_code') != 0 or not entry.get('events'):
+                        continue
+                    if stage != "chain" and order.index(stage) > order.index(last[i]):
+                        continue
+                    self.samples.setdefault(key, {}).setdefault(stage, []).append((entry['wall'] / entry['events'], entry['max_rss_kb']))
+        return self.samples
+
+    def estimate(self, config):
+        # (seconds per event, peak kB, source) for a configuration, None without any usable logs
+        samples = self.learn()
+        key = self.key(config.get_config_string())
+        if key is None:
+            return None
+        stages = [stage for stage, run in [("wcsim", config.runWCSim), ("mdt", config.runMDT), ("fq", config.runFQ)] if run]
+        stageSets = [["chain"], stages] if config.chained else [stages, ["chain"]]
+        # The same particle, mode and CDS at the nearest energy, scaled with the energy, if this one was never run
+        candidates = sorted((abs(k[2] - key[2]), k) for k in samples if k[:2] == key[:2] and k[3] == key[3])
+        for distance, k in candidates:
+            for stageSet in stageSets:
+                if not stageSet or not all(stage in samples[k] for stage in stageSet):
+                    continue
+                spe = 0.
+                peak = 0
+                n = 0
+                for stage in stageSet:
+                    # 90th percentile of the time, largest memory
+                    values = sorted(sample[0] for sample in samples[k][stage])
+                    spe += percentile(values, 90)
+                    peak = max(peak, max(sample[1] for sample in samples[k][stage]))
+                    n = max(n, len(values))
+                source = "%d jobs" % n
+                if k != key:
+                    if k[2] > 0 and key[2] > 0:
+                        spe *= key[2] / k[2]
+                    source += ", scaled from %.0f MeV" % k[2]
+                return spe, peak, source
+        return None
+
+    def plan(self, config, target_hours):
+        estimate = self.estimate(config)
+        if estimate is None:
+            return None
+        spe, peak, source = estimate
+        # Files of a job run cpus_per_job at a time
+        rounds = -(-max(1, config.files_per_job) // config.cpus_per_job)
+        expected = spe * config.nevs * rounds
+        hours = expected * self.margin / 3600
+        flavour = [f for f, h in zip(CONDOR_FLAVOURS, CONDOR_HOURS) if h >= hours]
+        plan = {
+            'config': config.get_config_string(),
+            'source': source,
+            'seconds_per_event': spe,
+            'peak_mb': peak / 1024.,
+            'job_hours': expected / 3600,
+            'walltime_hours': min(168, max(1, int(-(-hours // 1)))),
+            'mem_per_cpu': max(1000, int(-(-peak * self.mem_margin / 1024 // 500)) * 500),
+            'condor_queue': flavour[0] if flavour else CONDOR_FLAVOURS[-1],
+            'split': 1,
+        }
+        # Jobs longer than the target should have fewer events per file
+        if expected / 3600 > target_hours:
+            plan['split'] = int(-(-expected / 3600 // target_hours))
+        return plan
+
+    def apply(self, config, target_hours):
+        plan = self.plan(config, target_hours)
+        self.report(config, plan)
+        if plan is None:
+            return None
+        config.walltime_hours = plan['walltime_hours']
+        config.mem_per_cpu = plan['mem_per_cpu']
+        config.condor_memory = plan['mem_per_cpu'] * config.cpus_per_job
+        config.local_mem_per_job = plan['mem_per_cpu']
+        config.condor_queue = plan['condor_queue']
+        return plan
+
+    def report(self, config, plan):
+        if plan is None:
+            print ("%s: no completed jobs to learn from, keeping %d h, %d MB per cpu, condor %s" % (
+                config.get_config_string(), config.walltime_hours, config.mem_per_cpu, config.condor_queue))
+            return
+        print ("%s: %.3f s/event, peak %.0f MB (%s)" % (plan['config'], plan['seconds_per_event'], plan['peak_mb'], plan['source']))
+        print ("  expected job duration %.1f h for %d events x %d files per job" % (plan['job_hours'], config.nevs, config.files_per_job))
+        print ("  walltime %d h (was %d h), memory %d MB per cpu (was %d MB), condor %s (was %s)" % (
+            plan['walltime_hours'], config.walltime_hours, plan['mem_per_cpu'], config.mem_per_cpu, plan['condor_queue'], config.condor_queue))
+        if plan['split'] > 1:
+            print ("  jobs exceed the target duration: consider -n %d -f %d (%d times more files with fewer events)" % (
+                -(-config.nevs // plan['split']), config.nfiles * plan['split'], plan['split']))
+
+class CampaignMetrics:
+    # Per-stage summary of the sidecars of one or more configurations
+    def __init__(self, file_generator):
+        self.fgen = file_generator
+        self.cfg = file_generator.cfg
+
+    def summary(self, configStrings=None):
+        sidecars = read_sidecars(self.fgen.path(self.fgen.logdir), configStrings, self.cfg.gen_workers)
+        stages = collections.OrderedDict()
+        for configString in sorted(sidecars):
+            for i, entries in sidecars[configString].items():
+                for stage, entry in entries.items():
+                    stages.setdefault(stage, []).append(entry)
+        summary = {
+            'configs': sorted(sidecars),
+            'files': sum(len(files) for files in sidecars.values()),
+            'stages': collections.OrderedDict()
+        }
+        for stage in sorted(stages, key=lambda stage: (["wcsim", "mdt", "fq", "chain"] + [stage]).index(stage)):
+            entries = stages[stage]
+            ok = [entry for entry in entries if entry.get('exit_code') == 0]
+            wall = sorted(entry['wall'] for entry in ok)
+            rss = sorted(entry['max_rss_kb'] / 1024. for entry in ok)
+            events = sum(entry.get('events', 0) for entry in ok)
+            outputs = [sum(entry.get('outputs', {}).values()) for entry in ok]
+            summary['stages'][stage] = {
+                'runs': len(entries),
+                'failed': len(entries) - len(ok),
+                'wall_p50': percentile(wall, 50),
+                'wall_p90': percentile(wall, 90),
+                'wall_p99': percentile(wall, 99),
+                'wall_max': wall[-1] if wall else None,
+                'cpu_efficiency': sum(entry['cpu'] for entry in ok) / sum(wall) if sum(wall) > 0 else None,
+                'rss_p50_mb': percentile(rss, 50),
+                'rss_max_mb': rss[-1] if rss else None,
+                'events_per_s': events / sum(wall) if sum(wall) > 0 else None,
+                'output_mb': sum(outputs) / len(outputs) / 1e6 if outputs else None,
+            }
+        return summary
+
+    def report(self, configStrings=None):
+        summary = self.summary(configStrings)
+        print ("%d files of %d configurations" % (summary['files'], len(summary['configs'])))
+        print ("  %-6s %6s %6s %9s %9s %9s %9s %8s %9s %9s %9s %9s" % (
+            "stage", "runs", "failed", "wall p50", "p90", "p99", "max [s]", "cpu/wall", "rss p50", "max [MB]", "events/s", "out [MB]"))
+        fmt = lambda value, spec: spec % value if value is not None else "-"
+        for stage, s in summary['stages'].items():
+            print ("  %-6s %6d %6d %9s %9s %9s %9s %8s %9s %9s %9s %9s" % (stage, s['runs'], s['failed'],
+                fmt(s['wall_p50'], "%.1f"), fmt(s['wall_p90'], "%.1f"), fmt(s['wall_p99'], "%.1f"), fmt(s['wall_max'], "%.1f"),
+                fmt(s['cpu_efficiency'], "%.2f"), fmt(s['rss_p50_mb'], "%.0f"), fmt(s['rss_max_mb'], "%.0f"),
+                fmt(s['events_per_s'], "%.2f"), fmt(s['output_mb'], "%.1f")))
+        return summary
+
+class CampaignPlanner:
+    # Dry run of a campaign or scan: missing files, core-hours, output volume per stage and time to drain the queue,
+    # estimated from the sidecars and output files of earlier campaigns. Nothing is written or submitted.
+    def __init__(self, file_generator):
+        self.fgen = file_generator
+        self.cfg = file_generator.cfg
+        self.model = ResourceModel(file_generator)
+        self.completion = None
+        self.output_samples = None
+
+    def get_completion(self):
+        if self.completion is None:
+            self.completion = CompletionIndex(self.fgen.path(self.fgen.outdir), self.cfg.min_output_size)
+        return self.completion
+
+    def learn_outputs(self):
+        # output_samples[key][stage] is a list of output bytes per event, from the outputs recorded in the sidecars
+        if self.output_samples is not None:
+            return self.output_samples
+        self.output_samples = {}
+        for configString, files in self.model.get_sidecars().items():
+            key = ResourceModel.key(configString)
+            if key is None:
+                continue
+            for i, stages in files.items():
+                for stage, entry in stages.items():
+                    if entry.get('exit_code') != 0 or not entry.get('events'):
+                        continue
+                    # A chain entry lists the outputs of all stages
+                    for name, size in entry.get('outputs', {}).items():
+                        m = CompletionIndex.pattern.match(name)
+                        if m and size > 0:
+                            self.output_samples.setdefault(key, {}).setdefault(m.group(1), []).append(size / float(entry['events']))
+        return self.output_samples
+
+    def output_rate(self, config, stage):
+        # (bytes per event, source) of one stage, None without any outputs to learn from
+        samples = self.learn_outputs()
+        key = ResourceModel.key(config.get_config_string())
+        if key is not None:
+            # Same fallback as ResourceModel.estimate: nearest energy of the same particle, mode and CDS, scaled with the energy
+            candidates = sorted((abs(k[2] - key[2]), k) for k in samples if k[:2] == key[:2] and k[3] == key[3] and stage in samples[k])
+            if candidates:
+                k = candidates[0][1]
+                values = samples[k][stage]
+                rate = sum(values) / len(values)
+                source = "%d jobs" % len(values)
+                if k != key:
+                    if k[2] > 0 and key[2] > 0:
+                        rate *= key[2] / k[2]
+                    source += ", scaled from %.0f MeV" % k[2]
+                return rate, source
+        # Files of this configuration in out/ without sidecars, assumed to have the same number of events
+        configString = config.get_config_string()
+        sizes = []
+        for i in sorted(self.get_completion().files.get((stage, configString), set()))[:100]:
+            try:
+                sizes.append(os.path.getsize(self.fgen.path("%s/%s%s%04i.root" % (self.fgen.outdir, stage, configString, i))))
+            except OSError:
+                continue
+        if sizes and config.nevs > 0:
+            return sum(sizes) / float(len(sizes)) / config.nevs, "%d files in %s" % (len(sizes), self.fgen.outdir)
+        return None
+
+    def backend(self, config):
+        for backend, selected in [("sukap", config.submit_sukap_jobs), ("cedar", config.submit_cedar_jobs),
+                                  ("condor", config.submit_condor_jobs), ("local", config.submit_local_jobs)]:
+            if selected:
+                return backend
+        return None
+
+    def concurrency(self, config):
+        # Jobs running at once: the throttle's queue limit, the array limit or the local workers, 0 for no limit
+        backend = self.backend(config)
+        if backend == "local":
+            return LocalExecutor(config, self.fgen).workers
+        limit = MAX_JOBS[backend] if config.max_jobs is None else config.max_jobs
+        if backend == "cedar" and config.cedar_array and config.cedar_array_limit > 0:
+            limit = min(limit, config.cedar_array_limit) if limit > 0 else config.cedar_array_limit
+        return limit
+
+    def scheduler_calls(self, config, njobs):
+        # Per-job submissions are spaced by the submission rate, arrays, bulk jobs and condor clusters take a few calls
+        backend = self.backend(config)
+        if config.compact or backend in ("condor", "local"):
+            return 0
+        if (backend == "sukap" and not config.sukap_bulk) or (backend == "cedar" and not config.cedar_array):
+            return njobs
+        return 0
+
+    def plan(self, config):
+        configString = config.get_config_string()
+        indices = config.get_indices()
+        missing = self.get_completion().missing(configString, config.get_kept_stages(), indices)
+        k = max(1, config.files_per_job)
+        njobs = -(-len(missing) // k)
+        plan = {
+            'config': configString,
+            'files': len(indices),
+            'missing': len(missing),
+            'missing_indices': compress_indices(missing),
+            'jobs': njobs,
+            'cpus_per_job': config.cpus_per_job,
+            'seconds_per_event': None,
+            'time_source': None,
+            'job_hours': None,
+            'core_hours': None,
+            'stages': collections.OrderedDict(),
+            'storage_gb': None,
+            'backend': self.backend(config),
+            'concurrency': self.concurrency(config) if self.backend(config) else None,
+            'scheduler_calls': self.scheduler_calls(config, njobs),
+        }
+        estimate = self.model.estimate(config)
+        if estimate is not None:
+            spe, peak, source = estimate
+            # Files of a job run cpus_per_job at a time, and the job holds all of its cores until the last one ends
+            rounds = -(-min(k, max(1, len(missing))) // config.cpus_per_job)
+            plan['seconds_per_event'] = spe
+            plan['time_source'] = source
+            plan['job_hours'] = spe * config.nevs * rounds / 3600
+            plan['core_hours'] = plan['job_hours'] * config.cpus_per_job * njobs
+        kept = config.get_kept_stages()
+        storage = 0.
+        for stage in config.get_run_stages():
+            rate = self.output_rate(config, stage)
+            plan['stages'][stage] = {
+                'kept': stage in kept,
+                'bytes_per_event': rate[0] if rate else None,
+                'source': rate[1] if rate else None,
+                'gb': rate[0] * config.nevs * len(missing) / 1e9 if rate else None,
+            }
+            if stage in kept:
+                storage = storage + plan['stages'][stage]['gb'] if rate and storage is not None else None
+        plan['storage_gb'] = storage
+        return plan
+
+    def summary(self, configs):
+        # The points of a scan share one throttle per batch system, so they drain together
+        plans = [self.plan(config) for config in configs]
+        total = lambda key: sum(p[key] for p in plans) if all(p[key] is not None for p in plans) else None
+        summary = {
+            'points': plans,
+            'files': sum(p['files'] for p in plans),
+            'missing': sum(p['missing'] for p in plans),
+            'jobs': sum(p['jobs'] for p in plans),
+            'core_hours': total('core_hours'),
+            'storage_gb': total('storage_gb'),
+            'backend': plans[0]['backend'] if plans else None,
+            'drain_hours': None,
+        }
+        if summary['backend'] and summary['jobs'] and all(p['job_hours'] is not None for p in plans if p['jobs']):
+            jobHours = sum(p['job_hours'] * p['jobs'] for p in plans)
+            longest = max(p['job_hours'] for p in plans if p['jobs'])
+            concurrency = plans[0]['concurrency']
+            drain = max(longest, jobHours / concurrency) if concurrency > 0 else longest
+            if self.cfg.submit_rate > 0:
+                drain += sum(p['scheduler_calls'] for p in plans) / self.cfg.submit_rate / 3600
+            summary['drain_hours'] = drain
+        return summary
+
+    def report(self, configs):
+        summary = self.summary(configs)
+        fmt = lambda value, spec: spec % value if value is not None else "-"
+        for p in summary['points']:
+            print ("%s: %d of %d files missing (%s), %d jobs" % (p['config'], p['missing'], p['files'], p['missing_indices'] or "-", p['jobs']))
+            if p['seconds_per_event'] is None:
+                print ("  no completed jobs to learn the time per event from")
+            else:
+                print ("  %.3f s/event (%s), %.2f h per job x %d cpus, %s core-hours" % (
+                    p['seconds_per_event'], p['time_source'], p['job_hours'], p['cpus_per_job'], fmt(p['core_hours'], "%.1f")))
+            for stage, s in p['stages'].items():
+                print ("  %-5s %10s GB %s(%s)" % (stage, fmt(s['gb'], "%.2f"), "" if s['kept'] else "intermediate, not kept ",
+                    s['source'] or "no outputs to learn from"))
+        print ("Total: %d of %d files missing, %d jobs, %s core-hours, %s GB kept in %s" % (summary['missing'], summary['files'], summary['jobs'],
+            fmt(summary['core_hours'], "%.1f"), fmt(summary['storage_gb'], "%.2f"), self.fgen.outdir))
+        if summary['backend'] is None:
+            print ("No batch system selected, select one for the time to drain the queue")
+        elif summary['drain_hours'] is not None:
+            concurrency = summary['points'][0]['concurrency']
+            print ("%s: %s at a time, drained in about %.1f h (not counting the time the jobs wait for the scheduler)" % (
+                summary['backend'], "%d jobs" % concurrency if concurrency > 0 else "all jobs", summary['drain_hours']))
+        elif summary['jobs']:
+            print ("%s: no completed jobs to estimate the time to drain the queue from" % summary['backend'])
+        return summary
+
+    def check_budget(self, configs):
+        # False if the missing files of the campaign (or scan) exceed the CPU or storage budget
+        if self.cfg.budget_core_hours <= 0 and self.cfg.budget_storage_gb <= 0:
             return True
-        return False
+        summary = self.report(configs)
+        ok = True
+        for name, value, limit, unit in [("CPU", summary['core_hours'], self.cfg.budget_core_hours, "core-hours"),
+                                         ("storage", summary['storage_gb'], self.cfg.budget_storage_gb, "GB")]:
+            if limit <= 0:
+                continue
+            if value is None:
+                print ("WARNING: no statistics of earlier jobs, the %s budget of %g %s cannot be checked" % (name, limit, unit))
+            elif value > limit:
+                print ("ERROR: the submission needs %.1f %s, over the %s budget of %g %s" % (value, unit, name, limit, unit))
+                ok = False
+        return ok
+
+# Queue listing per backend and the column holding the user name; array tasks are listed one per row
+QUEUE_COMMANDS = {
+    'sukap': ("pjstat -E", 4),
+    'cedar': ("squeue -h -r -u %(user)s -o '%%i %%u'", 1),
+    'condor': ("condor_q %(user)s -af ClusterId Owner", 1),
+}
+# Default number of jobs kept in the queue per backend, 0 is no limit
+MAX_JOBS = {'sukap': 300, 'cedar': 1000, 'condor': 0}
+
+class SubmissionThrottle:
+    # Shared by all submissions to one backend: a sliding window over the jobs in the queue
+    # and a minimum interval between scheduler calls. A full queue is waited for at most max_wait seconds
+    # in total (-1 without limit); the web server uses 0 so a campaign never holds a worker until the queue drains.
+    def __init__(self, backend, max_jobs=None, rate=0., poll_interval=10, max_wait=-1):
+        self.user = os.environ.get('USER')
+        if not self.user:
+            self.user = getpass.getuser()
+        command, self.user_column = QUEUE_COMMANDS[backend]
+        self.command = command % {'user': self.user}
+        self.max_jobs = MAX_JOBS[backend] if max_jobs is None else max_jobs
+        self.interval = 1. / rate if rate > 0 else 0.
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.deadline = None
+        self.depth = None
+        self.last_poll = 0.
+        self.last_submit = 0.
+        self.lock = threading.Lock()
+
+    def poll(self):
+        # Count only this user's rows, header and summary lines are skipped
+        com = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        res, err = com.communicate()
+        depth = 0
+        for line in res.decode('utf-8').split('\n'):
+            parts = line.split()
+            if len(parts) > self.user_column and parts[self.user_column] == self.user:
+                depth += 1
+        self.depth = depth
+        self.last_poll = time.time()
+        return depth
+
+    def queue_depth(self):
+        if self.depth is None or time.time() - self.last_poll >= self.poll_interval:
+            self.poll()
+        return self.depth
+
+    def acquire(self, n):
+        # Hand out as many slots as are free (up to n), waiting for room until the deadline; 0 if the queue stayed full
+        if self.max_jobs <= 0:
+            return n
+        while True:
+            with self.lock:
+                free = self.max_jobs - self.queue_depth()
+                if free > 0:
+                    n = min(n, free)
+                    self.depth += n
+                    return n
+                if self.deadline is None:
+                    self.deadline = time.time() + self.max_wait if self.max_wait >= 0 else float('inf')
+                wait = min(max(0., self.poll_interval - (time.time() - self.last_poll)), self.deadline - time.time())
+                if wait <= 0:
+                    return 0
+            time.sleep(wait)
+
+    def wait_turn(self):
+        # Space the scheduler calls at least 1/rate seconds apart
+        with self.lock:
+            wait = self.last_submit + self.interval - time.time()
+            self.last_submit = max(time.time(), self.last_submit + self.interval)
+        if wait > 0:
+            time.sleep(wait)
+
+class LocalExecutor:
+    # Runs job scripts on this machine with a bounded number of concurrent processes.
+    # Each job has a state file in local_dir/ so JobStatus can list and kill it from another process.
+    def __init__(self, config, file_generator):
+        self.cfg = config
+        self.fgen = file_generator
+        self.workers = self.cfg.local_workers if self.cfg.local_workers > 0 else self.default_workers()
+
+    def default_workers(self):
+        ncpus = max(1, (os.cpu_count() or 1) // self.cfg.cpus_per_job)
+        try:
+            mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+            nmem = max(1, mem // (self.cfg.local_mem_per_job * self.cfg.cpus_per_job))
+        except (ValueError, OSError, AttributeError):
+            nmem = ncpus
+        return min(ncpus, nmem)
+
+    def state_file(self, name):
+        return self.fgen.path("%s/%s.state" % (self.fgen.localdir, name))
+
+    def run(self, jobs):
+        # jobs is a list of (name, script, nfiles); blocks until all of them have finished
+        for name, script, nfiles in jobs:
+            with open(self.state_file(name), 'w') as fo:
+                fo.write("PENDING - %f %s\n" % (time.time(), script))
+        print ("Running %d local jobs, %d at a time" % (len(jobs), self.workers))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(lambda job: self.run_job(*job), jobs))
+        return results
+
+    def run_job(self, name, script, nfiles):
+        stateFile = self.state_file(name)
+        if not os.path.exists(stateFile):
+            # Killed while still pending
+            return None
+        out = self.fgen.path("%s/local%s.out" % (self.fgen.logdir, name))
+        err = self.fgen.path("%s/local%s.err" % (self.fgen.logdir, name))
+        with open(out, 'w') as fout, open(err, 'w') as ferr:
+            com = subprocess.Popen(["bash"] + script.split(), cwd=self.cfg.curdir, stdout=fout, stderr=ferr, close_fds=True, start_new_session=True)
+            with open(stateFile, 'w') as fo:
+                fo.write("RUNNING %d %f %s\n" % (com.pid, time.time(), script))
+            try:
+                code = com.wait(timeout=self.cfg.local_timeout if self.cfg.local_timeout > 0 else None)
+            except subprocess.TimeoutExpired:
+                # The container and its children run in the job's own session
+                os.killpg(com.pid, signal.SIGKILL)
+                com.wait()
+                ferr.write("Local job killed after %d s timeout\n" % self.cfg.local_timeout)
+                code = -signal.SIGKILL
+        if os.path.exists(stateFile):
+            os.remove(stateFile)
+        if code != 0:
+            self.fgen.progress.add('failed', nfiles)
+            print ("Local job %s failed (exit code %d)" % (name, code))
+        return code
+
+class JobSubmitter:
+    def __init__(self, config, file_generator, throttles=None):
+        self.cfg = config
+        self.fgen = file_generator
+        self.progress = file_generator.progress
+        self.completion = None
+        # Submitters of the same campaign or scan share one throttle per backend
+        self.throttles = throttles if throttles is not None else {}
+        self.submit_error = None
+        self.failed_submissions = []
+        self.deferred_submissions = []
+
+    def get_completion(self, refresh=False):
+        if self.completion is None or refresh:
+            self.completion = CompletionIndex(self.fgen.path(self.fgen.outdir), self.cfg.min_output_size)
+        return self.completion
+
+    def get_stages(self):
+        # A file is done when the outputs of its kept stages exist
+        return self.cfg.get_kept_stages()
+
+    def get_missing_indices(self, refresh=False):
+        return self.get_completion(refresh).missing(self.cfg.get_config_string(), self.get_stages(), self.cfg.get_indices())
+
+    def is_job_missing(self, i):
+        return len(self.get_completion().missing(self.cfg.get_config_string(), self.get_stages(), [i])) > 0
 
     def scan_jobs(self):
-        n_to_submit = 0
-        n_skipped = 0
-        for i in range(self.cfg.nfiles):
-            if self.is_job_missing(i):
-                n_to_submit += 1
-            else:
-                n_skipped += 1
+        n_to_submit = len(self.get_missing_indices())
+        n_skipped = len(self.cfg.get_indices()) - n_to_submit
         return n_to_submit, n_skipped
 
+    def get_packs(self):
+        # Missing indices grouped files_per_job at a time; completion is still checked per file
+        indices = self.get_missing_indices()
+        k = max(1, self.cfg.files_per_job)
+        return [indices[n:n + k] for n in range(0, len(indices), k)]
+
+    def job_script(self, pack):
+        # A pack is named after its first index, single files keep using their run script directly
+        configString = self.cfg.get_config_string()
+        if self.cfg.compact:
+            return "%s/job%s.sh %d" % (self.fgen.shelldir, configString, pack[0])
+        if self.cfg.files_per_job <= 1:
+            return "%s/run%s%04i.sh" % (self.fgen.shelldir, configString, pack[0])
+        return "%s/pack%s%04i.sh" % (self.fgen.shelldir, configString, pack[0])
+
+    def write_pack_scripts(self, packs):
+        if self.cfg.files_per_job <= 1: return
+        configString = self.cfg.get_config_string()
+        packFormat = compile_template(self.fgen.path("template/pack.sh"), curdir=self.cfg.curdir, ncpus=self.cfg.cpus_per_job)
+        for pack in packs:
+            with open(self.fgen.path(self.job_script(pack)), 'w') as fo:
+                fo.write(packFormat % {
+                    'shFiles': " ".join("%s/run%s%04i.sh" % (self.fgen.shelldir, configString, i) for i in pack)
+                })
+
+    def get_throttle(self, backend):
+        if backend not in self.throttles:
+            self.throttles[backend] = SubmissionThrottle(backend, self.cfg.max_jobs, self.cfg.submit_rate, self.cfg.queue_poll_interval, self.cfg.queue_wait)
+        return self.throttles[backend]
+
+    def run_submit_command(self, command, nfiles, name):
+        # Scheduler errors are retried with exponential backoff; returns None once the retries are used up
+        throttle = self.get_throttle(name.lower())
+        delay = self.cfg.submit_backoff
+        for attempt in range(self.cfg.submit_retries + 1):
+            throttle.wait_turn()
+            com = subprocess.Popen(command, shell=True, cwd=self.cfg.curdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+            res, err = com.communicate()
+            res = res.decode('utf-8')
+            err = err.decode('utf-8').strip()
+            if com.returncode == 0 and (not err or SUBMIT_ID.search(res)):
+                self.progress.add('submitted', nfiles)
+                print (res)
+                if err:
+                    print ("%s submission warning: %s" % (name, err))
+                return res
+            self.submit_error = err or "exit code %d" % com.returncode
+            print ("%s submission failed (attempt %d of %d): %s" % (name, attempt + 1, self.cfg.submit_retries + 1, self.submit_error))
+            if attempt < self.cfg.submit_retries:
+                time.sleep(delay)
+                delay = min(delay * 2, 600)
+        self.progress.add('failed', nfiles)
+        return None
+
+    def record_submission(self, res, backend, packs, tasks=None, task_format="%s_%d"):
+        # tasks maps the first index of a pack to its array task (or proc) number
+        if res is None:
+            indices = [i for pack in packs for i in pack]
+            self.failed_submissions.extend(indices)
+            self.fgen.get_db().mark(self.cfg.get_config_string(), indices, 'failed', backend, message="submission failed: %s" % self.submit_error)
+            return
+        match = SUBMIT_ID.search(res)
+        job_id = match.group(1) if match else None
+        ids = {}
+        for pack in packs:
+            for i in pack:
+                ids[i] = task_format % (job_id, tasks[pack[0]]) if tasks is not None and job_id else job_id
+        self.fgen.get_db().mark(self.cfg.get_config_string(), list(ids), 'submitted', backend, ids)
+
+    def defer(self, packs):
+        # Packs left over when the queue stayed full; they keep their generated state and are submitted by a later run
+        indices = [i for pack in packs for i in pack]
+        self.deferred_submissions.extend(indices)
+        self.progress.add('deferred', len(indices))
+
+    def print_summary(self, nfiles, njobs, n_skipped):
+        nfiles -= len(self.failed_submissions) + len(self.deferred_submissions)
+        if self.cfg.files_per_job > 1:
+            print ("Submitted %d files in %d jobs. Skipped %d files due to existing files." % (nfiles, njobs, n_skipped))
+        else:
+            print ("Submitted %d jobs. Skipped %d jobs due to existing files." % (nfiles, n_skipped))
+        if self.failed_submissions:
+            print ("Submission of %d files failed after %d attempts: %s" % (len(self.failed_submissions), self.cfg.submit_retries + 1,
+                compress_indices(sorted(self.failed_submissions))))
+        if self.deferred_submissions:
+            deferred = sorted(self.deferred_submissions)
+            print ("The queue is full, %d files were not submitted: %s" % (len(deferred), compress_indices(deferred)))
+            if self.cfg.only_indices is None:
+                print ("Submit them once the queue has drained with --range %d:%d, or with a longer --queue-wait" % (deferred[0], self.cfg.get_indices()[-1] + 1))
+
     def submit_sukap(self):
         if not self.cfg.submit_sukap_jobs: return
 
         configString = self.cfg.get_config_string()
         print ("Submitting pjsub jobs on sukap")
         
-        with open("template/pjsub.sh", 'r') as f:
+        with open(self.fgen.path("template/pjsub.sh"), 'r') as f:
             shTemplate = string.Template(f.read())
 
-        n_submitted = 0
-        n_skipped = 0
-        for i in range(self.cfg.nfiles):
-            if self.is_job_missing(i):
-                n_submitted += 1
-                while True:
-                    com = subprocess.Popen("pjstat | wc -l", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-                    res, err = com.communicate()
-                    try:
-                        queueCount = int(res)
-                    except:
-                        queueCount = 9999
-                    if queueCount < 300:
+        packs = self.get_packs()
+        nfiles = sum(len(pack) for pack in packs)
+        n_skipped = len(self.cfg.get_indices()) - nfiles
+        self.progress.add('skipped', n_skipped)
+        self.write_pack_scripts(packs)
+
+        throttle = self.get_throttle("sukap")
+
+        # Compact campaigns have no per-file scripts, so they are always bulk jobs
+        if self.cfg.sukap_bulk or self.cfg.compact:
+            indices = [pack[0] for pack in packs]
+
+            # Bulk sub-jobs get their index from PJM_BULKNUM and keep the per-file log names
+            idx = "$(printf '%04i' $PJM_BULKNUM)"
+            pjFile = "%s/pjsub%sbulk.sh" % (self.fgen.pjdir, configString)
+            script = "%s/job%s.sh $PJM_BULKNUM" % (self.fgen.shelldir, configString) if self.cfg.compact else "%s/run%s%s.sh" % (self.fgen.shelldir, configString, idx)
+            with open(self.fgen.path(pjFile), 'w') as fo:
+                fo.write(shTemplate.substitute(
+                    curdir=self.cfg.curdir,
+                    shFile="%s > %s/pjsub%s%s.out 2> %s/pjsub%s%s.err" % (
+                        script,
+                        self.fgen.pjoutdir, configString, idx,
+                        self.fgen.pjerrdir, configString, idx),
+                    pjout="%s/pjsub%sbulk.out" % (self.fgen.pjoutdir, configString),
+                    pjerr="%s/pjsub%sbulk.err" % (self.fgen.pjerrdir, configString),
+                    elapse="%d:00:00" % self.cfg.walltime_hours,
+                    rscgrp=self.cfg.sukap_queue
+                ))
+
+            # --sparam only takes a start-end range, so each contiguous run of missing indices is its own bulk job
+            ranges = [[int(v) for v in r.split("-")] for r in compress_indices(indices).split(",") if r]
+            for r in ranges:
+                lo, hi = r[0], r[-1]
+                while lo <= hi:
+                    n = throttle.acquire(hi - lo + 1) if not self.deferred_submissions else 0
+                    if n == 0:
+                        self.defer([[i] for i in range(lo, hi + 1)])
                         break
-                    time.sleep(10)
-
-                shFile = "%s/run%s%04i.sh" % (self.fgen.shelldir, configString, i)
-                pjFile = "%s/pjsub%s%04i.sh" % (self.fgen.pjdir, configString, i)
-                pjout = "%s/pjsub%s%04i.out" % (self.fgen.pjoutdir, configString, i)
-                pjerr = "%s/pjsub%s%04i.err" % (self.fgen.pjerrdir, configString, i)
-                
-                with open(pjFile, 'w') as fo:
-                    fo.write(shTemplate.substitute(
-                        curdir=self.cfg.curdir,
-                        shFile=shFile,
-                        pjout=pjout,
-                        pjerr=pjerr,
-                        rscgrp=self.cfg.sukap_queue
-                    ))
+                    res = self.run_submit_command("pjsub --bulk --sparam %d-%d %s" % (lo, lo + n - 1, pjFile), n, "Sukap")
+                    self.record_submission(res, "sukap", [[i] for i in range(lo, lo + n)], {i: i for i in range(lo, lo + n)}, "%s[%d]")
+                    lo += n
+        else:
+            pos = 0
+            while pos < len(packs):
+                # Fill all the free slots before polling the queue again
+                n = throttle.acquire(len(packs) - pos)
+                if n == 0:
+                    self.defer(packs[pos:])
+                    break
+                for pack in packs[pos:pos + n]:
+                    i = pack[0]
+                    pjFile = "%s/pjsub%s%04i.sh" % (self.fgen.pjdir, configString, i)
+                    pjout = "%s/pjsub%s%04i.out" % (self.fgen.pjoutdir, configString, i)
+                    pjerr = "%s/pjsub%s%04i.err" % (self.fgen.pjerrdir, configString, i)
+                    
+                    with open(self.fgen.path(pjFile), 'w') as fo:
+                        fo.write(shTemplate.substitute(
+                            curdir=self.cfg.curdir,
+                            shFile=self.job_script(pack),
+                            pjout=pjout,
+                            pjerr=pjerr,
+                            elapse="%d:00:00" % self.cfg.walltime_hours,
+                            rscgrp=self.cfg.sukap_queue
+                        ))
 
-                com = subprocess.Popen("pjsub %s" % (pjFile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-                res, err = com.communicate()
-                if len(err) > 0:
-                    raise RuntimeError("Sukap submission failed: %s" % err.decode('utf-8'))
-                else:
-                    print (res.decode('utf-8'))
-            else:
-                n_skipped += 1
-        print ("Submitted %d jobs. Skipped %d jobs due to existing files." % (n_submitted, n_skipped))
+                    res = self.run_submit_command("pjsub %s" % (pjFile), len(pack), "Sukap")
+                    self.record_submission(res, "sukap", [pack])
+                pos += n
+        self.print_summary(nfiles, len(packs), n_skipped)
 
     def submit_cedar(self):
         if not self.cfg.submit_cedar_jobs: return
+        # Compact campaigns have no per-file scripts, so they are always job arrays
+        if self.cfg.cedar_array or self.cfg.compact:
+            self.submit_cedar_array()
+            return
         
         configString = self.cfg.get_config_string()
         print ("Creating slurm scripts for WCSim")
         
-        with open("template/slurm.sh", 'r') as f:
+        with open(self.fgen.path("template/slurm.sh"), 'r') as f:
             slTemplate = string.Template(f.read())
             
         siffile = self.cfg.siffile
 
-        for i in range(self.cfg.nfiles):
+        packs = self.get_packs()
+        nfiles = sum(len(pack) for pack in packs)
+        n_skipped = len(self.cfg.get_indices()) - nfiles
+        self.progress.add('skipped', n_skipped)
+        self.write_pack_scripts(packs)
+
+        for pack in packs:
+            i = pack[0]
             slFile = "%s/slurm%s%04i.sh" % (self.fgen.sldir, configString, i)
             slout = "%s/slurm%s%04i" % (self.fgen.sloutdir, configString, i)
             slerr = "%s/slurm%s%04i" % (self.fgen.slerrdir, configString, i)
             
-            with open(slFile, 'w') as fo:
+            with open(self.fgen.path(slFile), 'w') as fo:
                 fo.write(slTemplate.substitute(
                     account=self.cfg.rapaccount, 
                     curdir=self.cfg.curdir, 
@@ -310,61 +1639,728 @@ class JobSubmitter:
                     siffile=siffile, 
                     sout=slout, 
                     serr=slerr,
-                    shFile="%s/run%s%04i.sh" % (self.fgen.shelldir, configString, i)
+                    cpus=self.cfg.cpus_per_job,
+                    mem="%iM" % (self.cfg.mem_per_cpu * self.cfg.cpus_per_job),
+                    walltime="%d-%d:0:0" % divmod(self.cfg.walltime_hours, 24),
+                    shFile=self.job_script(pack)
                 ))
 
         print ("Submitting slurm jobs on cedar")
-        n_submitted = 0
-        n_skipped = 0
-        for i in range(self.cfg.nfiles):
-            if self.is_job_missing(i):
-                n_submitted += 1
-                slFile = "%s/slurm%s%04i.sh" % (self.fgen.sldir, configString, i)
-                com = subprocess.Popen("sbatch %s" % (slFile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-                res, err = com.communicate()
-                if len(err) > 0:
-                    raise RuntimeError("Cedar submission failed: %s" % err.decode('utf-8'))
-                else:
-                    print (res.decode('utf-8'))
-            else:
-                n_skipped += 1
-        print ("Submitted %d jobs. Skipped %d jobs due to existing files." % (n_submitted, n_skipped))
+        throttle = self.get_throttle("cedar")
+        pos = 0
+        while pos < len(packs):
+            n = throttle.acquire(len(packs) - pos)
+            if n == 0:
+                self.defer(packs[pos:])
+                break
+            for pack in packs[pos:pos + n]:
+                slFile = "%s/slurm%s%04i.sh" % (self.fgen.sldir, configString, pack[0])
+                res = self.run_submit_command("sbatch %s" % (slFile), len(pack), "Cedar")
+                self.record_submission(res, "cedar", [pack])
+            pos += n
+        self.print_summary(nfiles, len(packs), n_skipped)
+
+    def submit_cedar_array(self):
+        configString = self.cfg.get_config_string()
+        print ("Creating slurm array script for WCSim")
+
+        with open(self.fgen.path("template/slurm.sh"), 'r') as f:
+            slTemplate = string.Template(f.read())
+
+        # The array task ID is the (first) file index of the job and %4a keeps the per-file log names
+        prefix = "pack" if self.cfg.files_per_job > 1 else "run"
+        slFile = "%s/slurm%sarray.sh" % (self.fgen.sldir, configString)
+        if self.cfg.compact:
+            shFile = "%s/job%s.sh $SLURM_ARRAY_TASK_ID" % (self.fgen.shelldir, configString)
+        else:
+            shFile = "%s/%s%s$(printf '%%04i' $SLURM_ARRAY_TASK_ID).sh" % (self.fgen.shelldir, prefix, configString)
+        self.write_array_script(slTemplate, slFile, configString, shFile)
+
+        packs = self.get_packs()
+        nfiles = sum(len(pack) for pack in packs)
+        n_skipped = len(self.cfg.get_indices()) - nfiles
+        self.progress.add('skipped', n_skipped)
+        self.write_pack_scripts(packs)
+
+        if len(packs) > 0:
+            print ("Submitting slurm job array on cedar")
+        # Arrays larger than the free queue slots are split into several arrays
+        throttle = self.get_throttle("cedar")
+        pos = 0
+        while pos < len(packs):
+            n = throttle.acquire(len(packs) - pos)
+            if n == 0:
+                self.defer(packs[pos:])
+                break
+            chunk = packs[pos:pos + n]
+            arraySpec = compress_indices([pack[0] for pack in chunk])
+            if self.cfg.cedar_array_limit > 0:
+                arraySpec += "%%%d" % self.cfg.cedar_array_limit
+            res = self.run_submit_command("sbatch --array=%s %s" % (arraySpec, slFile), sum(len(pack) for pack in chunk), "Cedar")
+            self.record_submission(res, "cedar", chunk, {pack[0]: pack[0] for pack in chunk})
+            pos += n
+        self.print_summary(nfiles, len(packs), n_skipped)
+
+    def write_array_script(self, slTemplate, slFile, name, shFile):
+        with open(self.fgen.path(slFile), 'w') as fo:
+            fo.write(slTemplate.substitute(
+                account=self.cfg.rapaccount,
+                curdir=self.cfg.curdir,
+                mntdir=self.cfg.mntdir,
+                siffile=self.cfg.siffile,
+                sout="%s/slurm%s%%4a" % (self.fgen.sloutdir, name),
+                serr="%s/slurm%s%%4a" % (self.fgen.slerrdir, name),
+                cpus=self.cfg.cpus_per_job,
+                mem="%iM" % (self.cfg.mem_per_cpu * self.cfg.cpus_per_job),
+                walltime="%d-%d:0:0" % divmod(self.cfg.walltime_hours, 24),
+                shFile=shFile
+            ))
 
     def submit_condor(self):
         if not self.cfg.submit_condor_jobs: return
 
         configString = self.cfg.get_config_string()
-        print ("Creating condor scripts")
+        print ("Creating condor submit description")
         
-        with open("template/condor_submit.sub", 'r') as f:
+        with open(self.fgen.path("template/condor_submit.sub"), 'r') as f:
             condorTemplate = string.Template(f.read())
 
-        for i in range(self.cfg.nfiles):
-            condorFile = "%s/condor%s%04i.sub" % (self.fgen.condordir, configString, i)
-            out = "%s/condor%s%04i" % (self.fgen.condorout, configString, i)
-            err = "%s/condor%s%04i" % (self.fgen.condorerr, configString, i)
-            log = "%s/condor%s%04i" % (self.fgen.condorlog, configString, i)
-            shfile = "%s/run%s%04i.sh" % (self.fgen.shelldir, configString, i)
-            
-            with open(condorFile, 'w') as fo:
-                fo.write(condorTemplate.substitute(shfile=shfile, out=out, err=err, log=log, JobFlavour=self.cfg.condor_queue))
-
-        print ("Submitting condor jobs on lxplus")
-        n_submitted = 0
-        n_skipped = 0
-        for i in range(self.cfg.nfiles):
-            if self.is_job_missing(i):
-                n_submitted += 1
-                condorFile = "%s/condor%s%04i.sub" % (self.fgen.condordir, configString, i)
-                com = subprocess.Popen("module load lxbatch/eossubmit && condor_submit %s" % (condorFile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-                res, err = com.communicate()
-                if len(err) > 0:
-                    raise RuntimeError("Condor submission failed: %s" % err.decode('utf-8'))
-                else:
-                    print (res.decode('utf-8'))
+        # One submit description for the whole campaign, the per-job values come from the item file
+        condorFile = "%s/condor%s.sub" % (self.fgen.condordir, configString)
+        itemFile = "%s/condor%s.items" % (self.fgen.condordir, configString)
+
+        packs = self.get_packs()
+        nfiles = sum(len(pack) for pack in packs)
+        n_skipped = len(self.cfg.get_indices()) - nfiles
+        self.progress.add('skipped', n_skipped)
+        self.write_pack_scripts(packs)
+        with open(self.fgen.path(itemFile), 'w') as fo:
+            for pack in packs:
+                fo.write(self.condor_item(pack))
+        self.write_condor_description(condorTemplate, condorFile, itemFile)
+
+        if len(packs) > 0:
+            print ("Submitting condor jobs on lxplus")
+            res = self.run_submit_command("module load lxbatch/eossubmit && condor_submit %s" % (condorFile), nfiles, "Condor")
+            match = re.search(r"submitted to cluster (\d+)", res or "")
+            if match:
+                self.record_condor_cluster(int(match.group(1)), packs)
+            elif res is None:
+                self.record_submission(res, "condor", packs)
+        self.print_summary(nfiles, len(packs), n_skipped)
+
+    def condor_item(self, pack):
+        configString = self.cfg.get_config_string()
+        i = pack[0]
+        # The generic job script of a compact campaign gets the file index as its argument
+        return "%s, %s/condor%s%04i, %s/condor%s%04i, %s/condor%s%04i\n" % (
+            self.job_script(pack).replace(" ", ", "),
+            self.fgen.condorout, configString, i,
+            self.fgen.condorerr, configString, i,
+            self.fgen.condorlog, configString, i)
+
+    def write_condor_description(self, condorTemplate, condorFile, itemFile, args=None):
+        # Items have an args column for the generic job script of a compact campaign
+        args = self.cfg.compact if args is None else args
+        # The schedd keeps at most max_jobs of the cluster's jobs in the queue
+        maxJobs = self.get_throttle("condor").max_jobs
+        with open(self.fgen.path(condorFile), 'w') as fo:
+            fo.write(condorTemplate.substitute(
+                shfile="$(shfile)", out="$(out)", err="$(err)", log="$(log)",
+                arguments="arguments = $(args)" if args else "",
+                JobFlavour=self.cfg.condor_queue,
+                cpus=self.cfg.cpus_per_job,
+                memory="request_memory = %d" % self.cfg.condor_memory if self.cfg.condor_memory > 0 else "",
+                materialize="max_materialize = %d" % maxJobs if maxJobs > 0 else "",
+                queue="queue shfile,%sout,err,log from %s" % ("args," if args else "", itemFile)
+            ))
+
+    def validate_outputs(self):
+        # Check every existing output of this configuration, removing (or quarantining) the invalid ones
+        configString = self.cfg.get_config_string()
+        indices = set(self.cfg.get_indices())
+        completion = self.get_completion(refresh=True)
+        files = []
+        for stage in ["wcsim", "mdt", "fq"]:
+            for i in sorted(completion.files.get((stage, configString), set()) & indices):
+                files.append(self.fgen.path("%s/%s%s%04i.root" % (self.fgen.outdir, stage, configString, i)))
+
+        print ("Validating %d output files" % len(files))
+        start = time.time()
+        quarantine = self.fgen.path(self.cfg.quarantine_dir) if self.cfg.quarantine_dir else None
+        results = validate_files(files, self.cfg.nevs, max(self.cfg.gen_workers, os.cpu_count() or 1), quarantine)
+        bad = [result for result in results if result.verdict != "ok"]
+        for result in bad:
+            print ("%s: %s (%s)" % (os.path.basename(result.file), result.verdict, result.reason))
+        self.progress.add('validated', len(results) - len(bad))
+        self.progress.add('invalid', len(bad))
+        failed = {}
+        for result in bad:
+            failed[int(CompletionIndex.pattern.match(os.path.basename(result.file)).group(3))] = result.reason
+        ok = set(int(CompletionIndex.pattern.match(os.path.basename(result.file)).group(3)) for result in results) - set(failed)
+        db = self.fgen.get_db()
+        db.mark(configString, sorted(ok), 'validated')
+        for i, reason in failed.items():
+            db.mark(configString, [i], 'failed', message=reason)
+        print ("Validated %d files in %.2f s: %d ok, %d invalid%s." % (len(results), time.time() - start, len(results) - len(bad), len(bad),
+            ", moved to %s" % self.cfg.quarantine_dir if quarantine and bad else ""))
+        self.get_completion(refresh=True)
+        return results
+
+    def get_queued_indices(self, files):
+        # Files whose job the scheduler still lists, by index or by the recorded job ID
+        configString = self.cfg.get_config_string()
+        records = [job for jobs in JobStatus(self.cfg).get_jobs().values() for job in jobs]
+        ids, ranges = JobStatus.listed(records)
+        queued = set(job.index for job in records if job.config == configString and job.index is not None)
+        for i, row in files.items():
+            job_id = row['job_id'] or ""
+            if job_id in ids or re.split(r"[_\[.]", job_id)[0] in ranges:
+                queued.add(i)
+        return queued
+
+    def adjust_resources(self, category, attempts):
+        # Each retry of a walltime or memory failure doubles the request again
+        cfg = copy.copy(self.cfg)
+        factor = 2 ** min(attempts, 3)
+        if category == 'walltime':
+            cfg.walltime_hours = min(self.cfg.walltime_hours * factor, 168)
+            flavour = CONDOR_FLAVOURS.index(self.cfg.condor_queue) + min(attempts, 3)
+            cfg.condor_queue = CONDOR_FLAVOURS[min(flavour, len(CONDOR_FLAVOURS) - 1)]
+            cfg.local_timeout = self.cfg.local_timeout * factor
+        elif category == 'oom':
+            cfg.mem_per_cpu = self.cfg.mem_per_cpu * factor
+            # lxplus gives 2 GB per requested core by default
+            cfg.condor_memory = (self.cfg.condor_memory or 2000 * self.cfg.cpus_per_job) * factor
+            cfg.local_mem_per_job = self.cfg.local_mem_per_job * factor
+        return cfg
+
+    def retry_failures(self):
+        configString = self.cfg.get_config_string()
+        db = self.fgen.get_db()
+        files = db.get_files(configString)
+        queued = self.get_queued_indices(files)
+
+        # Only files that were submitted before, have no output and whose job has left the queue
+        candidates = [i for i in self.get_missing_indices() if i in files and files[i]['attempts'] > 0 and i not in queued]
+        print ("Classifying %d failed files" % len(candidates))
+        failures = FailureClassifier(self.cfg, self.fgen).classify_all(candidates)
+
+        groups = {}
+        exhausted = []
+        for i, (category, evidence) in failures.items():
+            db.mark(configString, [i], 'failed', message="%s %s" % (category, evidence))
+            if not FailureClassifier.retryable[category]:
+                continue
+            if files[i]['attempts'] > self.cfg.retry_budget:
+                exhausted.append(i)
+                continue
+            groups.setdefault((category, files[i]['attempts']), []).append(i)
+        self.write_failure_summary(failures, groups, exhausted)
+
+        for (category, attempts), indices in sorted(groups.items()):
+            cfg = self.adjust_resources(category, attempts)
+            cfg.only_indices = indices
+            print ("Resubmitting %d files after %s failures (attempt %d)" % (len(indices), category, attempts + 1))
+            submitter = JobSubmitter(cfg, self.fgen, self.throttles)
+            submitter.completion = self.completion
+            submitter.submit_sukap()
+            submitter.submit_cedar()
+            submitter.submit_condor()
+            submitter.submit_local()
+        return failures
+
+    def write_failure_summary(self, failures, groups, exhausted):
+        configString = self.cfg.get_config_string()
+        categories = collections.OrderedDict()
+        for i, (category, evidence) in sorted(failures.items()):
+            categories.setdefault(category, []).append(i)
+        retried = sorted(i for indices in groups.values() for i in indices)
+        print ("Failures of %s:" % configString)
+        for category, indices in categories.items():
+            print ("  %-10s %6d  %s%s" % (category, len(indices), compress_indices(indices),
+                "" if FailureClassifier.retryable[category] else " (not retried)"))
+        print ("Retrying %d files, %d files are out of retries%s" % (len(retried), len(exhausted),
+            ": %s" % compress_indices(exhausted) if exhausted else ""))
+        summary = {
+            'config': configString,
+            'time': time.time(),
+            'categories': dict((category, compress_indices(indices)) for category, indices in categories.items()),
+            'retried': compress_indices(retried),
+            'exhausted': compress_indices(exhausted),
+            'evidence': dict((str(i), evidence) for i, (category, evidence) in failures.items() if evidence)
+        }
+        with open(self.fgen.path("%s/failures%s.json" % (self.fgen.logdir, configString)), 'w') as fo:
+            json.dump(summary, fo, indent=1)
+
+    def submit_local(self):
+        if not self.cfg.submit_local_jobs: return
+
+        configString = self.cfg.get_config_string()
+        packs = self.get_packs()
+        nfiles = sum(len(pack) for pack in packs)
+        n_skipped = len(self.cfg.get_indices()) - nfiles
+        self.progress.add('skipped', n_skipped)
+        self.write_pack_scripts(packs)
+
+        if not packs:
+            self.print_summary(0, 0, n_skipped)
+            return
+
+        executor = LocalExecutor(self.cfg, self.fgen)
+        jobs = [("%s%04i" % (configString, pack[0]), self.job_script(pack), len(pack)) for pack in packs]
+        self.progress.add('submitted', nfiles)
+        self.fgen.get_db().mark(configString, [i for pack in packs for i in pack], 'submitted', "local",
+            {i: "%s%04i" % (configString, pack[0]) for pack in packs for i in pack})
+        self.print_summary(nfiles, len(packs), n_skipped)
+        results = executor.run(jobs)
+        print ("Local jobs finished: %d succeeded, %d failed, %d cancelled." % (results.count(0), len([r for r in results if r not in (0, None)]), results.count(None)))
+        missing = self.get_missing_indices(refresh=True)
+        if missing:
+            print ("%d files are still missing outputs: %s" % (len(missing), compress_indices(missing)))
+
+    def record_condor_cluster(self, cluster, packs, first_proc=0):
+        # Proc first_proc + N of the cluster runs the Nth queued pack of indices
+        configString = self.cfg.get_config_string()
+        schedd = os.environ.get("_CONDOR_SCHEDD_HOST", "-")
+        with open(self.fgen.path("%s/condor%s.clusters" % (self.fgen.condordir, configString)), 'a') as fo:
+            fo.write("%d %s %s\n" % (cluster, schedd, compress_indices([i for pack in packs for i in pack])))
+        with open(self.fgen.path("%s/condor%s.%d.procs" % (self.fgen.condordir, configString, cluster)), 'w') as fo:
+            for proc, pack in enumerate(packs, first_proc):
+                fo.write("%d.%d %s\n" % (cluster, proc, compress_indices(pack)))
+        self.record_submission("submitted to cluster %d" % cluster, "condor", packs,
+            {pack[0]: proc for proc, pack in enumerate(packs, first_proc)}, "%s.%d")
+
+class ScanSubmitter:
+    # Submits all points of a parameter scan together: one condor cluster, one slurm array and one local pool.
+    # Backend settings are shared by the points, so they are taken from the first one.
+    def __init__(self, configs, name, progress=None):
+        self.configs = configs
+        self.name = "_scan_%s_" % name
+        self.progress = progress if progress is not None else Progress()
+        self.throttles = {}
+        self.submitters = [JobSubmitter(config, FileGenerator(config, self.progress), self.throttles) for config in configs]
+        self.cfg = configs[0]
+        self.fgen = self.submitters[0].fgen
+        self.jobs = None
+
+    def collect(self):
+        # (submitter, pack) for the missing files of every point
+        if self.jobs is None:
+            self.jobs = []
+            for submitter in self.submitters:
+                packs = submitter.get_packs()
+                self.progress.add('skipped', len(submitter.cfg.get_indices()) - sum(len(pack) for pack in packs))
+                submitter.write_pack_scripts(packs)
+                self.jobs.extend((submitter, pack) for pack in packs)
+        return self.jobs
+
+    def submit(self):
+        if self.cfg.submit_sukap_jobs:
+            for submitter in self.submitters:
+                submitter.submit_sukap()
+        if self.cfg.submit_cedar_jobs:
+            if self.cfg.cedar_array or self.cfg.compact:
+                self.submit_cedar_array()
+            else:
+                for submitter in self.submitters:
+                    submitter.submit_cedar()
+        if self.cfg.submit_condor_jobs:
+            self.submit_condor()
+        if self.cfg.submit_local_jobs:
+            self.submit_local()
+        self.print_report()
+
+    def submit_cedar_array(self):
+        print ("Creating slurm array script for %d scan points" % len(self.submitters))
+        with open(self.fgen.path("template/slurm.sh"), 'r') as f:
+            slTemplate = string.Template(f.read())
+
+        # Task N runs line N+1 of the task file, which spans all points
+        jobs = self.collect()
+        taskFile = "%s/slurm%s.tasks" % (self.fgen.sldir, self.name)
+        with open(self.fgen.path(taskFile), 'w') as fo:
+            for submitter, pack in jobs:
+                fo.write("%s\n" % submitter.job_script(pack))
+        slFile = "%s/slurm%sarray.sh" % (self.fgen.sldir, self.name)
+        self.submitters[0].write_array_script(slTemplate, slFile, self.name,
+            "$(sed -n \"$((SLURM_ARRAY_TASK_ID + 1))p\" %s)" % taskFile)
+
+        if len(jobs) > 0:
+            print ("Submitting slurm job array on cedar")
+        throttle = self.submitters[0].get_throttle("cedar")
+        pos = 0
+        while pos < len(jobs):
+            n = throttle.acquire(len(jobs) - pos)
+            if n == 0:
+                for submitter in self.submitters:
+                    submitter.defer([pack for s, pack in jobs[pos:] if s is submitter])
+                break
+            arraySpec = "%d-%d" % (pos, pos + n - 1)
+            if self.cfg.cedar_array_limit > 0:
+                arraySpec += "%%%d" % self.cfg.cedar_array_limit
+            chunk = [(task, jobs[task]) for task in range(pos, pos + n)]
+            res = self.submitters[0].run_submit_command("sbatch --array=%s %s" % (arraySpec, slFile), sum(len(pack) for task, (s, pack) in chunk), "Cedar")
+            for submitter in self.submitters:
+                tasks = {pack[0]: task for task, (s, pack) in chunk if s is submitter}
+                if tasks:
+                    submitter.submit_error = self.submitters[0].submit_error
+                    submitter.record_submission(res, "cedar", [pack for task, (s, pack) in chunk if s is submitter], tasks)
+            pos += n
+
+    def submit_condor(self):
+        print ("Creating condor submit description for %d scan points" % len(self.submitters))
+        with open(self.fgen.path("template/condor_submit.sub"), 'r') as f:
+            condorTemplate = string.Template(f.read())
+
+        jobs = self.collect()
+        condorFile = "%s/condor%s.sub" % (self.fgen.condordir, self.name)
+        itemFile = "%s/condor%s.items" % (self.fgen.condordir, self.name)
+        with open(self.fgen.path(itemFile), 'w') as fo:
+            for submitter, pack in jobs:
+                fo.write(submitter.condor_item(pack))
+        self.submitters[0].write_condor_description(condorTemplate, condorFile, itemFile)
+
+        nfiles = sum(len(pack) for submitter, pack in jobs)
+        if len(jobs) > 0:
+            print ("Submitting condor jobs on lxplus")
+            res = self.submitters[0].run_submit_command("module load lxbatch/eossubmit && condor_submit %s" % (condorFile), nfiles, "Condor")
+            match = re.search(r"submitted to cluster (\d+)", res or "")
+            if res is None:
+                for submitter in self.submitters:
+                    packs = [pack for s, pack in jobs if s is submitter]
+                    if packs:
+                        submitter.submit_error = self.submitters[0].submit_error
+                        submitter.record_submission(res, "condor", packs)
+            elif match:
+                # Each point keeps its own cluster record, with the proc numbers of its packs
+                proc = 0
+                for submitter in self.submitters:
+                    packs = [pack for s, pack in jobs if s is submitter]
+                    if packs:
+                        submitter.record_condor_cluster(int(match.group(1)), packs, proc)
+                    proc += len(packs)
+
+    def submit_local(self):
+        jobs = self.collect()
+        nfiles = sum(len(pack) for submitter, pack in jobs)
+        if len(jobs) == 0:
+            return
+        self.progress.add('submitted', nfiles)
+        for submitter, pack in jobs:
+            name = "%s%04i" % (submitter.cfg.get_config_string(), pack[0])
+            submitter.fgen.get_db().mark(submitter.cfg.get_config_string(), pack, 'submitted', "local", name)
+        results = LocalExecutor(self.cfg, self.fgen).run([
+            ("%s%04i" % (submitter.cfg.get_config_string(), pack[0]), submitter.job_script(pack), len(pack)) for submitter, pack in jobs])
+        print ("Local jobs finished: %d succeeded, %d failed, %d cancelled." % (results.count(0), len([r for r in results if r not in (0, None)]), results.count(None)))
+
+    def print_report(self):
+        snap = self.progress.snapshot()
+        print ("Scan %s: %d points" % (self.name, len(self.submitters)))
+        for submitter in self.submitters:
+            nfiles = len(submitter.get_missing_indices())
+            deferred = sorted(submitter.deferred_submissions)
+            print ("  %-45s %6d submitted %6d skipped%s" % (submitter.cfg.get_config_string(), nfiles - len(deferred), len(submitter.cfg.get_indices()) - nfiles,
+                ", queue full, not submitted: %s" % compress_indices(deferred) if deferred else ""))
+        print ("Generated %d files, submitted %d files, skipped %d, failed %d, deferred %d in %.1f s." % (
+            snap['generated'], snap['submitted'], snap['skipped'], snap['failed'], snap['deferred'], snap['elapsed']))
+
+class OutputMerger:
+    # Combines the validated outputs of a configuration into files of about merge_size GB per stage in out/merged/.
+    # Each merged file gets a JSON manifest next to it listing its source indices, so a later --merge only
+    # plans the new files and CompletionIndex counts merged indices as done even after the sources were removed.
+    def __init__(self, config, file_generator, submitter=None):
+        self.cfg = config
+        self.fgen = file_generator
+        self.submitter = submitter if submitter is not None else JobSubmitter(config, file_generator)
+        self.mergedir = "%s/merged" % file_generator.outdir
+        self.workers = config.merge_workers if config.merge_workers > 0 else (os.cpu_count() or 1)
+
+    def batch(self):
+        return self.cfg.merge_batch and (self.cfg.submit_sukap_jobs or self.cfg.submit_cedar_jobs or self.cfg.submit_condor_jobs)
+
+    def plan(self):
+        # Pending manifests of merges to run, the last smaller group of a stage waits until all its files are there
+        configString = self.cfg.get_config_string()
+        indices = self.cfg.get_indices()
+        mergedir = self.fgen.path(self.mergedir)
+        if not os.path.exists(mergedir):
+            os.makedirs(mergedir)
+        merged = {}
+        for manifest in read_merge_manifests(mergedir):
+            if manifest['config'] == configString:
+                merged.setdefault(manifest['stage'], set()).update(expand_indices(manifest['indices']))
+        # Merges of batch jobs may still be running, those of an interrupted local merge are planned again
+        for manifest in read_merge_manifests(mergedir, pending=True):
+            if manifest['config'] != configString:
+                continue
+            if manifest['batch']:
+                merged.setdefault(manifest['stage'], set()).update(expand_indices(manifest['indices']))
             else:
-                n_skipped += 1
-        print ("Submitted %d jobs. Skipped %d jobs due to existing files." % (n_submitted, n_skipped))
+                os.remove(self.fgen.path("%s.pending.json" % manifest['file'][:-5]))
+
+        completion = self.submitter.get_completion(refresh=True)
+        pendings = []
+        for stage in self.submitter.get_stages():
+            done = merged.get(stage, set()) & set(indices)
+            candidates = sorted((completion.files.get((stage, configString), set()) & set(indices)) - done)
+            files = [self.fgen.path("%s/%s%s%04i.root" % (self.fgen.outdir, stage, configString, i)) for i in candidates]
+            results = validate_files(files, self.cfg.nevs, self.workers, remove=False)
+            valid = [(i, os.path.getsize(result.file), result.entries) for i, result in zip(candidates, results) if result.verdict == "ok"]
+            print ("%s%s: %d merged, %d files to merge, %d not valid" % (stage, configString, len(done), len(valid), len(candidates) - len(valid)))
+
+            group, size = [], 0
+            for i, nbytes, entries in valid:
+                group.append((i, entries))
+                size += nbytes
+                if size >= self.cfg.merge_size * 1e9:
+                    pendings.append(self.write_pending(stage, group))
+                    group, size = [], 0
+            if group and len(done) + len(valid) == len(indices):
+                pendings.append(self.write_pending(stage, group))
+        return pendings
+
+    def write_pending(self, stage, group):
+        configString = self.cfg.get_config_string()
+        indices = [i for i, entries in group]
+        name = "%s/%s%s%04i-%04i" % (self.mergedir, stage, configString, indices[0], indices[-1])
+        # hadd runs in the container of the jobs, the paths are relative to curdir
+        batch = self.batch()
+        exe = "apptainer" if batch and self.cfg.submit_condor_jobs else "singularity"
+        userns = "-u" if self.cfg.submit_sukap_jobs else ""
+        siffile = self.cfg.sandbox if self.cfg.submit_sukap_jobs else self.cfg.siffile
+        pending = {
+            'config': configString,
+            'stage': stage,
+            'file': "%s.root" % name,
+            'indices': compress_indices(indices),
+            'sources': ["%s/%s%s%04i.root" % (self.fgen.outdir, stage, configString, i) for i in indices],
+            'entries': sum(entries for i, entries in group if entries is not None),
+            'log': "%s/merge%s.log" % (self.fgen.logdir, os.path.basename(name)),
+            'curdir': self.cfg.curdir,
+            'mntdir': self.cfg.mntdir,
+            'container': "%s exec %s -B %s:%s %s" % (exe, userns, self.cfg.curdir, self.cfg.mntdir, siffile),
+            'fanin': self.cfg.merge_fanin,
+            'remove': self.cfg.merge_remove,
+            'batch': batch,
+            'created': time.time()
+        }
+        path = self.fgen.path("%s.pending.json" % name)
+        with open(path, 'w') as fo:
+            json.dump(pending, fo, indent=1)
+        return path
+
+    def run(self):
+        pendings = self.plan()
+        if not pendings:
+            print ("Nothing to merge for %s" % self.cfg.get_config_string())
+            return []
+        if self.batch():
+            self.submit(pendings)
+            return []
+        start = time.time()
+        results = OutputMerger.merge(pendings, self.workers)
+        print ("Merged %d of %d files in %.1f s" % (results.count(True), len(results), time.time() - start))
+        return results
+
+    @staticmethod
+    def load(pending):
+        with open(pending, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def merge(pendings, workers):
+        # Tree reduction: every hadd merges at most fanin inputs into a part file, and the parts are merged
+        # again until one hadd is enough. A level runs over all merges at once, so the pool stays busy.
+        merges = [OutputMerger.load(pending) for pending in pendings]
+        inputs = dict((k, merge['sources']) for k, merge in enumerate(merges))
+        ok = [True] * len(merges)
+        level = 0
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while inputs:
+                tasks = []
+                for k, files in inputs.items():
+                    fanin = max(2, merges[k]['fanin'])
+                    if len(files) <= fanin:
+                        tasks.append((k, merges[k]['file'] + ".tmp", files))
+                    else:
+                        for n in range(0, len(files), fanin):
+                            tasks.append((k, "%s.part%d_%d.root" % (merges[k]['file'][:-5], level, n // fanin), files[n:n + fanin]))
+                results = list(pool.map(lambda task: OutputMerger.hadd(merges[task[0]], task[1], task[2]), tasks))
+                parts = {}
+                for (k, target, sources), result in zip(tasks, results):
+                    ok[k] = ok[k] and result
+                    parts.setdefault(k, []).append(target)
+                    if level > 0:
+                        for source in sources:
+                            os.remove(os.path.join(merges[k]['curdir'], source))
+                inputs = {}
+                for k, targets in parts.items():
+                    if not ok[k]:
+                        for target in targets:
+                            if os.path.exists(os.path.join(merges[k]['curdir'], target)):
+                                os.remove(os.path.join(merges[k]['curdir'], target))
+                    elif targets != [merges[k]['file'] + ".tmp"]:
+                        inputs[k] = targets
+                level += 1
+        return [OutputMerger.finish(merge, result) for merge, result in zip(merges, ok)]
+
+    @staticmethod
+    def hadd(merge, target, sources):
+        mnt = lambda name: "%s/%s" % (merge['mntdir'], name)
+        command = "%s bash -c 'source /opt/entrypoint.sh && hadd -f %s %s'" % (merge['container'], mnt(target), " ".join(mnt(source) for source in sources))
+        with open(os.path.join(merge['curdir'], merge['log']), 'a') as fo:
+            com = subprocess.Popen(command, shell=True, cwd=merge['curdir'], stdout=fo, stderr=subprocess.STDOUT, close_fds=True)
+            return com.wait() == 0
+
+    @staticmethod
+    def finish(merge, ok):
+        # The merged file must hold every entry of its sources before it replaces anything
+        path = lambda name: os.path.join(merge['curdir'], name)
+        tmp = path(merge['file'] + ".tmp")
+        result = validate_file(tmp, merge['entries'], remove=False) if ok else None
+        if result is not None and result.verdict != "invalid":
+            os.replace(tmp, path(merge['file']))
+            manifest = dict((key, merge[key]) for key in ['config', 'stage', 'file', 'indices', 'entries'])
+            manifest.update(sources=len(merge['sources']), size=os.path.getsize(path(merge['file'])), time=time.time())
+            manifestFile = path("%s.json" % merge['file'][:-5])
+            with open(manifestFile + ".tmp", 'w') as fo:
+                json.dump(manifest, fo, indent=1)
+            os.replace(manifestFile + ".tmp", manifestFile)
+            if merge['remove']:
+                for source in merge['sources']:
+                    if os.path.exists(path(source)):
+                        os.remove(path(source))
+            print ("Merged %d files into %s (%d entries, %.2f GB)" % (len(merge['sources']), merge['file'], merge['entries'], manifest['size'] / 1e9))
+        else:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            print ("Merging into %s failed%s, see %s" % (merge['file'], ": %s" % result.reason if result is not None else "", merge['log']))
+        os.remove(path("%s.pending.json" % merge['file'][:-5]))
+        return result is not None and result.verdict != "invalid"
+
+    def submit(self, pendings):
+        # One batch job per merged file on the selected backend, running the same tree reduction with its cores
+        shFormat = compile_template(self.fgen.path("template/merge.sh"),
+            curdir=self.cfg.curdir,
+            cern_condor="" if self.cfg.submit_condor_jobs else "#",
+            ncpus=self.cfg.cpus_per_job
+        )
+        scripts = []
+        for pending in pendings:
+            name = "merge%s" % os.path.basename(pending)[:-len(".pending.json")]
+            shFile = "%s/%s.sh" % (self.fgen.shelldir, name)
+            with open(self.fgen.path(shFile), 'w') as fo:
+                fo.write(shFormat % {'pending': pending})
+            scripts.append((name, shFile, pending))
+
+        configString = self.cfg.get_config_string()
+        submitter = self.submitter
+        results = []
+        if self.cfg.submit_sukap_jobs:
+            with open(self.fgen.path("template/pjsub.sh"), 'r') as f:
+                pjTemplate = string.Template(f.read())
+            for name, shFile, pending in scripts:
+                pjFile = "%s/pjsub%s.sh" % (self.fgen.pjdir, name)
+                with open(self.fgen.path(pjFile), 'w') as fo:
+                    fo.write(pjTemplate.substitute(
+                        curdir=self.cfg.curdir,
+                        shFile=shFile,
+                        pjout="%s/pjsub%s.out" % (self.fgen.pjoutdir, name),
+                        pjerr="%s/pjsub%s.err" % (self.fgen.pjerrdir, name),
+                        elapse="%d:00:00" % self.cfg.walltime_hours,
+                        rscgrp=self.cfg.sukap_queue
+                    ))
+                if not submitter.get_throttle("sukap").acquire(1):
+                    results.append((None, [pending]))
+                    continue
+                results.append((submitter.run_submit_command("pjsub %s" % pjFile, 1, "Sukap"), [pending]))
+        elif self.cfg.submit_cedar_jobs:
+            with open(self.fgen.path("template/slurm.sh"), 'r') as f:
+                slTemplate = string.Template(f.read())
+            for name, shFile, pending in scripts:
+                slFile = "%s/slurm%s.sh" % (self.fgen.sldir, name)
+                with open(self.fgen.path(slFile), 'w') as fo:
+                    fo.write(slTemplate.substitute(
+                        account=self.cfg.rapaccount,
+                        curdir=self.cfg.curdir,
+                        mntdir=self.cfg.mntdir,
+                        siffile=self.cfg.siffile,
+                        sout="%s/slurm%s" % (self.fgen.sloutdir, name),
+                        serr="%s/slurm%s" % (self.fgen.slerrdir, name),
+                        cpus=self.cfg.cpus_per_job,
+                        mem="%iM" % (self.cfg.mem_per_cpu * self.cfg.cpus_per_job),
+                        walltime="%d-%d:0:0" % divmod(self.cfg.walltime_hours, 24),
+                        shFile=shFile
+                    ))
+                if not submitter.get_throttle("cedar").acquire(1):
+                    results.append((None, [pending]))
+                    continue
+                results.append((submitter.run_submit_command("sbatch %s" % slFile, 1, "Cedar"), [pending]))
+        elif self.cfg.submit_condor_jobs:
+            with open(self.fgen.path("template/condor_submit.sub"), 'r') as f:
+                condorTemplate = string.Template(f.read())
+            condorFile = "%s/condormerge%s.sub" % (self.fgen.condordir, configString)
+            itemFile = "%s/condormerge%s.items" % (self.fgen.condordir, configString)
+            with open(self.fgen.path(itemFile), 'w') as fo:
+                for name, shFile, pending in scripts:
+                    fo.write("%s, %s/condor%s, %s/condor%s, %s/condor%s\n" % (shFile,
+                        self.fgen.condorout, name, self.fgen.condorerr, name, self.fgen.condorlog, name))
+            submitter.write_condor_description(condorTemplate, condorFile, itemFile, args=False)
+            results.append((submitter.run_submit_command("module load lxbatch/eossubmit && condor_submit %s" % condorFile, len(scripts), "Condor"), pendings))
+        # Merges whose submission failed or found the queue full are planned again by the next --merge
+        failed = [pending for res, group in results if res is None for pending in group]
+        for pending in failed:
+            os.remove(pending)
+        print ("Submitted %d merge jobs for %s%s" % (len(scripts) - len(failed), configString, ", %d failed" % len(failed) if failed else ""))
+
+JobRecord = collections.namedtuple('JobRecord', ['job_id', 'name', 'config', 'index', 'state', 'runtime'])
+
+# Scheduler states mapped onto the slurm names
+CONDOR_STATES = {1: "PENDING", 2: "RUNNING", 3: "CANCELLED", 4: "COMPLETED", 5: "HELD", 6: "RUNNING", 7: "SUSPENDED"}
+PJM_STATES = {"ACC": "PENDING", "QUE": "PENDING", "RNA": "PENDING", "RNP": "RUNNING", "RUN": "RUNNING",
+              "RNE": "RUNNING", "RNO": "RUNNING", "EXT": "COMPLETED", "CCL": "CANCELLED", "HLD": "HELD", "ERR": "FAILED"}
+
+def parse_job_name(name, task=None):
+    # Recover (config string, file index) from the script name of a per-file or array/bulk job
+    m = re.match(r"^(?:slurm|pjsub|condor|run|pack)(.*_)(\d+)\.(?:sh|sub)$", name)
+    if m:
+        return m.group(1), int(m.group(2))
+    m = re.match(r"^(?:slurm|pjsub)(.*_)(?:array|bulk)\.sh$", name)
+    if m:
+        return m.group(1), task
+    # Generic job script of a compact campaign, with the file index as its argument
+    m = re.match(r"^job(.*_)\.sh(?: (\d+))?$", name)
+    if m:
+        return m.group(1), int(m.group(2)) if m.group(2) else task
+    return None, None
+
+def expand_array_tasks(spec):
+    # Task IDs of a slurm array range as printed by squeue for pending tasks: 5-9%3, 1,3,7-11:2
+    tasks = []
+    for part in spec.split('%')[0].split(','):
+        if not part: continue
+        step = 1
+        if ':' in part:
+            part, step = part.split(':')
+            step = int(step)
+        lo, _, hi = part.partition('-')
+        tasks.extend(range(int(lo), int(hi or lo) + 1, step))
+    return tasks
+
+def parse_duration(text):
+    # [days-]hours:minutes:seconds as printed by squeue and pjstat
+    try:
+        days = 0
+        if '-' in text:
+            d, text = text.split('-', 1)
+            days = int(d)
+        seconds = 0
+        for v in text.split(':'):
+            seconds = seconds * 60 + int(v)
+        return days * 86400 + seconds
+    except ValueError:
+        return None
 
 class JobStatus:
     def __init__(self, config):
@@ -372,6 +2368,9 @@ class JobStatus:
         self.user = os.environ.get('USER')
         if not self.user:
             self.user = getpass.getuser()
+        self.scan_tasks = {}
+
+    backends = ['sukap', 'cedar', 'condor', 'local']
 
     def get_jobs(self):
         jobs = {}
@@ -381,220 +2380,618 @@ class JobStatus:
             jobs['cedar'] = self.get_cedar_jobs()
         if self.cfg.submit_condor_jobs:
             jobs['condor'] = self.get_condor_jobs()
+        if self.cfg.submit_local_jobs:
+            jobs['local'] = self.get_local_jobs()
         return jobs
 
+    def status_command(self, backend):
+        # Ask each scheduler for this user's jobs only, in a form that does not depend on column widths
+        if backend == 'sukap':
+            return ["pjstat", "-E"]
+        if backend == 'cedar':
+            return ["squeue", "-u", self.user, "-h", "-o", "%i|%j|%T|%M"]
+        return ["condor_q", "-global", "-json", "-constraint", 'Owner == "%s"' % self.user,
+                "-attributes", "ClusterId,ProcId,Cmd,Args,JobStatus,JobCurrentStartDate"]
+
+    def run_status_command(self, backend):
+        com = subprocess.Popen(self.status_command(backend), stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        res, err = com.communicate()
+        return res.decode('utf-8')
+
+    def parse_jobs(self, backend, text):
+        if backend == 'sukap':
+            return self.parse_sukap_jobs(text)
+        if backend == 'cedar':
+            return self.parse_cedar_jobs(text)
+        return self.parse_condor_jobs(text)
+
     def get_sukap_jobs(self):
-        jobs = []
-        header = ""
         try:
-            com = subprocess.Popen("pjstat", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-            res, err = com.communicate()
-            if res:
-                lines = res.decode('utf-8').split('\n')
-                for line in lines:
-                    parts = line.split()
-                    if len(parts) < 5: continue
-                    if parts[0] == "JOB_ID":
-                        header = line
-                        continue
-                    if parts[4] == self.user:
-                        jobs.append(line)
+            return self.parse_sukap_jobs(self.run_status_command('sukap'))
         except Exception as e:
             print ("Error getting sukap jobs: %s" % str(e))
-        
-        if len(jobs) > 0 and header != "":
-            jobs.insert(0, header)
+        return []
+
+    def parse_sukap_jobs(self, text):
+        # pjstat has no machine-readable output, but the leading columns are fixed
+        jobs = []
+        for line in text.split('\n'):
+            parts = line.split()
+            if len(parts) < 5 or parts[0] == "JOB_ID" or parts[4] != self.user: continue
+            job_id = parts[0]
+            task = re.search(r"\[(\d+)\]$", job_id)
+            config, index = parse_job_name(parts[1], int(task.group(1)) if task else None)
+            jobs.append(JobRecord(job_id, parts[1], config, index, PJM_STATES.get(parts[3], "OTHER"), None))
         return jobs
 
     def get_cedar_jobs(self):
-        jobs = []
-        header = ""
         try:
-            com = subprocess.Popen("squeue", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-            res, err = com.communicate()
-            if res:
-                lines = res.decode('utf-8').split('\n')
-                for line in lines:
-                    parts = line.split()
-                    if len(parts) < 4: continue
-                    if parts[0] == "JOBID":
-                        header = line
-                        continue
-                    if parts[3] == self.user:
-                        jobs.append(line)
+            return self.parse_cedar_jobs(self.run_status_command('cedar'))
         except Exception as e:
             print ("Error getting cedar jobs: %s" % str(e))
-            
-        if len(jobs) > 0 and header != "":
-            jobs.insert(0, header)
+        return []
+
+    def get_scan_task(self, name, task):
+        # Task N of a scan array runs line N+1 of its task file, which names the job script of one file of one point
+        if name not in self.scan_tasks:
+            fgen = FileGenerator(self.cfg)
+            try:
+                with open(fgen.path("%s/%s.tasks" % (fgen.sldir, name[:-len("array.sh")])), 'r') as f:
+                    self.scan_tasks[name] = [parse_job_name(os.path.basename(line.strip())) for line in f]
+            except (IOError, OSError):
+                self.scan_tasks[name] = []
+        tasks = self.scan_tasks[name]
+        return tasks[task] if task is not None and 0 <= task < len(tasks) else (None, None)
+
+    def parse_cedar_jobs(self, text):
+        jobs = []
+        for line in text.split('\n'):
+            parts = line.strip().split('|')
+            if len(parts) < 4: continue
+            job_id, name, state, runtime = parts[:4]
+            # Array tasks show up as <jobid>_<task>, pending ranges as <jobid>_[a-b%limit], which get a record per task
+            pending = re.match(r"^(\d+)_\[(.*)\]$", job_id)
+            if pending:
+                tasks = [("%s_%d" % (pending.group(1), t), t) for t in expand_array_tasks(pending.group(2))]
+            else:
+                task = re.search(r"_(\d+)$", job_id)
+                tasks = [(job_id, int(task.group(1)) if task else None)]
+            for task_id, task in tasks:
+                if name.startswith("slurm_scan_") and name.endswith("array.sh"):
+                    config, index = self.get_scan_task(name, task)
+                else:
+                    config, index = parse_job_name(name, task)
+                jobs.append(JobRecord(task_id, name, config, index, state, parse_duration(runtime)))
         return jobs
 
     def get_condor_jobs(self):
-        jobs = []
         try:
-            com = subprocess.Popen("condor_q -global", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-            res, err = com.communicate()
-            if res:
-                lines = res.decode('utf-8').split('\n')
-                current_schedd = ""
-                current_header = ""
-                current_jobs = []
-
-                for line in lines:
-                    if line.startswith("-- Schedd"):
-                        if len(current_jobs) > 0:
-                            jobs.append(current_schedd)
-                            jobs.append(current_header)
-                            jobs.extend(current_jobs)
-                            jobs.append("")
-                        current_schedd = line
-                        current_header = ""
-                        current_jobs = []
-                    elif line.startswith("OWNER"):
-                        current_header = line
-                    else:
-                        parts = line.split()
-                        if len(parts) > 0 and parts[0] == self.user:
-                            current_jobs.append(line)
-                
-                if len(current_jobs) > 0:
-                    jobs.append(current_schedd)
-                    jobs.append(current_header)
-                    jobs.extend(current_jobs)
-
+            return self.parse_condor_jobs(self.run_status_command('condor'))
         except Exception as e:
             print ("Error getting condor jobs: %s" % str(e))
+        return []
+
+    def parse_condor_jobs(self, text):
+        # condor_q -global prints one JSON array per schedd, possibly with text in between
+        jobs = []
+        decoder = json.JSONDecoder()
+        pos = text.find('[')
+        now = time.time()
+        while pos >= 0:
+            try:
+                ads, end = decoder.raw_decode(text, pos)
+            except ValueError:
+                pos = text.find('[', pos + 1)
+                continue
+            for ad in ads:
+                name = os.path.basename(ad.get("Cmd", ""))
+                args = ad.get("Args", "").strip()
+                config, index = parse_job_name(name, int(args) if args.isdigit() else None)
+                state = CONDOR_STATES.get(ad.get("JobStatus"), "OTHER")
+                start = ad.get("JobCurrentStartDate")
+                runtime = int(now - start) if state == "RUNNING" and start else 0
+                jobs.append(JobRecord("%s.%s" % (ad.get("ClusterId"), ad.get("ProcId")), name, config, index, state, runtime))
+            pos = text.find('[', end)
         return jobs
 
-    def kill_jobs(self):
-        if self.cfg.submit_sukap_jobs:
-            self._kill_sukap_jobs()
-        if self.cfg.submit_cedar_jobs:
-            self._kill_cedar_jobs()
-        if self.cfg.submit_condor_jobs:
-            self._kill_condor_jobs()
+    def get_local_jobs(self):
+        fgen = FileGenerator(self.cfg)
+        localdir = fgen.path(fgen.localdir)
+        jobs = []
+        if not os.path.isdir(localdir):
+            return jobs
+        now = time.time()
+        for entry in sorted(os.listdir(localdir)):
+            if not entry.endswith(".state"): continue
+            try:
+                with open(os.path.join(localdir, entry)) as f:
+                    state, pid, start, script = f.read().strip().split(None, 3)
+            except (IOError, ValueError):
+                continue
+            name = os.path.basename(script)
+            config, index = parse_job_name(name)
+            runtime = int(now - float(start)) if state == "RUNNING" else 0
+            jobs.append(JobRecord(pid if state == "RUNNING" else entry[:-len(".state")], name, config, index, state, runtime))
+        return jobs
 
-    def _kill_sukap_jobs(self):
-        print("Killing sukap jobs...")
-        try:
-            com = subprocess.Popen("pjstat", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    # Job IDs per cancel command, well below the argument length limit
+    kill_batch = 500
+
+    @staticmethod
+    def listed(records):
+        # IDs of the listed jobs, and the base IDs of pending array tasks (123_5, expanded from 123_[5-99]) or bulk ranges (123[5-99])
+        ids = set(job.job_id for job in records)
+        ranges = set(re.split(r"[_\[]", job.job_id)[0] for job in records
+                     if "[" in job.job_id and "-" in job.job_id or job.state == "PENDING" and "_" in job.job_id)
+        return ids, ranges
+
+    def select_jobs(self, backend, records, config_string=None, indices=None, job_ids=None):
+        # IDs of the selected jobs that are still queued: explicit job IDs (or condor clusters),
+        # or the jobs of one config string, optionally only some indices, found in the listing and in the job database
+        ids, ranges = self.listed(records)
+        clusters = set(job_id.split(".")[0] for job_id in ids) if backend == 'condor' else set()
+        isQueued = lambda job_id: job_id in ids or job_id in clusters or re.split(r"[_\[.]", job_id)[0] in ranges
+        if job_ids:
+            return [job_id for job_id in job_ids if isQueued(job_id)]
+        indices = set(indices) if indices is not None else None
+        selected = set(job.job_id for job in records if job.config == config_string and (indices is None or job.index in indices))
+        fgen = FileGenerator(self.cfg)
+        for i, row in fgen.get_db().get_files(config_string).items():
+            if row['backend'] == backend and row['job_id'] and (indices is None or i in indices) and isQueued(row['job_id']):
+                selected.add(row['job_id'])
+        return sorted(selected)
+
+    def run_cancel(self, command, ids, weights=None, log=print):
+        # One command per batch of IDs; returns the number of jobs in the batches that succeeded
+        # (weights gives the number of jobs of an ID that is a whole cluster)
+        weights = weights or {}
+        cancelled = 0
+        ncommands = 0
+        for k in range(0, len(ids), self.kill_batch):
+            batch = ids[k:k + self.kill_batch]
+            # Quoted, since array ranges contain brackets
+            com = subprocess.Popen("%s %s" % (command, " ".join("'%s'" % job_id for job_id in batch)), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
             res, err = com.communicate()
-            if res:
-                lines = res.decode('utf-8').split('\n')
-                for line in lines:
-                    parts = line.split()
-                    if len(parts) > 4 and parts[4] == self.user:
-                        job_id = parts[0]
-                        print(f"Killing sukap job {job_id}")
-                        kill_com = subprocess.Popen(f"pjdel {job_id}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-                        kill_res, kill_err = kill_com.communicate()
-                        if kill_res:
-                            print(kill_res.decode('utf-8'))
-                        if kill_err:
-                            print(kill_err.decode('utf-8'))
-        except Exception as e:
-            print(f"Error killing sukap jobs: {e}")
+            ncommands += 1
+            if com.returncode == 0:
+                cancelled += sum(weights.get(job_id, 1) for job_id in batch)
+            elif err:
+                log (err.decode('utf-8').strip())
+            log ("%s: %d/%d" % (command, min(k + self.kill_batch, len(ids)), len(ids)))
+        return cancelled, ncommands
 
-    def _kill_cedar_jobs(self):
-        print(f"Killing cedar jobs for user {self.user}...")
-        try:
-            com = subprocess.Popen(f"scancel -u {self.user}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    def kill_jobs(self, config_string=None, indices=None, job_ids=None, log=print):
+        # Without a selection every job of the user on the enabled batch systems is cancelled.
+        # Returns the number of selected and cancelled jobs and of cancel commands per batch system,
+        # messages go to log (e.g. list.append to collect them for a server response).
+        counts = {}
+        for backend in self.backends:
+            if not getattr(self.cfg, "submit_%s_jobs" % backend):
+                continue
+            try:
+                counts[backend] = getattr(self, "_kill_%s_jobs" % backend)(config_string, indices, job_ids, log)
+            except Exception as e:
+                log ("Error killing %s jobs: %s" % (backend, e))
+                counts[backend] = {'selected': 0, 'cancelled': 0, 'commands': 0}
+                continue
+            log ("%s: cancelled %d of %d selected jobs with %d commands" % (
+                backend, counts[backend]['cancelled'], counts[backend]['selected'], counts[backend]['commands']))
+        return counts
+
+    def _kill_local_jobs(self, config_string=None, indices=None, job_ids=None, log=print):
+        log ("Killing local jobs...")
+        fgen = FileGenerator(self.cfg)
+        localdir = fgen.path(fgen.localdir)
+        counts = {'selected': 0, 'cancelled': 0, 'commands': 0}
+        if not os.path.isdir(localdir):
+            return counts
+        for entry in os.listdir(localdir):
+            if not entry.endswith(".state"): continue
+            stateFile = os.path.join(localdir, entry)
+            try:
+                with open(stateFile) as f:
+                    state, pid, start, script = f.read().strip().split(None, 3)
+                config, index = parse_job_name(os.path.basename(script))
+                if job_ids:
+                    if pid not in job_ids and entry[:-len(".state")] not in job_ids: continue
+                elif config_string and (config != config_string or indices is not None and index not in indices):
+                    continue
+                counts['selected'] += 1
+                # Removing the state file cancels a pending job
+                os.remove(stateFile)
+                if state == "RUNNING":
+                    log ("Killing local job %s" % pid)
+                    os.killpg(int(pid), signal.SIGTERM)
+                counts['cancelled'] += 1
+            except (IOError, OSError, ValueError) as e:
+                log ("Error killing local job %s: %s" % (entry, e))
+        return counts
+
+    def _kill_sukap_jobs(self, config_string=None, indices=None, job_ids=None, log=print):
+        log ("Killing sukap jobs...")
+        records = self.get_sukap_jobs()
+        if config_string or job_ids:
+            ids = self.select_jobs('sukap', records, config_string, indices, job_ids)
+        else:
+            ids = [job.job_id for job in records]
+        # pjdel takes any number of job IDs, including bulk sub-jobs
+        cancelled, ncommands = self.run_cancel("pjdel", ids, log=log)
+        return {'selected': len(ids), 'cancelled': cancelled, 'commands': ncommands}
+
+    def _kill_cedar_jobs(self, config_string=None, indices=None, job_ids=None, log=print):
+        if not config_string and not job_ids:
+            log ("Killing cedar jobs for user %s..." % self.user)
+            records = self.get_cedar_jobs()
+            com = subprocess.Popen("scancel -u %s" % self.user, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
             res, err = com.communicate()
-            if res:
-                print(res.decode('utf-8'))
             if err:
-                print(err.decode('utf-8'))
-        except Exception as e:
-            print(f"Error killing cedar jobs: {e}")
+                log (err.decode('utf-8'))
+            return {'selected': len(records), 'cancelled': len(records) if com.returncode == 0 else 0, 'commands': 1}
 
-    def _kill_condor_jobs(self):
-        print(f"Killing condor jobs for user {self.user}...")
-        try:
-            com = subprocess.Popen("condor_q -global", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-            res, err = com.communicate()
-            if res:
-                lines = res.decode('utf-8').split('\n')
-                schedds_with_user_jobs = set()
-                current_schedd = None
-
-                for line in lines:
-                    if line.startswith("-- Schedd"):
-                        # Example: -- Schedd: bigbird03.cern.ch (137.138.105.78) : <137.138.105.78:9618?...
+        log ("Killing selected cedar jobs...")
+        records = self.get_cedar_jobs()
+        ncommands = 0
+        cancelled = 0
+        byName = []
+        if config_string and indices is None and not job_ids:
+            # The whole array of the campaign goes by its job name, pending tasks included
+            arrayName = "slurm%sarray.sh" % config_string
+            byName = [job for job in records if job.name == arrayName]
+            if byName:
+                com = subprocess.Popen("scancel -u %s --name=%s" % (self.user, arrayName), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+                res, err = com.communicate()
+                ncommands += 1
+                if com.returncode == 0:
+                    cancelled += len(byName)
+                records = [job for job in records if job.name != arrayName]
+        ids = self.select_jobs('cedar', records, config_string, indices, job_ids)
+        n, m = self.run_cancel("scancel", ids, log=log)
+        return {'selected': len(byName) + len(ids), 'cancelled': cancelled + n, 'commands': ncommands + m}
+
+    def condor_schedds(self):
+        # cluster -> schedd from the cluster records written at submission
+        fgen = FileGenerator(self.cfg)
+        condordir = fgen.path(fgen.condordir)
+        schedds = {}
+        if os.path.isdir(condordir):
+            for entry in os.listdir(condordir):
+                if not entry.endswith(".clusters"): continue
+                with open(os.path.join(condordir, entry)) as f:
+                    for line in f:
                         parts = line.split()
-                        if len(parts) > 2:
-                            current_schedd = parts[2] # bigbird03.cern.ch
-                    else:
-                        job_parts = line.split()
-                        if len(job_parts) > 0 and job_parts[0] == self.user:
-                            if current_schedd:
-                                schedds_with_user_jobs.add(current_schedd)
-
-                if not schedds_with_user_jobs:
-                    print("No condor jobs found for user.")
-                    return
-
-                for schedd in schedds_with_user_jobs:
-                    print(f"Killing jobs on schedd: {schedd}")
-                    kill_command = f"condor_rm -name {schedd} {self.user}"
-                    print(f"Executing: {kill_command}")
-                    kill_com = subprocess.Popen(kill_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-                    kill_res, kill_err = kill_com.communicate()
-                    if kill_res:
-                        print(kill_res.decode('utf-8'))
-                    if kill_err:
-                        print(kill_err.decode('utf-8'))
+                        if len(parts) >= 2:
+                            schedds[parts[0]] = parts[1]
+        return schedds
+
+    def _kill_condor_jobs(self, config_string=None, indices=None, job_ids=None, log=print):
+        if not config_string and not job_ids:
+            return self._kill_all_condor_jobs(log)
+
+        log ("Killing selected condor jobs...")
+        records = self.get_condor_jobs()
+        ids = self.select_jobs('condor', records, config_string, indices, job_ids)
+        # A cluster whose listed jobs are all selected is removed as a whole
+        procs = {}
+        for job in records:
+            procs.setdefault(job.job_id.split(".")[0], set()).add(job.job_id)
+        selected = set(ids)
+        schedds = self.condor_schedds()
+        targets = {}
+        weights = {}
+        for job_id in ids:
+            cluster = job_id.split(".")[0]
+            if "." not in job_id or procs.get(cluster, set()) <= selected:
+                if cluster not in weights:
+                    weights[cluster] = len(procs.get(cluster, ()))
+                    targets.setdefault(schedds.get(cluster, "-"), []).append(cluster)
+            else:
+                targets.setdefault(schedds.get(cluster, "-"), []).append(job_id)
+        cancelled = 0
+        ncommands = 0
+        for schedd, batch in sorted(targets.items()):
+            n, m = self.run_cancel("condor_rm" if schedd == "-" else "condor_rm -name %s" % schedd, batch, weights, log=log)
+            cancelled += n
+            ncommands += m
+        nselected = sum(weights.get(t, 1) for batch in targets.values() for t in batch)
+        return {'selected': nselected, 'cancelled': cancelled, 'commands': ncommands}
 
+    def _kill_all_condor_jobs(self, log=print):
+        log ("Killing condor jobs for user %s..." % self.user)
+        com = subprocess.Popen("condor_q -global", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        res, err = com.communicate()
+        schedds_with_user_jobs = set()
+        current_schedd = None
+        for line in res.decode('utf-8').split('\n'):
+            if line.startswith("-- Schedd"):
+                # Example: -- Schedd: bigbird03.cern.ch (137.138.105.78) : <137.138.105.78:9618?...
+                parts = line.split()
+                if len(parts) > 2:
+                    current_schedd = parts[2] # bigbird03.cern.ch
+            else:
+                job_parts = line.split()
+                if len(job_parts) > 0 and job_parts[0] == self.user and current_schedd:
+                    schedds_with_user_jobs.add(current_schedd)
+
+        if not schedds_with_user_jobs:
+            log ("No condor jobs found for user.")
+            return {'selected': 0, 'cancelled': 0, 'commands': 0}
+
+        # One condor_rm per schedd removes all of the user's jobs there
+        njobs = len(self.get_condor_jobs())
+        failed = 0
+        for schedd in sorted(schedds_with_user_jobs):
+            kill_command = "condor_rm -name %s %s" % (schedd, self.user)
+            log ("Executing: %s" % kill_command)
+            kill_com = subprocess.Popen(kill_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+            kill_res, kill_err = kill_com.communicate()
+            if kill_res:
+                log (kill_res.decode('utf-8'))
+            if kill_err:
+                log (kill_err.decode('utf-8'))
+            failed += kill_com.returncode != 0
+        return {'selected': njobs, 'cancelled': njobs if not failed else 0, 'commands': len(schedds_with_user_jobs)}
+
+class StatusCache:
+    # Shares scheduler queries between concurrent callers of an asyncio server
+    def __init__(self, ttl=5, timeout=120):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.status = JobStatus(SimulationConfig())
+        self.entries = {}
+        self.inflight = {}
+        self.stats = {}
+        self.db = None
+        self.db_lock = threading.Lock()
+
+    def get_stats(self, backend):
+        if backend not in self.stats:
+            self.stats[backend] = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0, 'last_latency': None, 'total_latency': 0.}
+        return self.stats[backend]
+
+    def invalidate(self, backend=None):
+        if backend is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(backend, None)
+
+    async def get_jobs(self, backend):
+        stats = self.get_stats(backend)
+        entry = self.entries.get(backend)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            stats['hits'] += 1
+            return entry[1]
+
+        # Callers arriving while a query is running wait for the same result
+        task = self.inflight.get(backend)
+        if task is not None:
+            stats['coalesced'] += 1
+        else:
+            stats['misses'] += 1
+            task = asyncio.ensure_future(self.fetch(backend))
+            self.inflight[backend] = task
+            task.add_done_callback(lambda t: self.inflight.pop(backend, None))
+        return await asyncio.shield(task)
+
+    async def fetch(self, backend):
+        stats = self.get_stats(backend)
+        start = time.time()
+        try:
+            if backend == 'local':
+                jobs = self.status.get_local_jobs()
+                self.entries[backend] = (time.time(), jobs)
+                return jobs
+            command = self.status.status_command(backend)
+            com = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            try:
+                res, err = await asyncio.wait_for(com.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                com.kill()
+                await com.wait()
+                raise RuntimeError("%s timed out after %d s" % (command[0], self.timeout))
+            jobs = self.status.parse_jobs(backend, res.decode('utf-8'))
+            # The job scripts hold the same SQLite lock, so the write must not block the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.record_running, jobs)
         except Exception as e:
-            print(f"Error killing condor jobs: {e}")
+            stats['errors'] += 1
+            print ("Error getting %s jobs: %s" % (backend, str(e)))
+            return []
+        finally:
+            stats['last_latency'] = time.time() - start
+            stats['total_latency'] += stats['last_latency']
+        self.entries[backend] = (time.time(), jobs)
+        return jobs
+
+    def record_running(self, jobs):
+        # Runs in an executor thread, one JobDatabase is shared by all backends
+        try:
+            with self.db_lock:
+                if self.db is None:
+                    self.db = JobDatabase(os.path.join(self.status.cfg.curdir, self.status.cfg.db_file))
+            self.db.mark_running(jobs)
+        except sqlite3.Error as e:
+            print ("Error updating the job database: %s" % str(e))
+
+def run_campaign(config, progress=None):
+    fgen = FileGenerator(config, progress)
+    try:
+        fgen.create_directories()
+        submitter = JobSubmitter(config, fgen)
+        if config.validate_outputs:
+            fgen.progress.set_stage("validating")
+            submitter.validate_outputs()
+
+        if config.auto_resources > 0:
+            ResourceModel(fgen).apply(config, config.auto_resources)
+
+        # The budget only needs the missing files, so a refused campaign leaves no job files behind
+        if not CampaignPlanner(fgen).check_budget([config]):
+            fgen.progress.set_stage("failed", "over budget, nothing was generated or submitted")
+            return fgen.progress
+
+        fgen.progress.set_stage("generating")
+        fgen.generate_mac_files()
+        fgen.generate_shell_scripts()
+
+        fgen.progress.set_stage("submitting")
+        if config.retry_budget > 0:
+            submitter.retry_failures()
+        else:
+            submitter.submit_sukap()
+            submitter.submit_cedar()
+            submitter.submit_condor()
+            submitter.submit_local()
+    except Exception as e:
+        fgen.progress.set_stage("failed", str(e))
+        raise
+    fgen.progress.set_stage("done")
+    return fgen.progress
+
+def run_scan(configs, name, progress=None):
+    scan = ScanSubmitter(configs, name, progress)
+    try:
+        scan.fgen.create_directories()
+        if scan.cfg.validate_outputs:
+            scan.progress.set_stage("validating")
+            for submitter in scan.submitters:
+                submitter.validate_outputs()
+
+        if scan.cfg.auto_resources > 0:
+            model = ResourceModel(scan.fgen)
+            for config in configs:
+                model.apply(config, config.auto_resources)
+            if (scan.cfg.submit_cedar_jobs and (scan.cfg.cedar_array or scan.cfg.compact)) or scan.cfg.submit_condor_jobs:
+                # The points share one array script or submit description, sized for the most expensive point
+                for attr in ['walltime_hours', 'mem_per_cpu', 'condor_memory', 'local_mem_per_job']:
+                    setattr(scan.cfg, attr, max(getattr(config, attr) for config in configs))
+                scan.cfg.condor_queue = CONDOR_FLAVOURS[max(CONDOR_FLAVOURS.index(config.condor_queue) for config in configs)]
+
+        if not CampaignPlanner(scan.fgen).check_budget(configs):
+            scan.progress.set_stage("failed", "over budget, nothing was generated or submitted")
+            return scan.progress
+
+        scan.progress.set_stage("generating")
+        for submitter in scan.submitters:
+            submitter.fgen.generate_mac_files()
+            submitter.fgen.generate_shell_scripts()
+
+        scan.progress.set_stage("submitting")
+        if scan.cfg.retry_budget > 0:
+            for submitter in scan.submitters:
+                submitter.retry_failures()
+        else:
+            scan.submit()
+    except Exception as e:
+        scan.progress.set_stage("failed", str(e))
+        raise
+    scan.progress.set_stage("done")
+    return scan.progress
 
 def main():
     config = SimulationConfig()
 
     parser = argparse.ArgumentParser(description="Function to create mac, shell and batch job scripts for WCSim, MDT and fiTQun")
-    parser.add_argument('-p', '--pid', help='particle name (mu-, e-, etc.)')
-    parser.add_argument('-b', '--beam', help='generate beam with KE in MeV, wallDistance in cm (e.g. 100,0)')
-    parser.add_argument('-u', '--uniform', help='generate random vertices with uniform KE in MeV (e.g. 0,2000)')
+    parser.add_argument('-p', '--pid', help='particle name (mu-, e-, etc.), or a comma separated list for a scan')
+    parser.add_argument('-b', '--beam', action='append', help='generate beam with KE in MeV, wallDistance in cm (e.g. 100,0). Repeat it or use START:END:STEP values for a scan (e.g. 100:1000:100,0:60:30)')
+    parser.add_argument('-u', '--uniform', action='append', help='generate random vertices with uniform KE in MeV (e.g. 0,2000). Can be repeated for a scan')
     parser.add_argument('-m', '--cosmics', action='store_true', help='generate cosmic muon events')
+    parser.add_argument('--scan', help='campaign spec (JSON, or YAML with PyYAML) listing pid, beam and uniform points')
+    parser.add_argument('--scan-name', help='name of the combined submission files of a scan (default: spec file name)')
     parser.add_argument('-n', '--nevs', type=int, help='number of events per file')
     parser.add_argument('-f', '--nfiles', type=int, help='number of files to be generated')
     parser.add_argument('-s', '--seed', type=int, help='RNG seed used in this script')
+    parser.add_argument('--range', help='only generate and submit file indices START to END-1 (e.g. 9000:10000)')
+    parser.add_argument('--legacy-seeds', action='store_true', help='draw seeds from a single sequential stream as in older productions')
+    parser.add_argument('-j', '--jobs', type=int, help='number of threads used to write mac and shell files')
     parser.add_argument('-c', '--cds', action='store_true', help='disable CDS in WCSim')
     parser.add_argument('--wcsim', action='store_true', help='disable WCSim execution')
     parser.add_argument('--mdt', action='store_true', help='disable MDT execution')
     parser.add_argument('--fq', action='store_true', help='disable fiTQun execution')
+    parser.add_argument('--files-per-job', type=int, help='number of files run by each batch job')
+    parser.add_argument('--cpus-per-task', type=int, help='number of files of a job run in parallel (cedar and condor request this many cores)')
+    parser.add_argument('--min-size', type=int, help='treat output files smaller than this many bytes as missing')
+    parser.add_argument('--chained', action='store_true', help='run all stages of a job in a single container invocation')
+    parser.add_argument('--compact', action='store_true', help='write one campaign manifest and one generic job script instead of per-file macros and scripts')
+    parser.add_argument('--render-job', nargs=3, metavar=('MANIFEST', 'INDEX', 'OUTPUT'), help='render the macro and run script of one file of a compact campaign (used by the generic job script)')
+    parser.add_argument('--scratch', action='store_true', help='run the jobs in node-local scratch and copy only the validated outputs back')
+    parser.add_argument('--keep-stages', help='comma separated stages whose outputs are kept in out/ (default: all run stages), e.g. mdt,fq')
     parser.add_argument('-k', '--sukap', nargs='?', const='all', default=None, help='submit batch jobs on sukap. Optional: queue name (default: all)')
+    parser.add_argument('--bulk', action='store_true', help='submit sukap jobs as pjsub bulk jobs')
     parser.add_argument('-d', '--cedar', help='submit batch jobs on cedar with specified RAP account')
+    parser.add_argument('--validate', action='store_true', help='check the existing output files before submitting and remove the invalid ones')
+    parser.add_argument('--quarantine', nargs='?', const='quarantine', default=None, help='move invalid output files to this directory instead of removing them (default: quarantine)')
+    parser.add_argument('--db', help='job state database (default: jobs.db)')
+    parser.add_argument('--db-status', action='store_true', help='print the file states recorded in the job database instead of generating and submitting')
+    parser.add_argument('--set-state', nargs=3, metavar=('CONFIG', 'INDEX', 'STATE'), help='record the state of one file in the job database')
+    parser.add_argument('--retry', nargs='?', const=3, default=None, type=int, help='classify the failed files and resubmit the retryable ones, adjusting their resources. Optional: retry budget per file (default: 3)')
+    parser.add_argument('--local', nargs='?', const=0, default=None, type=int, help='run jobs on this machine. Optional: number of concurrent jobs (default: from cores and memory)')
+    parser.add_argument('--timeout', type=int, help='kill local jobs running longer than this many seconds')
+    parser.add_argument('--array', nargs='?', const=0, default=None, type=int, help='submit cedar jobs as a single slurm job array. Optional: maximum number of simultaneously running tasks')
     parser.add_argument('--condor', nargs='?', const='tomorrow', default=None, choices=CONDOR_FLAVOURS, help='submit batch jobs on lxplus. Optional: JobFlavour (default: tomorrow)')
+    parser.add_argument('--auto-resources', nargs='?', const=12, default=None, type=float, help='size walltime, memory and condor JobFlavour from the logs of completed jobs. Optional: target job duration in hours (default: 12)')
+    parser.add_argument('--resource-report', action='store_true', help='print the resources --auto-resources would request and exit')
+    parser.add_argument('--plan', action='store_true', help='print the missing files, core-hours, output volume per stage and time to drain the queue of the configuration (or scan) and exit without writing or submitting anything')
+    parser.add_argument('--budget', help='refuse to submit if the missing files need more than CPU_HOURS core-hours or STORAGE_GB of kept outputs, given as CPU_HOURS[,STORAGE_GB] (e.g. 5000,200 or ,200)')
+    parser.add_argument('--kill', action='store_true', help='cancel the queued jobs of the configuration (or scan) on the selected batch system, only the --range indices if given, and exit')
+    parser.add_argument('--kill-ids', help='cancel these comma separated job IDs (or condor clusters) on the selected batch system and exit')
+    parser.add_argument('--metrics', action='store_true', help='summarise the per-stage timing and memory of the finished jobs of the configuration (or scan) and exit')
+    parser.add_argument('--max-jobs', type=int, help='maximum number of your jobs in the queue, 0 for no limit (default: 300 on sukap, 1000 on cedar, no limit on condor)')
+    parser.add_argument('--submit-rate', type=float, help='maximum number of scheduler submissions per second, 0 for no limit (default: 5)')
+    parser.add_argument('--queue-wait', type=int, help='seconds to wait for free queue slots when --max-jobs is reached, -1 without limit (default: -1). The files that do not fit in time are reported and the exit code is 3')
+    parser.add_argument('--submit-retries', type=int, help='number of times a failed submission is retried with exponential backoff (default: 5)')
+    parser.add_argument('--merge', nargs='?', const=3., default=None, type=float, help='merge the validated outputs of the configuration (or scan) per stage into files of this many GB in out/merged/ and exit (default: 3)')
+    parser.add_argument('--merge-batch', action='store_true', help='run the merges as jobs on the selected batch system instead of on this machine')
+    parser.add_argument('--merge-remove', action='store_true', help='remove the source files once their merged file is checked')
+    parser.add_argument('--run-merge', help='run the merge of a pending manifest in out/merged/ (used by the merge jobs)')
 
     args = parser.parse_args()
 
-    if args.pid:
-        config.ParticleName = args.pid
-    if args.beam:
-        config.useBeam = True
-        config.useUniform = False
-        config.useCosmics = False
-        vals = args.beam.strip().split(",")
-        config.ParticleKE = float(vals[0])
-        config.wallD = float(vals[1])
-        config.ParticlePosz = -(config.TankRadius - config.wallD)
-    if args.uniform:
-        config.useBeam = False
-        config.useUniform = True
-        config.useCosmics = False
-        vals = args.uniform.strip().split(",")
-        config.ParticleKELow = float(vals[0])
-        config.ParticleKEHigh = float(vals[1])
-    if args.cosmics:
-        config.useBeam = False
-        config.useUniform = False
-        config.useCosmics = True
+    if args.db:
+        config.db_file = args.db
+    if args.set_state:
+        # Manual correction of one file, nothing else is set up
+        if args.set_state[2] not in JobDatabase.states:
+            print ("ERROR: unknown state %s" % args.set_state[2])
+            sys.exit(1)
+        JobDatabase(os.path.join(config.curdir, config.db_file)).mark(args.set_state[0], [int(args.set_state[1])], args.set_state[2])
+        return
+    if args.render_job:
+        sys.exit(0 if render_job(args.render_job[0], int(args.render_job[1]), args.render_job[2]) else 1)
+    if args.run_merge:
+        results = OutputMerger.merge([args.run_merge], args.jobs or 1)
+        sys.exit(0 if all(results) else 1)
+
+    particles = args.pid.split(",") if args.pid else []
+    beams = list(args.beam or [])
+    uniforms = list(args.uniform or [])
+    cosmics = args.cosmics
+    scanName = args.scan_name or "scan"
+    if args.scan:
+        spec = load_scan(args.scan)
+        aslist = lambda v: v if isinstance(v, list) else [v]
+        particles += aslist(spec.get('pid', []))
+        # Points are "KE,wallD" strings or [KE, wallD] pairs
+        beams += [",".join(str(v) for v in b) if isinstance(b, list) else b for b in aslist(spec.get('beam', []))]
+        uniforms += [",".join(str(v) for v in u) if isinstance(u, list) else u for u in aslist(spec.get('uniform', []))]
+        cosmics = cosmics or spec.get('cosmics', False)
+        if 'nevs' in spec: config.nevs = int(spec['nevs'])
+        if 'nfiles' in spec: config.nfiles = int(spec['nfiles'])
+        if 'seed' in spec: config.rngseed = int(spec['seed'])
+        scanName = args.scan_name or os.path.splitext(os.path.basename(args.scan))[0]
     if args.nevs is not None:
         config.nevs = args.nevs
     if args.nfiles is not None:
         config.nfiles = args.nfiles
     if args.seed is not None:
         config.rngseed = args.seed
+    if args.range:
+        vals = args.range.strip().split(":")
+        start = int(vals[0]) if vals[0] else 0
+        end = int(vals[1]) if len(vals) > 1 and vals[1] else config.nfiles
+        config.file_range = (start, end)
+    if args.legacy_seeds:
+        config.legacy_seeds = True
+    if args.jobs is not None:
+        config.gen_workers = args.jobs
     if args.cds:
         config.useCDS = False
     if args.wcsim:
@@ -603,29 +3000,135 @@ def main():
         config.runMDT = False
     if args.fq:
         config.runFQ = False
+    if args.chained:
+        config.chained = True
+    if args.compact:
+        config.compact = True
+    if args.scratch:
+        config.scratch = True
+    if args.keep_stages:
+        config.keep_stages = args.keep_stages.split(",")
+    if args.files_per_job is not None:
+        config.files_per_job = args.files_per_job
+    if args.cpus_per_task is not None:
+        config.cpus_per_job = args.cpus_per_task
+    if args.min_size is not None:
+        config.min_output_size = args.min_size
     if args.sukap is not None:
         config.submit_sukap_jobs = True
         if args.sukap != 'all':
             config.sukap_queue = args.sukap
+    if args.bulk:
+        config.sukap_bulk = True
     if args.cedar:
         config.submit_cedar_jobs = True
         config.rapaccount = args.cedar
+    if args.validate:
+        config.validate_outputs = True
+    if args.quarantine is not None:
+        config.quarantine_dir = args.quarantine
+    if args.retry is not None:
+        config.retry_budget = args.retry
+    if args.local is not None:
+        config.submit_local_jobs = True
+        config.local_workers = args.local
+    if args.timeout is not None:
+        config.local_timeout = args.timeout
+    if args.array is not None:
+        config.cedar_array = True
+        config.cedar_array_limit = args.array
     if args.condor is not None:
         config.submit_condor_jobs = True
         if args.condor != 'tomorrow':
             config.condor_queue = args.condor
+    if args.auto_resources is not None:
+        config.auto_resources = args.auto_resources
+    if args.budget:
+        vals = args.budget.strip().split(",")
+        try:
+            config.budget_core_hours = float(vals[0]) if vals[0] else 0
+            config.budget_storage_gb = float(vals[1]) if len(vals) > 1 and vals[1] else 0
+        except ValueError:
+            print ("ERROR: invalid budget %s." % args.budget)
+            sys.exit(1)
+    if args.max_jobs is not None:
+        config.max_jobs = args.max_jobs
+    if args.submit_rate is not None:
+        config.submit_rate = args.submit_rate
+    if args.queue_wait is not None:
+        config.queue_wait = args.queue_wait
+    if args.submit_retries is not None:
+        config.submit_retries = args.submit_retries
+    if args.merge is not None:
+        config.merge_size = args.merge
+        config.merge_workers = args.jobs or 0
+    if args.merge_batch:
+        config.merge_batch = True
+    if args.merge_remove:
+        config.merge_remove = True
+
+    if not args.db_status and not args.resource_report and not args.metrics and not args.plan and not args.kill and not args.kill_ids:
+        config.validate()
+
+    try:
+        configs = expand_scan(config, particles, beams, uniforms, cosmics)
+    except ValueError as e:
+        print ("ERROR: invalid scan point: %s" % e)
+        sys.exit(1)
+    if not check_scan(configs):
+        sys.exit(1)
+
+    if args.db_status:
+        for point in configs:
+            summary = FileGenerator(point).get_db().summary(point.get_config_string(), point.get_indices())
+            print ("%s: %s" % (summary['config'], ", ".join("%d %s" % (n, state) for state, n in sorted(summary['counts'].items()))))
+            print ("  missing: %s" % (summary['missing'] or "-"))
+            print ("  failed: %s" % (summary['failed'] or "-"))
+        return
+
+    if args.kill or args.kill_ids:
+        if not (config.submit_sukap_jobs or config.submit_cedar_jobs or config.submit_condor_jobs or config.submit_local_jobs):
+            print ("ERROR: select the batch system of the jobs to cancel.")
+            sys.exit(1)
+        status = JobStatus(config)
+        if args.kill_ids:
+            status.kill_jobs(job_ids=args.kill_ids.split(","))
+        else:
+            for point in configs:
+                status.kill_jobs(point.get_config_string(), point.get_indices() if point.file_range is not None else None)
+        return
+
+    if args.merge is not None:
+        for point in configs:
+            fgen = FileGenerator(point)
+            fgen.create_directories()
+            OutputMerger(point, fgen).run()
+        return
+
+    if args.metrics:
+        CampaignMetrics(FileGenerator(config)).report([point.get_config_string() for point in configs])
+        return
 
-    config.validate()
+    if args.resource_report:
+        # Dry run: nothing is generated or submitted
+        model = ResourceModel(FileGenerator(config))
+        for point in configs:
+            model.apply(point, config.auto_resources or 12)
+        return
 
-    fgen = FileGenerator(config)
-    fgen.create_directories()
-    fgen.generate_mac_files()
-    fgen.generate_shell_scripts()
+    if args.plan:
+        CampaignPlanner(FileGenerator(config)).report(configs)
+        return
 
-    submitter = JobSubmitter(config, fgen)
-    submitter.submit_sukap()
-    submitter.submit_cedar()
-    submitter.submit_condor()
+    if len(configs) == 1 and not args.scan:
+        progress = run_campaign(configs[0])
+    else:
+        progress = run_scan(configs, scanName)
+    if progress.stage == "failed":
+        sys.exit(1)
+    if progress.counts['deferred'] > 0:
+        # The queue stayed full for --queue-wait seconds, scripts must not take the campaign as fully submitted
+        sys.exit(3)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,5 @@
+# Stub container environment: the applications are small scripts writing fake output files.
+STUBCONTAINER=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+export PATH=$STUBCONTAINER/bin:$PATH
+export MDTROOT=$STUBCONTAINER/mdt
+export FITQUN_ROOT=$STUBCONTAINER/fitqun
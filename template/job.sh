@@ -0,0 +1,12 @@
+#!/bin/bash
+
+# Generic job of a compact campaign: renders the macro and run script of one file from the campaign manifest and runs them.
+# The file index is the first argument, or the array task or bulk number of the batch system.
+INDEX=$${1:-$${SLURM_ARRAY_TASK_ID:-$$PJM_BULKNUM}}
+MAC=$curdir/$macdir/wcsim$config$$(printf '%04i' $$INDEX).mac
+JOB=$$(mktemp $${TMPDIR:-/tmp}/run$config$$(printf '%04i' $$INDEX).XXXXXX)
+trap 'rm -f $$MAC $$JOB' EXIT
+
+cd $curdir
+python3 $curdir/runSimulation.py --render-job $manifest $$INDEX $$JOB || exit 1
+bash $$JOB
@@ -0,0 +1,8 @@
+#!/bin/bash
+
+${cern_condor}export APPTAINER_BINDPATH=/afs,/cvmfs,/cvmfs/grid.cern.ch/etc/grid-security:/etc/grid-security,/cvmfs/grid.cern.ch/etc/grid-security/vomses:/etc/vomses,/eos,/etc/pki/ca-trust,/etc/tnsnames.ora,/run/user,/var/run/user
+
+# Merge the sources listed in the pending manifest, running up to $ncpus hadd processes at a time,
+# then check the merged file and record it in its manifest
+cd $curdir
+python3 $curdir/runSimulation.py --run-merge $pending -j $ncpus
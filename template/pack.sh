@@ -0,0 +1,5 @@
+#!/bin/bash
+
+# Run several files in one batch job, $ncpus at a time
+cd $curdir
+printf '%s\n' $shFiles | xargs -P $ncpus -n 1 bash
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 #PJM -L rscgrp=$rscgrp              # Resource group (Queue name)
-#PJM -L elapse=24:00:00         # Time limit (24 hours)
+#PJM -L elapse=$elapse         # Time limit
 #PJM -o $pjout                  # Output log
 #PJM -e $pjerr                  # Error log
 
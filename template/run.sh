@@ -6,16 +6,81 @@ EXE=singularity
 ${cern_condor}export APPTAINER_BINDPATH=/afs,/cvmfs,/cvmfs/grid.cern.ch/etc/grid-security:/etc/grid-security,/cvmfs/grid.cern.ch/etc/grid-security/vomses:/etc/vomses,/eos,/etc/pki/ca-trust,/etc/tnsnames.ora,/run/user,/var/run/user
 ${cern_condor}EXE=apptainer
 
+MNT=$mntdir
+CUR=$curdir
+LOG=$logfile
+BINDS=""
+
+# Stage in node-local scratch: the container sees scratch directories as out/ and log/,
+# and only the validated outputs of the kept stages are copied back
+${scratch}SCRATCH=$$(mktemp -d $${SLURM_TMPDIR:-$${_CONDOR_SCRATCH_DIR:-$${TMPDIR:-/tmp}}}/wcte.XXXXXX)
+${scratch}trap 'rm -rf $$SCRATCH' EXIT
+${scratch}mkdir -p $$SCRATCH/out $$SCRATCH/log
+${scratch}CUR=$$SCRATCH
+${scratch}BINDS="-B $$SCRATCH/out:$mntdir/out -B $$SCRATCH/log:$mntdir/log"
+
+# Copy a file to the shared directory under a temporary name and rename it, so out/ never holds a partial file
+copyback() {
+    local src=$${1/#$$MNT/$$CUR} dst=$${1/#$$MNT/$curdir}
+    [ -f $$src ] && [ $$src != $$dst ] || return 0
+    cp $$src $$(dirname $$dst)/.$$(basename $$dst).tmp && mv $$(dirname $$dst)/.$$(basename $$dst).tmp $$dst || STATE=failed
+}
+
+# Check an output file without starting ROOT, falling back to RemoveInvalidFile.c in the container if it cannot be checked here
+validate() {
+    python3 $curdir/validation/validate_output.py -n $nevs $quarantine $${1/#$$MNT/$$CUR} &>> $${2/#$$MNT/$$CUR}
+    if [ $$? -gt 1 ]; then
+        $$EXE exec $userns -B $curdir:$mntdir $$BINDS $siffile bash -c "source /opt/entrypoint.sh && root -l -b -q $mntdir/validation/RemoveInvalidFile.c\(\\\"$$1\\\",$nevs\) &>> $$2"
+        [ "$$STATE" = failed ] || STATE=finished
+    fi
+    [ -f $${1/#$$MNT/$$CUR} ] || STATE=failed
+}
+
+# Run one stage, recording its wall and CPU time, peak memory, exit code and output size next to the log
+# (the stage runs unmeasured if there is no python3 on the node)
+measure() {
+    if command -v python3 &> /dev/null; then
+        python3 $curdir/validation/measure_stage.py --stage $$1 --nevs $nevs --log $${2/#$$MNT/$$CUR} --output $${3/#$$MNT/$$CUR} "$${@:4}"
+    else
+        "$${@:4}"
+    fi
+}
+
+# Record the file state next to the run log, the submit host folds it into the job database
+# (jobs do not open the SQLite file, its locking is unreliable on shared filesystems); this never stops the job
+setstate() {
+    local file=$${LOG/#$$MNT/$curdir}
+    file=$${file%.log}.state
+    echo "$$1 $$(date +%s.%N)" 2> /dev/null > $$file.tmp && mv $$file.tmp $$file 2> /dev/null
+}
+STATE=validated
+setstate running
+
 # run wcsim
-${runwcsim}$$EXE exec $userns -B $curdir:$mntdir $siffile bash -c 'source /opt/entrypoint.sh && WCSim $macfile $tuningfile &> $logfile'
+${runwcsim}measure wcsim $logfile $wcsimfile $$EXE exec $userns -B $curdir:$mntdir $$BINDS $siffile bash -c 'source /opt/entrypoint.sh && WCSim $macfile $tuningfile &> $logfile'
 
 # Remove in valid files
-${runwcsim}$$EXE exec $userns -B $curdir:$mntdir $siffile bash -c 'source /opt/entrypoint.sh && root -l -b -q $mntdir/validation/RemoveInvalidFile.c\(\"$wcsimfile\",$nevs\) &>> $logfile'
+${runwcsim}validate $wcsimfile $logfile
 
 # run mdt
-${runmdt}$$EXE exec $userns -B $curdir:$mntdir $siffile bash -c 'source /opt/entrypoint.sh && $$MDTROOT/app/application/appWCTESingleEvent -i $wcsimfile -p $$MDTROOT/parameter/MDTParamenter_WCTE.txt -o $mdtfile -s $rngseed -n -1 &>> $logfile'
-${runmdt}$$EXE exec $userns -B $curdir:$mntdir $siffile bash -c 'source /opt/entrypoint.sh && root -l -b -q $mntdir/validation/RemoveInvalidFile.c\(\"$mdtfile\",$nevs\) &>> $logfile'
+${runmdt}measure mdt $logfile $mdtfile $$EXE exec $userns -B $curdir:$mntdir $$BINDS $siffile bash -c 'source /opt/entrypoint.sh && $$MDTROOT/app/application/appWCTESingleEvent -i $wcsimfile -p $$MDTROOT/parameter/MDTParamenter_WCTE.txt -o $mdtfile -s $rngseed -n -1 &>> $logfile'
+${runmdt}validate $mdtfile $logfile
 
 # run fiTQun
-${runfq}$$EXE exec $userns -B $curdir:$mntdir $siffile bash -c 'source /opt/entrypoint.sh && $$FITQUN_ROOT/runfiTQunWC -p $$FITQUN_ROOT/ParameterOverrideFiles/nuPRISMBeamTest_16cShort_mPMT.parameters.dat -r $fqfile $mdtfile &>> $logfile'
-${runfq}$$EXE exec $userns -B $curdir:$mntdir $siffile bash -c 'source /opt/entrypoint.sh && root -l -b -q $mntdir/validation/RemoveInvalidFile.c\(\"$fqfile\",$nevs\) &>> $logfile'
+${runfq}measure fq $logfile $fqfile $$EXE exec $userns -B $curdir:$mntdir $$BINDS $siffile bash -c 'source /opt/entrypoint.sh && $$FITQUN_ROOT/runfiTQunWC -p $$FITQUN_ROOT/ParameterOverrideFiles/nuPRISMBeamTest_16cShort_mPMT.parameters.dat -r $fqfile $mdtfile &>> $logfile'
+${runfq}validate $fqfile $logfile
+
+# Outputs of stages that are not kept are only intermediates: they are dropped once the downstream stages succeeded,
+# a failed job leaves the validated ones in out/ for a retry of the later stages
+${scratch}copyback $logfile
+${scratch}copyback $${LOG%.log}.json
+${keepwcsim}copyback $wcsimfile
+${keepmdt}copyback $mdtfile
+${keepfq}copyback $fqfile
+${dropwcsim}OUTPUT=$wcsimfile; [ "$$STATE" = failed ] && copyback $$OUTPUT || rm -f $${OUTPUT/#$$MNT/$$CUR}
+${dropmdt}OUTPUT=$mdtfile; [ "$$STATE" = failed ] && copyback $$OUTPUT || rm -f $${OUTPUT/#$$MNT/$$CUR}
+${dropfq}OUTPUT=$fqfile; [ "$$STATE" = failed ] && copyback $$OUTPUT || rm -f $${OUTPUT/#$$MNT/$$CUR}
+
+setstate $$STATE
+# The exit code tells the batch system (and the local executor) whether the file failed
+[ "$$STATE" != failed ]
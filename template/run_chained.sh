@@ -0,0 +1,85 @@
+#!/bin/bash
+
+
+EXE=singularity
+
+${cern_condor}export APPTAINER_BINDPATH=/afs,/cvmfs,/cvmfs/grid.cern.ch/etc/grid-security:/etc/grid-security,/cvmfs/grid.cern.ch/etc/grid-security/vomses:/etc/vomses,/eos,/etc/pki/ca-trust,/etc/tnsnames.ora,/run/user,/var/run/user
+${cern_condor}EXE=apptainer
+
+MNT=$mntdir
+CUR=$curdir
+LOG=$logfile
+BINDS=""
+
+# Record the file state next to the run log, the submit host folds it into the job database
+# (jobs do not open the SQLite file, its locking is unreliable on shared filesystems); this never stops the job
+setstate() {
+    local file=$${LOG/#$$MNT/$curdir}
+    file=$${file%.log}.state
+    echo "$$1 $$(date +%s.%N)" 2> /dev/null > $$file.tmp && mv $$file.tmp $$file 2> /dev/null
+}
+setstate running
+
+# Stage in node-local scratch: the container sees scratch directories as out/ and log/,
+# and only the validated outputs of the kept stages are copied back
+${scratch}SCRATCH=$$(mktemp -d $${SLURM_TMPDIR:-$${_CONDOR_SCRATCH_DIR:-$${TMPDIR:-/tmp}}}/wcte.XXXXXX)
+${scratch}trap 'rm -rf $$SCRATCH' EXIT
+${scratch}mkdir -p $$SCRATCH/out $$SCRATCH/log
+${scratch}CUR=$$SCRATCH
+${scratch}BINDS="-B $$SCRATCH/out:$mntdir/out -B $$SCRATCH/log:$mntdir/log"
+
+# Copy a file to the shared directory under a temporary name and rename it, so out/ never holds a partial file
+copyback() {
+    local src=$${1/#$$MNT/$$CUR} dst=$${1/#$$MNT/$curdir}
+    [ -f $$src ] && [ $$src != $$dst ] || return 0
+    cp $$src $$(dirname $$dst)/.$$(basename $$dst).tmp && mv $$(dirname $$dst)/.$$(basename $$dst).tmp $$dst || STATE=failed
+}
+
+# Wall and CPU time, peak memory, exit code and output sizes of the whole chain are recorded next to the log
+OUTPUTS=""
+${runwcsim}OUTPUT=$wcsimfile; OUTPUTS="$$OUTPUTS --output $${OUTPUT/#$$MNT/$$CUR}"
+${runmdt}OUTPUT=$mdtfile; OUTPUTS="$$OUTPUTS --output $${OUTPUT/#$$MNT/$$CUR}"
+${runfq}OUTPUT=$fqfile; OUTPUTS="$$OUTPUTS --output $${OUTPUT/#$$MNT/$$CUR}"
+
+# run the whole WCSim -> MDT -> fiTQun chain in one container, validating each output before the next stage
+# (with ROOT only if python3 cannot check the file); without python3 on the node the chain runs unmeasured
+MEASURE=""
+command -v python3 &> /dev/null && MEASURE="python3 $curdir/validation/measure_stage.py --stage chain --nevs $nevs --log $${LOG/#$$MNT/$$CUR} $$OUTPUTS"
+$$MEASURE $$EXE exec $userns -B $curdir:$mntdir $$BINDS $siffile bash -c '
+source /opt/entrypoint.sh
+
+# run wcsim
+${runwcsim}WCSim $macfile $tuningfile &> $logfile
+${runwcsim}python3 $mntdir/validation/validate_output.py -n $nevs $quarantine $wcsimfile &>> $logfile
+${runwcsim}[ $$? -le 1 ] || root -l -b -q $mntdir/validation/RemoveInvalidFile.c\(\"$wcsimfile\",$nevs\) &>> $logfile
+${runwcsim}[ -f $wcsimfile ] || exit 1
+
+# run mdt
+${runmdt}$$MDTROOT/app/application/appWCTESingleEvent -i $wcsimfile -p $$MDTROOT/parameter/MDTParamenter_WCTE.txt -o $mdtfile -s $rngseed -n -1 &>> $logfile
+${runmdt}python3 $mntdir/validation/validate_output.py -n $nevs $quarantine $mdtfile &>> $logfile
+${runmdt}[ $$? -le 1 ] || root -l -b -q $mntdir/validation/RemoveInvalidFile.c\(\"$mdtfile\",$nevs\) &>> $logfile
+${runmdt}[ -f $mdtfile ] || exit 1
+
+# run fiTQun
+${runfq}$$FITQUN_ROOT/runfiTQunWC -p $$FITQUN_ROOT/ParameterOverrideFiles/nuPRISMBeamTest_16cShort_mPMT.parameters.dat -r $fqfile $mdtfile &>> $logfile
+${runfq}python3 $mntdir/validation/validate_output.py -n $nevs $quarantine $fqfile &>> $logfile
+${runfq}[ $$? -le 1 ] || root -l -b -q $mntdir/validation/RemoveInvalidFile.c\(\"$fqfile\",$nevs\) &>> $logfile
+${runfq}[ -f $fqfile ] || exit 1
+'
+
+[ $$? -eq 0 ] && STATE=validated || STATE=failed
+
+# Outputs of stages that are not kept are only intermediates: they are dropped once the downstream stages succeeded,
+# a failed job leaves the validated ones in out/ for a retry of the later stages
+${scratch}copyback $logfile
+${scratch}copyback $${LOG%.log}.json
+${keepwcsim}copyback $wcsimfile
+${keepmdt}copyback $mdtfile
+${keepfq}copyback $fqfile
+${dropwcsim}OUTPUT=$wcsimfile; [ "$$STATE" = failed ] && copyback $$OUTPUT || rm -f $${OUTPUT/#$$MNT/$$CUR}
+${dropmdt}OUTPUT=$mdtfile; [ "$$STATE" = failed ] && copyback $$OUTPUT || rm -f $${OUTPUT/#$$MNT/$$CUR}
+${dropfq}OUTPUT=$fqfile; [ "$$STATE" = failed ] && copyback $$OUTPUT || rm -f $${OUTPUT/#$$MNT/$$CUR}
+
+setstate $$STATE
+# The exit code tells the batch system (and the local executor) whether the file failed
+[ "$$STATE" != failed ]
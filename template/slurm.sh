@@ -1,10 +1,10 @@
 #!/bin/bash
 #SBATCH --account=$account
-#SBATCH --time=0-24:0:0
-#SBATCH --mem=16000M
+#SBATCH --time=$walltime
+#SBATCH --mem=$mem
 #SBATCH --output=$sout.%A.out
 #SBATCH --error=$serr.%A.err
-#SBATCH --cpus-per-task=1
+#SBATCH --cpus-per-task=$cpus
 
 module load apptainer
 
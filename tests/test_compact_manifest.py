@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import shutil
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, ROOT)
+import runSimulation
+
+def make_config(tmp_path, file_range, seed=20260129):
+    shutil.copytree(os.path.join(ROOT, "template"), str(tmp_path / "template"), dirs_exist_ok=True)
+    config = runSimulation.SimulationConfig()
+    config.curdir = str(tmp_path)
+    config.siffile = "/tmp/software.sif"
+    config.compact = True
+    config.nfiles = 20
+    config.nevs = 10
+    config.rngseed = seed
+    config.file_range = file_range
+    return config
+
+def generate(config):
+    fgen = runSimulation.FileGenerator(config)
+    fgen.create_directories()
+    fgen.generate_mac_files()
+    fgen.generate_shell_scripts()
+    return fgen.path(fgen.manifest_file())
+
+def test_second_range_keeps_the_first(tmp_path):
+    first = generate(make_config(tmp_path, (0, 10)))
+    with open(first) as f:
+        seeds = json.load(f)['seeds']
+    manifest = generate(make_config(tmp_path, (10, 20)))
+    assert manifest == first
+    with open(manifest) as f:
+        merged = json.load(f)
+    assert merged['indices'] == "0-19"
+    assert all(merged['seeds'][stage][i] == seed for stage in seeds for i, seed in seeds[stage].items())
+
+    output = str(tmp_path / "job.sh")
+    assert runSimulation.render_job(manifest, 3, output)
+    assert runSimulation.render_job(manifest, 15, output)
+
+def test_conflicting_seed_is_refused(tmp_path):
+    generate(make_config(tmp_path, (0, 10)))
+    try:
+        generate(make_config(tmp_path, (5, 15), seed=1))
+    except ValueError as e:
+        assert "different" in str(e)
+    else:
+        assert False, "a different seed for an existing file was accepted"
@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import runSimulation
+
+WARNING = """-------- WWWW ------- G4Exception-START -------- WWWW -------
+*** G4Exception : GeomNav1002
+      issued by : G4Navigator::ComputeStep()
+Track stuck or not moving.
+*** This is just a warning message. ***
+-------- WWWW -------- G4Exception-END --------- WWWW -------
+"""
+
+FATAL = """-------- EEEE ------- G4Exception-START -------- EEEE -------
+*** G4Exception : Run0035
+      issued by : G4RunManager::rndmSaveThisRun()
+Random number status was not stored.
+*** Fatal Exception *** core dump ***
+-------- EEEE -------- G4Exception-END --------- EEEE -------
+"""
+
+def make_classifier(tmp_path):
+    config = runSimulation.SimulationConfig()
+    config.curdir = str(tmp_path)
+    fgen = runSimulation.FileGenerator(config)
+    for d in (fgen.logdir, fgen.slerrdir):
+        os.makedirs(fgen.path(d), exist_ok=True)
+    return runSimulation.FailureClassifier(config, fgen), config.get_config_string(), fgen
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+def test_time_limit_beats_a_geant4_warning(tmp_path):
+    classifier, configString, fgen = make_classifier(tmp_path)
+    write(fgen.path("%s/run%s%04i.log" % (fgen.logdir, configString, 3)), WARNING * 3)
+    write(fgen.path("%s/slurm%s%04i.123.err" % (fgen.slerrdir, configString, 3)),
+          "slurmstepd: error: *** JOB 123 ON cdr1 CANCELLED AT 2026-01-01T00:00:00 DUE TO TIME LIMIT ***\n")
+    category, evidence = classifier.classify(3)
+    assert category == 'walltime'
+    assert evidence.startswith("slurm")
+    assert runSimulation.FailureClassifier.retryable[category]
+
+def test_geant4_warning_alone_is_not_fatal(tmp_path):
+    classifier, configString, fgen = make_classifier(tmp_path)
+    write(fgen.path("%s/run%s%04i.log" % (fgen.logdir, configString, 0)), WARNING)
+    assert classifier.classify(0)[0] == 'unknown'
+
+def test_fatal_geant4_exception(tmp_path):
+    classifier, configString, fgen = make_classifier(tmp_path)
+    write(fgen.path("%s/run%s%04i.log" % (fgen.logdir, configString, 0)), WARNING + FATAL)
+    assert classifier.classify(0)[0] == 'geant4'
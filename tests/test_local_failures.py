@@ -0,0 +1,40 @@
+import os
+import sys
+import shutil
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, ROOT)
+import runSimulation
+
+def run_local_campaign(tmp_path, monkeypatch, fail):
+    # The stubs stand in for the container and the batch systems, as in benchmark/benchmark.py
+    for name in ["runSimulation.py", "template", "validation", "stubs"]:
+        src = os.path.join(ROOT, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, str(tmp_path / name))
+        else:
+            shutil.copy(src, str(tmp_path / name))
+    monkeypatch.setenv("PATH", "%s:%s" % (tmp_path / "stubs", os.environ["PATH"]))
+    monkeypatch.setenv("STUB_FAIL", "1" if fail else "0")
+    config = runSimulation.SimulationConfig()
+    config.curdir = str(tmp_path)
+    config.siffile = str(tmp_path / "software.sif")
+    config.ParticleName = "e-"
+    config.nevs = 10
+    config.nfiles = 3
+    config.submit_local_jobs = True
+    config.local_workers = 2
+    progress = runSimulation.run_campaign(config, runSimulation.Progress())
+    states = runSimulation.FileGenerator(config).get_db().get_states(config.get_config_string())
+    return progress.snapshot(), states
+
+def test_failed_jobs_are_counted(tmp_path, monkeypatch):
+    snapshot, states = run_local_campaign(tmp_path, monkeypatch, fail=True)
+    assert snapshot['stage'] == "done"
+    assert snapshot['failed'] == 3
+    assert states == {0: 'failed', 1: 'failed', 2: 'failed'}
+
+def test_successful_jobs_are_validated(tmp_path, monkeypatch):
+    snapshot, states = run_local_campaign(tmp_path, monkeypatch, fail=False)
+    assert snapshot['failed'] == 0
+    assert states == {0: 'validated', 1: 'validated', 2: 'validated'}
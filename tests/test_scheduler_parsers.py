@@ -0,0 +1,78 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, ROOT)
+import runSimulation
+
+FIXTURES = os.path.join(ROOT, "stubs", "fixtures")
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+def make_status(tmp_path):
+    config = runSimulation.SimulationConfig()
+    config.curdir = str(tmp_path)
+    return runSimulation.JobStatus(config)
+
+def records(jobs):
+    return [(job.job_id, job.config, job.index, job.state) for job in jobs]
+
+def test_sukap_fixture(tmp_path):
+    status = make_status(tmp_path)
+    jobs = status.parse_sukap_jobs(read_fixture("pjstat.txt").replace("$USER", status.user))
+    assert records(jobs) == [
+        ("812345[3]", "_wCDS_mu-_Beam_100MeV_0cm_", 3, "RUNNING"),
+        ("812345[4]", "_wCDS_mu-_Beam_100MeV_0cm_", 4, "PENDING"),
+        ("812300", "_wCDS_e-_Uniform_0_500MeV_", 7, "RUNNING"),
+    ]
+
+def test_cedar_fixture(tmp_path):
+    jobs = make_status(tmp_path).parse_cedar_jobs(read_fixture("squeue.txt"))
+    mu = "_wCDS_mu-_Beam_100MeV_0cm_"
+    e = "_wCDS_e-_Uniform_0_500MeV_"
+    # The pending range 51234567_[5-9%3] is listed as one record per task
+    assert records(jobs) == [
+        ("51234567_5", mu, 5, "PENDING"),
+        ("51234567_6", mu, 6, "PENDING"),
+        ("51234567_7", mu, 7, "PENDING"),
+        ("51234567_8", mu, 8, "PENDING"),
+        ("51234567_9", mu, 9, "PENDING"),
+        ("51234567_3", mu, 3, "RUNNING"),
+        ("51234567_4", mu, 4, "RUNNING"),
+        ("51233001", e, 12, "RUNNING"),
+        ("51233002", e, 13, "PENDING"),
+    ]
+    assert jobs[5].runtime == 3723
+    assert jobs[7].runtime == 93600
+
+def test_condor_fixture(tmp_path):
+    jobs = make_status(tmp_path).parse_condor_jobs(read_fixture("condor_q.json"))
+    assert records(jobs) == [
+        ("1688489.0", "_wCDS_mu-_Beam_100MeV_0cm_", 0, "RUNNING"),
+        ("1688489.3", "_wCDS_mu-_Beam_100MeV_0cm_", 4, "PENDING"),
+        ("77102.0", "_wCDS_Comsics_", 42, "HELD"),
+    ]
+
+def test_scan_array_tasks_resolve_to_points(tmp_path):
+    # Task N of a scan array runs line N+1 of the task file, not file index N
+    status = make_status(tmp_path)
+    os.makedirs(str(tmp_path / "sldir"))
+    with open(str(tmp_path / "sldir" / "slurm_scan_energies_.tasks"), 'w') as f:
+        f.write("shell/run_wCDS_e-_Beam_100MeV_0cm_0000.sh\n")
+        f.write("shell/run_wCDS_e-_Beam_200MeV_0cm_0000.sh\n")
+        f.write("shell/job_wCDS_e-_Beam_300MeV_0cm_.sh 7\n")
+    text = "\n".join([
+        "900_1|slurm_scan_energies_array.sh|RUNNING|0:10",
+        "900_[2-3]|slurm_scan_energies_array.sh|PENDING|0:00",
+    ])
+    assert records(status.parse_cedar_jobs(text)) == [
+        ("900_1", "_wCDS_e-_Beam_200MeV_0cm_", 0, "RUNNING"),
+        ("900_2", "_wCDS_e-_Beam_300MeV_0cm_", 7, "PENDING"),
+        ("900_3", None, None, "PENDING"),
+    ]
+
+def test_expand_array_tasks():
+    assert runSimulation.expand_array_tasks("5-9%3") == [5, 6, 7, 8, 9]
+    assert runSimulation.expand_array_tasks("1,3,10-14:2") == [1, 3, 10, 12, 14]
@@ -0,0 +1,44 @@
+import os
+import sys
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "validation"))
+import validate_output
+
+FIXTURE = os.path.join(os.path.dirname(__file__), os.pardir, "stubs", "fixtures", "output.root")
+
+def write(tmp_path, data):
+    fname = str(tmp_path / "wcsim_0.root")
+    with open(fname, 'wb') as f:
+        f.write(data)
+    return fname
+
+def test_fixture_is_valid():
+    result = validate_output.validate_file(FIXTURE, 1, remove=False)
+    assert result.verdict == "ok"
+
+def test_truncated_header_is_invalid(tmp_path):
+    with open(FIXTURE, 'rb') as f:
+        data = f.read(40)
+    fname = write(tmp_path, data)
+    result = validate_output.validate_file(fname, 1)
+    assert result.verdict == "invalid"
+    assert not os.path.exists(fname)
+
+def test_negative_offset_in_header_is_invalid(tmp_path):
+    # fBEGIN pointing before the start of the file used to escape as an OSError from f.seek()
+    with open(FIXTURE, 'rb') as f:
+        data = bytearray(f.read())
+    struct.pack_into(">i", data, 8, -1000)
+    fname = write(tmp_path, bytes(data))
+    result = validate_output.validate_file(fname, 1)
+    assert result.verdict == "invalid"
+    assert not os.path.exists(fname)
+
+def test_corrupt_file_does_not_abort_the_pool(tmp_path):
+    with open(FIXTURE, 'rb') as f:
+        data = bytearray(f.read())
+    struct.pack_into(">i", data, 8, -1000)
+    bad = write(tmp_path, bytes(data))
+    results = validate_output.validate_files([FIXTURE, bad], 1, workers=2, remove=False)
+    assert [result.verdict for result in results] == ["ok", "invalid"]
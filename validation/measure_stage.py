@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Runs one stage of a job and records its wall time, CPU time, peak memory, exit code and output size
+# in a JSON sidecar next to the run log (log/run<config><index>.json), one entry per stage.
+# runSimulation.py --metrics summarises the sidecars and --auto-resources sizes later jobs from them.
+#
+# python3 validation/measure_stage.py --stage wcsim --nevs 1000 --log log/run_wCDS_mu-_Beam_100MeV_0cm_0000.log \
+#     --output out/wcsim_wCDS_mu-_Beam_100MeV_0cm_0000.root singularity exec ...
+# exits with the exit code of the command
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+def sidecar_path(logfile):
+    return (logfile[:-4] if logfile.endswith(".log") else logfile) + ".json"
+
+def record(logfile, stage, entry):
+    # Stages of a job run one after the other, so a plain read-modify-write is enough
+    path = sidecar_path(logfile)
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data.setdefault('stages', {})[stage] = entry
+    with open(path + ".tmp", 'w') as fo:
+        json.dump(data, fo)
+    os.replace(path + ".tmp", path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one job stage and record its resource usage')
+    parser.add_argument('--stage', required=True, help='stage name (wcsim, mdt, fq or chain)')
+    parser.add_argument('--nevs', type=int, default=0, help='number of events of the file')
+    parser.add_argument('--log', required=True, help='run log, the sidecar is written next to it')
+    parser.add_argument('--output', action='append', default=[], help='output file of the stage (can be repeated)')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='command of the stage')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("no command given")
+
+    start = time.time()
+    code = subprocess.call(args.command)
+    wall = time.time() - start
+    # Children's usage covers the container and everything it waited for; ru_maxrss is in kB on Linux
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record(args.log, args.stage, {
+        'start': start,
+        'wall': round(wall, 3),
+        'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+        'max_rss_kb': usage.ru_maxrss,
+        'exit_code': code,
+        'events': args.nevs,
+        'outputs': dict((os.path.basename(f), os.path.getsize(f) if os.path.exists(f) else 0) for f in args.output),
+    })
+    sys.exit(code if code >= 0 else 128 - code)
+
+if __name__ == '__main__':
+    main()
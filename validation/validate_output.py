@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Checks WCSim/MDT/fiTQun output files without starting ROOT.
+# Same checks as RemoveInvalidFile.c: the file must be a closed ROOT file with keys,
+# and its wcsimT or fiTQun tree must have at least nevs entries.
+# Only the file header, the key list and the start of the tree are read (standard library only).
+#
+# python3 validation/validate_output.py -n 1000 out/wcsim_*.root
+# exit code: 0 all files valid, 1 invalid files were removed (or quarantined), 2 some files could not be checked
+
+import os
+import sys
+import struct
+import zlib
+import lzma
+import shutil
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+TREE_NAMES = ("wcsimT", "fiTQun")
+
+# verdict is "ok", "invalid" or "unknown" (file could not be checked and is kept)
+Verdict = namedtuple('Verdict', ['file', 'verdict', 'entries', 'reason'])
+
+class RootFileError(Exception):
+    pass
+
+class UnsupportedCompression(Exception):
+    pass
+
+def read_string(buf, pos):
+    n = buf[pos]
+    pos += 1
+    if n == 255:
+        n = struct.unpack_from(">i", buf, pos)[0]
+        pos += 4
+    return buf[pos:pos + n].decode('latin-1'), pos + n
+
+def read_key(buf, pos):
+    nbytes, version, objlen, datime, keylen, cycle = struct.unpack_from(">ihiIhh", buf, pos)
+    p = pos + 18
+    if version > 1000:
+        seekkey, seekpdir = struct.unpack_from(">qq", buf, p)
+        p += 16
+    else:
+        seekkey, seekpdir = struct.unpack_from(">ii", buf, p)
+        p += 8
+    classname, p = read_string(buf, p)
+    name, p = read_string(buf, p)
+    title, p = read_string(buf, p)
+    return {'nbytes': nbytes, 'objlen': objlen, 'keylen': keylen, 'cycle': cycle, 'seekkey': seekkey,
+            'classname': classname, 'name': name}, p
+
+def decompress(data, need):
+    # ROOT compresses objects in blocks with a 9 byte header: algorithm, method, compressed and uncompressed size
+    out = b""
+    pos = 0
+    while pos < len(data) and len(out) < need:
+        algo = data[pos:pos + 2]
+        csize = data[pos + 3] | (data[pos + 4] << 8) | (data[pos + 5] << 16)
+        block = data[pos + 9:pos + 9 + csize]
+        if algo == b"ZL":
+            out += zlib.decompress(block)
+        elif algo == b"XZ":
+            out += lzma.decompress(block)
+        else:
+            raise UnsupportedCompression(algo.decode('latin-1', 'replace'))
+        pos += 9 + csize
+    return out
+
+def seek(f, pos):
+    # A corrupt key or header gives negative offsets, which f.seek() rejects with an OSError
+    if pos < 0:
+        raise RootFileError("corrupt file (offset %d)" % pos)
+    f.seek(pos)
+
+def read_tree_entries(f, key):
+    seek(f, key['seekkey'])
+    record = f.read(key['nbytes'])
+    if len(record) < key['nbytes']:
+        raise RootFileError("truncated %s" % key['name'])
+    data = record[key['keylen']:]
+    if key['objlen'] > len(data):
+        data = decompress(data, 256)
+    # TTree: byte count and version, then TNamed, TAttLine, TAttFill, TAttMarker (each with a byte count), then fEntries
+    pos = 6
+    for i in range(4):
+        bytecount = struct.unpack_from(">I", data, pos)[0] & ~0x40000000
+        pos += 4 + bytecount
+    return struct.unpack_from(">q", data, pos)[0]
+
+def check_root_file(fname):
+    # Returns the number of entries of the first tree found, raises RootFileError if the file is invalid
+    size = os.path.getsize(fname)
+    if size == 0:
+        raise RootFileError("empty file")
+    with open(fname, 'rb') as f:
+        header = f.read(64)
+        if len(header) < 53 or header[:4] != b"root":
+            raise RootFileError("not a ROOT file")
+        version, begin = struct.unpack_from(">ii", header, 4)
+        if version >= 1000000:
+            end = struct.unpack_from(">q", header, 12)[0]
+            nbytesname = struct.unpack_from(">i", header, 36)[0]
+        else:
+            end = struct.unpack_from(">i", header, 12)[0]
+            nbytesname = struct.unpack_from(">i", header, 28)[0]
+        if end > size:
+            raise RootFileError("truncated file (%d of %d bytes)" % (size, end))
+
+        # Top directory record: an unclosed file has no key list and would be recovered by ROOT
+        seek(f, begin + nbytesname)
+        directory = f.read(42)
+        dirversion = struct.unpack_from(">h", directory, 0)[0]
+        if dirversion > 1000:
+            seekkeys = struct.unpack_from(">q", directory, 34)[0]
+        else:
+            seekkeys = struct.unpack_from(">i", directory, 26)[0]
+        if seekkeys <= 0 or seekkeys >= end:
+            raise RootFileError("file was not closed")
+
+        seek(f, seekkeys)
+        keylist = f.read(end - seekkeys)
+        pos = read_key(keylist, 0)[0]['keylen']
+        nkeys = struct.unpack_from(">i", keylist, pos)[0]
+        pos += 4
+        if nkeys == 0:
+            raise RootFileError("no keys")
+        trees = {}
+        for i in range(nkeys):
+            key, pos = read_key(keylist, pos)
+            if key['classname'] == "TTree" and key['name'] in TREE_NAMES and key['cycle'] >= trees.get(key['name'], {'cycle': -1})['cycle']:
+                trees[key['name']] = key
+        for name in TREE_NAMES:
+            if name in trees:
+                return read_tree_entries(f, trees[name])
+        raise RootFileError("no wcsimT or fiTQun tree")
+
+def check_with_uproot(fname):
+    import uproot
+    try:
+        with uproot.open(fname) as f:
+            for name in TREE_NAMES:
+                if name in f:
+                    return f[name].num_entries
+    except Exception as e:
+        # uproot has its own error types (DeserializationError, KeyInFileError, ...), all of them mean a corrupt file
+        raise RootFileError("corrupt file (%s)" % e)
+    raise RootFileError("no wcsimT or fiTQun tree")
+
+def validate_file(fname, nevs, quarantine=None, remove=True):
+    if not os.path.exists(fname):
+        return Verdict(fname, "invalid", 0, "missing")
+    try:
+        try:
+            entries = check_root_file(fname)
+        except UnsupportedCompression as e:
+            try:
+                entries = check_with_uproot(fname)
+            except ImportError:
+                return Verdict(fname, "unknown", None, "unsupported compression %s" % e)
+        except (struct.error, IndexError, ValueError, OSError, zlib.error, lzma.LZMAError) as e:
+            raise RootFileError("corrupt file (%s)" % e)
+        if entries < nevs:
+            raise RootFileError("%d entries, expected %d" % (entries, nevs))
+    except RootFileError as e:
+        if quarantine:
+            os.makedirs(quarantine, exist_ok=True)
+            shutil.move(fname, os.path.join(quarantine, os.path.basename(fname)))
+        elif remove:
+            os.remove(fname)
+        return Verdict(fname, "invalid", 0, str(e))
+    return Verdict(fname, "ok", entries, "")
+
+def validate_files(files, nevs, workers=1, quarantine=None, remove=True):
+    if workers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda fname: validate_file(fname, nevs, quarantine, remove), files))
+    return [validate_file(fname, nevs, quarantine, remove) for fname in files]
+
+def main():
+    parser = argparse.ArgumentParser(description='Check ROOT output files and remove the invalid ones')
+    parser.add_argument('files', nargs='+', help='ROOT files to check')
+    parser.add_argument('-n', '--nevs', type=int, default=0, help='minimum number of entries')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of files checked in parallel')
+    parser.add_argument('-q', '--quarantine', help='move invalid files to this directory instead of removing them')
+    parser.add_argument('--keep', action='store_true', help='only report invalid files')
+    args = parser.parse_args()
+
+    results = validate_files(args.files, args.nevs, args.jobs, args.quarantine, not args.keep)
+    for result in results:
+        if result.verdict == "ok":
+            print ("%s: ok, %d entries" % (result.file, result.entries))
+        else:
+            print ("There is a problem with the file %s: %s" % (result.file, result.reason), file=sys.stderr)
+    if any(result.verdict == "unknown" for result in results):
+        sys.exit(2)
+    if any(result.verdict == "invalid" for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()